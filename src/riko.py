@@ -4,13 +4,38 @@ Project Riko
 Riko is a simple and light ORM for MySQL.
 DB Engine default to be pymysql, since not thread safe.
 """
+import asyncio
+import base64
+import bisect
 import contextlib
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import mmap
+import os
+import pickle
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
 import pymysql
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pymysql.constants import CLIENT, FIELD_TYPE, SERVER_STATUS
 from abc import ABCMeta, abstractmethod
-from datetime import date, datetime as dt
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from datetime import date, datetime as dt, time, timedelta
+from time import monotonic as time_monotonic, time as time_now
+from decimal import Decimal
 
-from DBUtils.PooledDB import PooledDB
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class INSERT:
@@ -27,37 +52,903 @@ class JOIN:
     RIGHT_JOIN = 3
 
 
+class DATETIME_DUMP:
+    NONE = False
+    EAGER = True
+    LAZY = 2
+
+
+class PING:
+    ALWAYS = 0
+    IDLE = 1
+    NEVER = 2
+
+
+class SHARD:
+    HASH = 0
+    RANGE = 1
+
+
+class CONNECTION:
+    SHORT = 0
+    THREAD_LOCAL = 1
+    POOLED = 2
+
+
 class ShadedDBPool:
     """
-    A shaded DB pool based on DBUtil.
+    A shaded DB pool, with a `ConnectionPool` for each db config.
     """
 
+    # max number of cached config keys, cleared when exceeded
+    _CONFIG_KEY_CAPACITY = 1024
+
     def __init__(self, driver=pymysql):
-        import threading
         self._db_driver_clz = driver
         self._configured_pool = dict()
+        self._pool_settings = dict()
+        self._config_keys = dict()
         self._sync_mutex = threading.Lock()
+        self._thread_local = threading.local()
+        # settings of pools not configured by `configure`
+        self.default_settings = dict(min_idle=0, max_size=500, max_lifetime=3600, idle_timeout=600,
+                                     checkout_timeout=30, max_usage=10000)
 
     def short_connection(self, db_config):
-        return self._db_driver_clz.connect(**db_config)
+        conn = self._db_driver_clz.connect(**db_config)
+        conn.riko_last_used = time_monotonic()
+        return conn
 
-    def pooled_connection(self, db_config):
+    def configure(self, db_config, **settings):
+        """
+        Set pool settings of a db config, see `ConnectionPool` for settings. The pool is rebuilt if it exists.
+        :param db_config: db connection config
+        :param settings: pool settings, others are default to `default_settings`
+        """
+        config_key = self.config_key(db_config)
+        with self._sync_mutex:
+            self._pool_settings[config_key] = settings
+            retired = self._configured_pool.pop(config_key, None)
+        if retired is not None:
+            retired.close()
+
+    def warm_up(self, db_config=None):
+        """
+        Connect `min_idle` connections of a pool in advance.
+        :param db_config: db connection config, None to use `Riko.db_config`
+        """
+        self._pool_of(Riko.db_config if db_config is None else db_config).warm_up()
+
+    def stats(self, db_config=None):
+        """
+        Get pool statistics of a db config.
+        :param db_config: db connection config, None to use `Riko.db_config`
+        :return: a dict, see `ConnectionPool.stats`
+        """
+        return self._pool_of(Riko.db_config if db_config is None else db_config).stats()
+
+    def config_key(self, db_config):
+        """
+        Get hashable key of a db config, cached for the config dict object.
+        A config dict changed in place gets a new key.
+        """
+        cached = self._config_keys.get(id(db_config))
+        # comparing with a copy is cheaper than sorting items again
+        if cached is not None and cached[0] is db_config and cached[1] == db_config:
+            return cached[2]
         config_key = tuple(sorted(db_config.items()))
-        if config_key in self._configured_pool:
-            pooled = self._configured_pool[config_key]
-        else:
+        if len(self._config_keys) >= ShadedDBPool._CONFIG_KEY_CAPACITY:
+            self._config_keys.clear()
+        self._config_keys[id(db_config)] = (db_config, dict(db_config), config_key)
+        return config_key
+
+    def forget_config(self, db_config):
+        """
+        Drop cached key of a db config dict.
+        """
+        self._config_keys.pop(id(db_config), None)
+
+    def pooled_connection(self, db_config):
+        return self._pool_of(db_config).connection()
+
+    def _pool_of(self, db_config):
+        config_key = self.config_key(db_config)
+        pooled = self._configured_pool.get(config_key)
+        if pooled is None:
             with self._sync_mutex:
-                if config_key not in self._configured_pool:
-                    pooled = PooledDB(self._db_driver_clz,
-                                      maxshared=1,
-                                      maxcached=500,
-                                      maxusage=10000,
-                                      setsession=['SET AUTOCOMMIT = 0'],
-                                      **db_config)
+                pooled = self._configured_pool.get(config_key)
+                if pooled is None:
+                    settings = dict(self.default_settings)
+                    settings.update(self._pool_settings.get(config_key, ()))
+                    pooled = ConnectionPool(lambda: self.short_connection(db_config),
+                                            init_statements=("SET AUTOCOMMIT = 0",), **settings)
                     self._configured_pool[config_key] = pooled
-                else:
-                    pooled = self._configured_pool[config_key]
-        return pooled.connection(shareable=False)
+        return pooled
+
+    def thread_connection(self, db_config):
+        """
+        Get the persistent connection of current thread, connecting if it is not connected or lost.
+        The connection is handed to one session at a time, a session gets a new connection while it is in use.
+        Closing the returned connection rolls back its open transaction and keeps it for the next use in this thread.
+        """
+        connections = getattr(self._thread_local, "connections", None)
+        if connections is None:
+            connections = self._thread_local.connections = dict()
+        config_key = self.config_key(db_config)
+        conn = connections.pop(config_key, None)
+        if conn is None or not getattr(conn, "open", True):
+            conn = self.short_connection(db_config)
+        return _ConnectionProxy(conn, release=lambda c: self._release_thread_connection(connections, config_key, c))
+
+    def close_thread_connections(self):
+        """
+        Close persistent connections of current thread.
+        """
+        connections = getattr(self._thread_local, "connections", None)
+        if connections:
+            for conn in connections.values():
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            connections.clear()
+
+    @staticmethod
+    def _release_thread_connection(connections, config_key, conn):
+        # a connection with an unread unbuffered result cannot run queries anymore
+        reusable = getattr(conn, "open", True) and not _has_unread_result(conn) and config_key not in connections
+        if reusable and getattr(conn, "server_status", 0) & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            try:
+                conn.rollback()
+            except pymysql.err.MySQLError:
+                reusable = False
+        if reusable:
+            connections[config_key] = conn
+        else:
+            conn.close()
+
+
+def _has_unread_result(conn):
+    result = getattr(conn, "_result", None)
+    return result is not None and getattr(result, "unbuffered_active", False)
+
+
+class ConnectionPool:
+    """
+    A blocking pool of connections of one db config.
+    """
+
+    def __init__(self, connect, min_idle=0, max_size=500, max_lifetime=3600, idle_timeout=600, checkout_timeout=30,
+                 max_usage=10000, init_statements=()):
+        """
+        Create a connection pool, connections are created when checked out or warmed up.
+        :param connect: function to create a connection
+        :param min_idle: idle connection number kept by `warm_up` and idle timeout
+        :param max_size: max connection number, checkout blocks when all are in use
+        :param max_lifetime: seconds before a connection is closed, None to keep forever
+        :param idle_timeout: seconds before an idle connection beyond `min_idle` is closed, None to keep forever
+        :param checkout_timeout: seconds to wait for a connection when all are in use, None to wait forever
+        :param max_usage: checkout number before a connection is closed, None for unlimited
+        :param init_statements: statements performed on new connections
+        """
+        assert max_size > 0 and 0 <= min_idle <= max_size
+        self._connect = connect
+        self._min_idle = min_idle
+        self._max_size = max_size
+        self._max_lifetime = max_lifetime
+        self._idle_timeout = idle_timeout
+        self._checkout_timeout = checkout_timeout
+        self._max_usage = max_usage
+        self._init_statements = tuple(init_statements)
+        # idle entries of [connection, created time, last used time, usage], most recently used at end
+        self._idle = list()
+        self._size = 0
+        self._active = 0
+        self._closed = False
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._creations = 0
+        self._failures = 0
+        self._timeouts = 0
+        self._retirements = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def connection(self):
+        """
+        Check out a connection, closing it gives it back to pool.
+        """
+        entry = self._checkout()
+        return _ConnectionProxy(entry[0], release=lambda conn: self._checkin(entry))
+
+    def warm_up(self):
+        """
+        Connect until there are `min_idle` idle connections.
+        """
+        while True:
+            with self._condition:
+                if len(self._idle) >= self._min_idle or self._size >= self._max_size or self._closed:
+                    return
+                self._size += 1
+            entry = self._create()
+            with self._condition:
+                self._idle.append(entry)
+                self._condition.notify()
+
+    def stats(self):
+        """
+        Get pool statistics.
+        :return: a dict of `size`, `active`, `idle`, `max_size`, `checkouts`, `waits`, `wait_time`, `max_wait_time`,
+                 `creations`, `failures`, `timeouts` and `retirements`
+        """
+        with self._condition:
+            return {
+                'size': self._size,
+                'active': self._active,
+                'idle': len(self._idle),
+                'max_size': self._max_size,
+                'checkouts': self._checkouts,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'creations': self._creations,
+                'failures': self._failures,
+                'timeouts': self._timeouts,
+                'retirements': self._retirements,
+            }
+
+    def close(self):
+        """
+        Close idle connections, connections in use are closed when given back.
+        """
+        with self._condition:
+            self._closed = True
+            retired = self._idle
+            self._idle = list()
+            self._size -= len(retired)
+            self._condition.notify_all()
+        ConnectionPool._close_entries(retired)
+
+    def _checkout(self):
+        begin = time_monotonic()
+        waited = False
+        retired = list()
+        try:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise Exception("Connection pool is closed")
+                    now = time_monotonic()
+                    while self._idle:
+                        entry = self._idle.pop()
+                        if self._is_expired(entry, now):
+                            retired.append(entry)
+                            self._size -= 1
+                            self._retirements += 1
+                            continue
+                        self._on_checkout(begin, waited)
+                        return entry
+                    if self._size < self._max_size:
+                        self._size += 1
+                        self._on_checkout(begin, waited)
+                        break
+                    waited = True
+                    remaining = None if self._checkout_timeout is None else self._checkout_timeout - (now - begin)
+                    if remaining is not None and remaining <= 0:
+                        self._timeouts += 1
+                        raise Exception("Timeout to check out a connection, all %d connections are in use"
+                                        % self._max_size)
+                    self._condition.wait(remaining)
+        finally:
+            ConnectionPool._close_entries(retired)
+        try:
+            return self._create()
+        except Exception:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify()
+            raise
+
+    def _on_checkout(self, begin, waited):
+        wait_time = time_monotonic() - begin
+        self._active += 1
+        self._checkouts += 1
+        if waited:
+            self._waits += 1
+        self._wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+
+    def _create(self):
+        try:
+            conn = self._connect()
+            try:
+                if self._init_statements:
+                    cursor = conn.cursor()
+                    try:
+                        for statement in self._init_statements:
+                            cursor.execute(statement)
+                    finally:
+                        cursor.close()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._failures += 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._creations += 1
+        now = time_monotonic()
+        return [conn, now, now, 0]
+
+    def _checkin(self, entry):
+        conn = entry[0]
+        entry[2] = time_monotonic()
+        entry[3] += 1
+        healthy = getattr(conn, "open", True) and not _has_unread_result(conn)
+        if healthy:
+            try:
+                if getattr(conn, "server_status", 0) & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+                    conn.rollback()
+            except Exception:
+                healthy = False
+        retire = (not healthy or self._closed or self._is_expired(entry, entry[2])
+                  or (self._max_usage is not None and entry[3] >= self._max_usage))
+        with self._condition:
+            self._active -= 1
+            if retire:
+                self._size -= 1
+                self._retirements += 1
+            else:
+                self._idle.append(entry)
+            self._condition.notify()
+        if retire:
+            ConnectionPool._close_entries((entry,))
+
+    def _is_expired(self, entry, now):
+        if self._max_lifetime is not None and now - entry[1] >= self._max_lifetime:
+            return True
+        return (self._idle_timeout is not None and now - entry[2] >= self._idle_timeout
+                and len(self._idle) >= self._min_idle)
+
+    @staticmethod
+    def _close_entries(entries):
+        for entry in entries:
+            try:
+                entry[0].close()
+            except Exception:
+                pass
+
+
+class SqlShapeCache:
+    """
+    A process-wide LRU cache of rendered SQL, keyed by query shape.
+    The shape is everything that decides the SQL text (model class, clauses, columns, join/order/limit terms),
+    but not the argument values, so queries differing only in args share one rendered statement.
+    """
+
+    def __init__(self, capacity=1024, enabled=True):
+        self._capacity = capacity
+        self._enabled = enabled
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._sync_mutex = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def enable(self, is_enabled=True):
+        """
+        Switch the cache on or off, cached statements are dropped when switched off.
+        :param is_enabled: True to use the cache, False to render every query from scratch
+        """
+        self._enabled = is_enabled
+        if not is_enabled:
+            self.clear()
+
+    def resize(self, capacity):
+        """
+        Change the max number of cached statements, evicting least recently used ones if necessary.
+        :param capacity: max statement number to be cached
+        """
+        assert capacity > 0
+        with self._sync_mutex:
+            self._capacity = capacity
+            while len(self._cache) > self._capacity:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all cached statements and reset the counters.
+        """
+        with self._sync_mutex:
+            self._cache.clear()
+            self._hits = 0
+            self._misses = 0
+
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: a dict of `hits`, `misses`, `size`, `capacity` and `enabled`
+        """
+        with self._sync_mutex:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'size': len(self._cache),
+                'capacity': self._capacity,
+                'enabled': self._enabled,
+            }
+
+    def lookup(self, shape):
+        """
+        Get rendered sql of a query shape.
+        :param shape: hashable query shape
+        :return: rendered sql string, or None if not cached
+        """
+        with self._sync_mutex:
+            sql = self._cache.get(shape)
+            if sql is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._cache.move_to_end(shape)
+            return sql
+
+    def store(self, shape, sql):
+        """
+        Put rendered sql of a query shape into cache.
+        :param shape: hashable query shape
+        :param sql: rendered sql string
+        """
+        with self._sync_mutex:
+            self._cache[shape] = sql
+            self._cache.move_to_end(shape)
+            if len(self._cache) > self._capacity:
+                self._cache.popitem(last=False)
+
+
+class ResultCache:
+    """
+    A process-wide read-through cache of select results, for queries opted in by `SelectQuery.cached`.
+    Entries are keyed by db config, rendered sql and args, evicted by LRU, TTL and a memory budget, and dropped
+    when a query through Riko in this process writes to a table they read, and again when its transaction commits.
+    Invalidation bumps the generation of the table, and a result read from DB is only stored if generations of its
+    tables have not changed since the miss, so a result read before a write never overwrites an invalidation.
+    """
+
+    def __init__(self, capacity=1024, max_bytes=64 * 1024 * 1024, default_ttl=60):
+        self._capacity = capacity
+        self._max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._cache = OrderedDict()
+        self._table_keys = dict()
+        self._generations = dict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+        self._sync_mutex = threading.Lock()
+
+    def resize(self, capacity=None, max_bytes=None):
+        """
+        Change the max number and total size of cached results, evicting least recently used ones if necessary.
+        :param capacity: max result number to be cached, None to keep current
+        :param max_bytes: max estimated bytes of cached results, None to keep current
+        """
+        with self._sync_mutex:
+            if capacity is not None:
+                assert capacity > 0
+                self._capacity = capacity
+            if max_bytes is not None:
+                assert max_bytes > 0
+                self._max_bytes = max_bytes
+            self._shrink()
+
+    def clear(self):
+        """
+        Drop all cached results and reset the counters.
+        """
+        with self._sync_mutex:
+            self._cache.clear()
+            self._table_keys.clear()
+            self._bytes = 0
+            self._hits = 0
+            self._misses = 0
+            self._evictions = 0
+            self._expirations = 0
+            self._invalidations = 0
+
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: a dict of `hits`, `misses`, `evictions`, `expirations`, `invalidations`, `size`, `bytes`,
+                 `capacity` and `max_bytes`
+        """
+        with self._sync_mutex:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+                'size': len(self._cache),
+                'bytes': self._bytes,
+                'capacity': self._capacity,
+                'max_bytes': self._max_bytes,
+            }
+
+    @staticmethod
+    def make_key(db_config, sql, args):
+        """
+        Get cache key of a query.
+        :return: a hashable key, or None if config or args are not hashable
+        """
+        try:
+            key = (tuple(sorted(db_config.items())), sql,
+                   tuple(sorted(args.items())) if args else ())
+            hash(key)
+            return key
+        except TypeError:
+            return None
+
+    def lookup(self, key):
+        """
+        Get cached result of a query.
+        :param key: key by `make_key`
+        :return: a tuple of (rows, cursor description) with rows copied, or None if not cached
+        """
+        with self._sync_mutex:
+            entry = self._cache.get(key)
+            if entry is not None and entry[0] < time_monotonic():
+                self._drop(key)
+                self._expirations += 1
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._cache.move_to_end(key)
+        return [dict(row) for row in entry[1]], entry[2]
+
+    def stamp(self, tables):
+        """
+        Get generations of tables, to be passed to `store` after reading the result from DB.
+        :param tables: names of tables read by the query
+        """
+        return tuple(self._generations.get(table, 0) for table in tables)
+
+    def store(self, key, tables, rows, description, ttl=None, stamp=None):
+        """
+        Put result of a query into cache.
+        :param key: key by `make_key`
+        :param tables: names of tables read by the query
+        :param rows: a list of dict objects, copied into cache
+        :param description: cursor description
+        :param ttl: seconds to keep the result, None to use `default_ttl`
+        :param stamp: generations by `stamp` before reading the result, None to store without the check
+        :return: True if stored, False if result is too large or a table is invalidated since `stamp`
+        """
+        size = ResultCache._estimate_size(rows)
+        if size > self._max_bytes:
+            return False
+        entry = (time_monotonic() + (self.default_ttl if ttl is None else ttl), [dict(row) for row in rows],
+                 description, tuple(tables), size)
+        with self._sync_mutex:
+            if stamp is not None and self.stamp(tables) != stamp:
+                return False
+            self._drop(key)
+            self._cache[key] = entry
+            self._bytes += size
+            for table in entry[3]:
+                self._table_keys.setdefault(table, set()).add(key)
+            self._shrink()
+        return True
+
+    def invalidate(self, table):
+        """
+        Drop cached results reading a table, and reject results read before.
+        :param table: table name
+        """
+        with self._sync_mutex:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for key in self._table_keys.pop(table, ()):
+                if self._drop(key):
+                    self._invalidations += 1
+
+    def _drop(self, key):
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[4]
+        for table in entry[3]:
+            keys = self._table_keys.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._table_keys[table]
+        return True
+
+    def _shrink(self):
+        while len(self._cache) > self._capacity or self._bytes > self._max_bytes:
+            self._drop(next(iter(self._cache)))
+            self._evictions += 1
+
+    @staticmethod
+    def _estimate_size(rows):
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row)
+            for v in row.values():
+                size += sys.getsizeof(v)
+        return size
+
+
+class SharedEntityCache:
+    """
+    A cache of model rows by primary key in a shared memory file, shared by all processes on the host.
+    The file is a hash table of buckets with a fixed number of fixed-size slots, so its size is bounded.
+    Readers do not lock but retry on a slot being written, detected by its sequence number, and writers lock the
+    bucket by a thread lock and a `fcntl` byte-range lock. Invalidation bumps the bucket generation, and a row
+    read from DB is only put if the generation has not changed since the miss, so a stale row never overwrites an
+    invalidation.
+    Writes of many rows bump the epoch of the table instead, which is a part of keys, so rows cached before are
+    never found again.
+    Rows are pickled, and rows larger than a slot are not cached. The file must be owned by the current user and
+    not writable by others, as anyone able to write it could make this process unpickle anything.
+    """
+    _MAGIC = b"RKE2"
+    # magic, bucket number, slot number of a bucket, slot size
+    _FILE_HEADER = struct.Struct("<4sIII")
+    # slots of table epochs, tables of the same slot share the epoch
+    _EPOCHS = 1024
+    _EPOCH = struct.Struct("<Q")
+    # generation
+    _BUCKET_HEADER = struct.Struct("<Q")
+    # sequence, key digest, expire time, payload length
+    _SLOT_HEADER = struct.Struct("<IQdI")
+
+    # read attempts on a slot being written before taking it as a miss
+    _READ_RETRY = 3
+
+    # `fcntl` locks are held by process, so threads take one of these first, by file and offset of the range
+    _THREAD_LOCKS = tuple(threading.Lock() for _ in range(64))
+
+    def __init__(self, path, buckets=16384, ways=4, slot_size=512, ttl=300):
+        """
+        Open or create a shared entity cache file.
+        :param path: cache file path, on a memory file system such as `/dev/shm` and same in all processes
+        :param buckets: bucket number of the hash table
+        :param ways: slot number of a bucket
+        :param slot_size: bytes of a slot, including slot header
+        :param ttl: seconds to keep a row
+        """
+        if fcntl is None:
+            raise Exception("SharedEntityCache requires fcntl, which is not available on this platform")
+        assert buckets > 0 and ways > 0 and slot_size > SharedEntityCache._SLOT_HEADER.size
+        self.ttl = ttl
+        self._buckets = buckets
+        self._ways = ways
+        self._slot_size = slot_size
+        self._bucket_size = SharedEntityCache._BUCKET_HEADER.size + ways * slot_size
+        self._buckets_offset = SharedEntityCache._FILE_HEADER.size + \
+            SharedEntityCache._EPOCHS * SharedEntityCache._EPOCH.size
+        file_size = self._buckets_offset + buckets * self._bucket_size
+        self._hits = 0
+        self._misses = 0
+        self._puts = 0
+        self._rejections = 0
+        self._mm = None
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_NOFOLLOW", 0), 0o600)
+        try:
+            file_stat = os.fstat(self._fd)
+            if file_stat.st_uid != os.geteuid() or file_stat.st_mode & 0o022:
+                raise Exception("Shared entity cache file must be owned by current user and not writable by "
+                                "others: " + path)
+            self._file_id = (file_stat.st_dev, file_stat.st_ino)
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, SharedEntityCache._FILE_HEADER.size, 0)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, file_size)
+                    os.write(self._fd, SharedEntityCache._FILE_HEADER.pack(SharedEntityCache._MAGIC, buckets, ways,
+                                                                           slot_size))
+                elif os.fstat(self._fd).st_size != file_size:
+                    raise Exception("Shared entity cache file is created in another layout: " + path)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, SharedEntityCache._FILE_HEADER.size, 0)
+            self._mm = mmap.mmap(self._fd, file_size)
+        except Exception:
+            os.close(self._fd)
+            raise
+        if SharedEntityCache._FILE_HEADER.unpack_from(self._mm, 0) != (SharedEntityCache._MAGIC, buckets, ways,
+                                                                      slot_size):
+            self.close()
+            raise Exception("Shared entity cache file is created in another layout: " + path)
+
+    def close(self):
+        """
+        Unmap and close the cache file, the file is kept for other processes.
+        """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            os.close(self._fd)
+
+    def make_key(self, db_config, table, pk_values):
+        """
+        Get cache key of a row in current epoch of its table, same in all processes.
+        Key values are compared as MySQL does with an integer column, so `3` and `"3"` are one key.
+        :param db_config: db connection config
+        :param table: table name
+        :param pk_values: tuple of primary key values
+        :return: key bytes
+        """
+        table_key = SharedEntityCache._table_key(db_config, table)
+        epoch = SharedEntityCache._EPOCH.unpack_from(self._mm, self._epoch_offset(table_key))[0]
+        return repr((table_key, tuple(_key_value(v) for v in pk_values), epoch)).encode("utf-8")
+
+    def invalidate_table(self, db_config, table):
+        """
+        Drop all cached rows of a table, and reject puts of rows read before.
+        :param db_config: db connection config
+        :param table: table name
+        """
+        epoch_offset = self._epoch_offset(SharedEntityCache._table_key(db_config, table))
+        with self._range_lock(epoch_offset, SharedEntityCache._EPOCH.size):
+            epoch = SharedEntityCache._EPOCH.unpack_from(self._mm, epoch_offset)[0]
+            SharedEntityCache._EPOCH.pack_into(self._mm, epoch_offset, epoch + 1)
+
+    @staticmethod
+    def _table_key(db_config, table):
+        return repr((db_config.get("unix_socket"), db_config.get("host"), db_config.get("port"),
+                     db_config.get("database", db_config.get("db")), table)).encode("utf-8")
+
+    def _epoch_offset(self, table_key):
+        index = int.from_bytes(hashlib.blake2b(table_key, digest_size=8).digest(), "little") % \
+            SharedEntityCache._EPOCHS
+        return SharedEntityCache._FILE_HEADER.size + index * SharedEntityCache._EPOCH.size
+
+    def stats(self):
+        """
+        Get cache statistics of this process.
+        :return: a dict of `hits`, `misses`, `puts`, `rejections` and `capacity`
+        """
+        return {
+            'hits': self._hits,
+            'misses': self._misses,
+            'puts': self._puts,
+            'rejections': self._rejections,
+            'capacity': self._buckets * self._ways,
+        }
+
+    def stamp(self, key):
+        """
+        Get generation of the bucket of a key, to be passed to `put` after reading the row from DB.
+        """
+        return SharedEntityCache._BUCKET_HEADER.unpack_from(self._mm, self._locate(key)[1])[0]
+
+    def get(self, key):
+        """
+        Get a cached row.
+        :param key: key by `make_key`
+        :return: a tuple of (columns, values), or None if not cached
+        """
+        digest, bucket_offset = self._locate(key)
+        slot_header = SharedEntityCache._SLOT_HEADER
+        for slot_offset in self._slot_offsets(bucket_offset):
+            for _ in range(SharedEntityCache._READ_RETRY):
+                (sequence, slot_digest, expire, length) = slot_header.unpack_from(self._mm, slot_offset)
+                if slot_digest != digest:
+                    break
+                payload_offset = slot_offset + slot_header.size
+                payload = self._mm[payload_offset:payload_offset + length]
+                if sequence & 1 or slot_header.unpack_from(self._mm, slot_offset)[0] != sequence:
+                    continue
+                if expire < time_now():
+                    break
+                (slot_key, columns, values) = pickle.loads(payload)
+                if slot_key != key:
+                    break
+                self._hits += 1
+                return columns, values
+        self._misses += 1
+        return None
+
+    def put(self, key, columns, values, stamp):
+        """
+        Put a row read from DB.
+        :param key: key by `make_key`
+        :param columns: tuple of column names
+        :param values: tuple of column values
+        :param stamp: generation by `stamp` before reading the row
+        :return: True if put, False if row is too large or invalidated since `stamp`
+        """
+        payload = pickle.dumps((key, tuple(columns), tuple(values)), pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self._slot_size - SharedEntityCache._SLOT_HEADER.size:
+            self._rejections += 1
+            return False
+        digest, bucket_offset = self._locate(key)
+        with self._bucket_lock(bucket_offset):
+            if SharedEntityCache._BUCKET_HEADER.unpack_from(self._mm, bucket_offset)[0] != stamp:
+                self._rejections += 1
+                return False
+            victim = None
+            victim_expire = None
+            for slot_offset in self._slot_offsets(bucket_offset):
+                (_, slot_digest, expire, _) = SharedEntityCache._SLOT_HEADER.unpack_from(self._mm, slot_offset)
+                if slot_digest == digest:
+                    victim = slot_offset
+                    break
+                if victim is None or expire < victim_expire:
+                    victim = slot_offset
+                    victim_expire = expire
+            self._write_slot(victim, digest, time_now() + self.ttl, payload)
+        self._puts += 1
+        return True
+
+    def invalidate(self, key):
+        """
+        Drop a cached row, and reject puts of rows read before.
+        :param key: key by `make_key`
+        """
+        digest, bucket_offset = self._locate(key)
+        with self._bucket_lock(bucket_offset):
+            generation = SharedEntityCache._BUCKET_HEADER.unpack_from(self._mm, bucket_offset)[0]
+            SharedEntityCache._BUCKET_HEADER.pack_into(self._mm, bucket_offset, generation + 1)
+            for slot_offset in self._slot_offsets(bucket_offset):
+                if SharedEntityCache._SLOT_HEADER.unpack_from(self._mm, slot_offset)[1] == digest:
+                    self._write_slot(slot_offset, 0, 0.0, b"")
+
+    def clear(self):
+        """
+        Drop all cached rows.
+        """
+        for bucket in range(self._buckets):
+            bucket_offset = self._buckets_offset + bucket * self._bucket_size
+            with self._bucket_lock(bucket_offset):
+                generation = SharedEntityCache._BUCKET_HEADER.unpack_from(self._mm, bucket_offset)[0]
+                SharedEntityCache._BUCKET_HEADER.pack_into(self._mm, bucket_offset, generation + 1)
+                for slot_offset in self._slot_offsets(bucket_offset):
+                    self._write_slot(slot_offset, 0, 0.0, b"")
+
+    def _locate(self, key):
+        # digest 0 marks an empty slot
+        digest = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+        return digest, self._buckets_offset + (digest % self._buckets) * self._bucket_size
+
+    def _slot_offsets(self, bucket_offset):
+        first = bucket_offset + SharedEntityCache._BUCKET_HEADER.size
+        return range(first, first + self._ways * self._slot_size, self._slot_size)
+
+    def _write_slot(self, slot_offset, digest, expire, payload):
+        slot_header = SharedEntityCache._SLOT_HEADER
+        sequence = slot_header.unpack_from(self._mm, slot_offset)[0]
+        struct.pack_into("<I", self._mm, slot_offset, (sequence + 1) & 0xFFFFFFFF)
+        payload_offset = slot_offset + slot_header.size
+        self._mm[payload_offset:payload_offset + len(payload)] = payload
+        slot_header.pack_into(self._mm, slot_offset, (sequence + 1) & 0xFFFFFFFF, digest, expire, len(payload))
+        struct.pack_into("<I", self._mm, slot_offset, (sequence + 2) & 0xFFFFFFFF)
+
+    @contextlib.contextmanager
+    def _range_lock(self, offset, size):
+        thread_lock = SharedEntityCache._THREAD_LOCKS[hash((self._file_id, offset)) %
+                                                      len(SharedEntityCache._THREAD_LOCKS)]
+        with thread_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, size, offset)
+
+    def _bucket_lock(self, bucket_offset):
+        return self._range_lock(bucket_offset, self._bucket_size)
 
 
 class Riko:
@@ -76,6 +967,87 @@ class Riko:
 
     shaded_pool = ShadedDBPool()
 
+    sql_cache = SqlShapeCache()
+
+    result_cache = ResultCache()
+
+    # Connection of sessions created with `short_connection=True`, see `CONNECTION`
+    connection_mode = CONNECTION.SHORT
+
+    # Replica topologies by primary config key, see `set_topology`
+    topologies = dict()
+
+    # When to check a connection is alive before a statement, see `PING`
+    ping_policy = PING.IDLE
+
+    # Seconds a connection can be idle before a statement without ping, for `PING.IDLE`
+    ping_idle_interval = 30
+
+    @staticmethod
+    def set_ping_policy(policy, idle_interval=None):
+        """
+        Set when to check a connection is alive before a statement.
+        Under `PING.IDLE` and `PING.NEVER`, a read query of a temporary session is performed once more on a new
+        connection if the connection is found lost.
+        :param policy: `PING.ALWAYS` to ping before each statement,
+                       `PING.IDLE` to ping only if the connection is idle longer than `idle_interval`,
+                       `PING.NEVER` to never ping
+        :param idle_interval: seconds of idle before ping for `PING.IDLE`, None to keep current
+        """
+        assert policy in (PING.ALWAYS, PING.IDLE, PING.NEVER)
+        Riko.ping_policy = policy
+        if idle_interval is not None:
+            Riko.ping_idle_interval = idle_interval
+
+    @staticmethod
+    def set_connection_mode(mode):
+        """
+        Set how sessions created with `short_connection=True` get their connection.
+        :param mode: `CONNECTION.SHORT` to connect for each session and close after it,
+                     `CONNECTION.THREAD_LOCAL` to reuse a persistent connection of each thread,
+                     `CONNECTION.POOLED` to check out a connection from `shaded_pool`
+        """
+        assert mode in (CONNECTION.SHORT, CONNECTION.THREAD_LOCAL, CONNECTION.POOLED)
+        Riko.connection_mode = mode
+
+    @staticmethod
+    def set_topology(topology):
+        """
+        Route SELECT queries on temporary sessions of a primary db config to its replicas.
+        :param topology: a `Topology` object
+        """
+        Riko.topologies[Riko.shaded_pool.config_key(topology.primary)] = topology
+
+    @staticmethod
+    def remove_topology(primary):
+        """
+        Stop routing queries of a primary db config to replicas.
+        :param primary: primary db config dict
+        """
+        Riko.topologies.pop(Riko.shaded_pool.config_key(primary), None)
+
+    @staticmethod
+    def topology_of(db_config):
+        """
+        Get the `Topology` of a primary db config, or None if it has no replicas.
+        """
+        return Riko.topologies.get(Riko.shaded_pool.config_key(db_config))
+
+    @staticmethod
+    def gather(*queries, max_workers=None, return_exceptions=False):
+        """
+        Perform independent queries concurrently, see `QueryBatch`.
+        :param queries: `SqlQuery` objects, or functions without arguments
+        :param max_workers: max queries in flight, None for `QueryBatch.default_max_workers`
+        :param return_exceptions: True to put exception of a failed query in its result place,
+                                  False to raise the exception of the first failed query
+        :return: a list of query results in order of `queries`
+        """
+        batch = QueryBatch(max_workers=max_workers)
+        for query in queries:
+            batch.add(query)
+        return batch.run(return_exceptions=return_exceptions)
+
     @staticmethod
     def set_default(db_config):
         """
@@ -93,15 +1065,71 @@ class Riko:
         :param db_config: terms for update connection config dict
         """
         Riko.db_config.update(db_config)
+        Riko.shaded_pool.forget_config(Riko.db_config)
 
 
-class AbstractModel(metaclass=ABCMeta):
-    __metaclass__ = ABCMeta
+class ModelMetadata:
+    """
+    Column metadata of a model class, compiled once when the class is defined.
+    Columns of models declaring no `fields` are discovered from an object built by `__init__` alone, and kept here
+    for the class.
+    """
+
+    def __init__(self, clazz):
+        self.pk = tuple(clazz.pk)
+        self.ak = clazz.ak
+        self.fields = None
+        self.columns = None
+        self.column_set = None
+        self.probing = False
+        declared = getattr(clazz, "fields", None)
+        self.slotted = declared is not None and getattr(clazz, "_slots_on_fields", False) and clazz.slots
+        if declared is not None:
+            self.define(clazz, declared)
+
+    def define(self, clazz, fields):
+        """
+        Set fields of the model class.
+        :param clazz: model class
+        :param fields: fields name list, without primary keys
+        """
+        self.columns = clazz._compile_columns(tuple(fields))
+        self.column_set = frozenset(self.columns)
+        self.fields = tuple(fields)
+
+
+class ModelMeta(ABCMeta):
+    """
+    Metaclass of ORM models, compiles column metadata once per model class.
+    `ObjectModel` subclasses declaring `fields` and setting `slots = True` keep their columns in `__slots__`
+    instead of a per-object dict.
+    """
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        slots = namespace.get("slots", any(getattr(b, "slots", False) for b in bases))
+        if slots and namespace.get("fields") is not None and "__slots__" not in namespace and \
+                any(getattr(b, "_slots_on_fields", False) for b in bases):
+            pk = namespace["pk"] if "pk" in namespace else getattr(bases[0], "pk", ())
+            inherited_slots = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited_slots.update(getattr(klass, "__slots__", ()))
+            namespace["__slots__"] = tuple(k for k in tuple(pk) + tuple(namespace["fields"])
+                                           if k not in inherited_slots)
+        clazz = super().__new__(mcs, name, bases, namespace, **kwargs)
+        clazz._meta = ModelMetadata(clazz)
+        return clazz
+
+
+class AbstractModel(metaclass=ModelMeta):
+    __metaclass__ = ModelMeta
 
     """
     Abstract ORM model.
     DO NOT inherit this, inherit `DictModel` or `ObjectModel` instead.
     """
+    __slots__ = ()
+
     _abstract_inner_var = {"db_config_", "dbi"}
 
     # Config
@@ -116,14 +1144,57 @@ class AbstractModel(metaclass=ABCMeta):
     # Update ignore column
     auto_update_ignore = None
 
+    # `SharedEntityCache` for primary key lookups by `get_one`
+    entity_cache = None
+
+    # `ShardMap` placing rows on databases by shard key, `_DB_CONF` must be None for a sharded model
+    shard_map = None
+
     def __init__(self, _db_config=None):
         """
         Create a Riko model object.
         :param _db_config: database to mapping
         """
-        if _db_config is None:
-            _db_config = self._DB_CONF
-        self.db_config_ = Riko.db_config if _db_config is None else _db_config
+        self._db_conf = _db_config
+        # Columns changed since loaded or saved, None if nothing changed
+        self._dirty_fields = None
+
+    def __getattr__(self, name):
+        # inner slots not assigned yet, such as assigning columns before `__init__`
+        if name in ("_db_conf", "_dirty_fields"):
+            return None
+        raise AttributeError(name)
+
+    @property
+    def db_config_(self):
+        """
+        DB config of this object, default to model `_DB_CONF` or `Riko.db_config`.
+        """
+        db_conf = self._db_conf
+        if db_conf is None:
+            if self.shard_map is not None and self._DB_CONF is None:
+                return self.shard_map.config_of(self.get_value(self.shard_map.key))
+            db_conf = Riko.db_config if self._DB_CONF is None else self._DB_CONF
+        return db_conf
+
+    @db_config_.setter
+    def db_config_(self, value):
+        self._db_conf = value
+
+    @classmethod
+    def _db_config_of(cls, _db_config, where_terms):
+        """
+        Get db config of a query on this model, the shard of shard key in `where_terms` for a sharded model.
+        """
+        if _db_config is not None:
+            return _db_config
+        if cls.shard_map is not None and cls.shard_map.key in where_terms:
+            return cls.shard_map.config_of(where_terms[cls.shard_map.key])
+        return cls._DB_CONF
+
+    @classmethod
+    def _compile_columns(cls, fields):
+        return tuple(cls.pk) + tuple(fields)
 
     @property
     def dbi(self, short_connection=True):
@@ -144,19 +1215,37 @@ class AbstractModel(metaclass=ABCMeta):
         :param terms: dict for parsing to the model object
         :return: parsed object in `cls` type
         """
-        try:
-            des_obj = cls(_db_config=db_conf)
-        except Exception as ce:
-            des_obj = cls()
-        if terms is not None:
-            for (k, v) in terms.items():
-                if _datetime_dump:
-                    if isinstance(v, dt):
-                        v = v.strftime('%Y-%m-%d %H:%M:%S')
-                    elif isinstance(v, date):
-                        v = v.strftime('%Y-%m-%d')
-                des_obj.set_value(k, v)
-        return des_obj
+        return ModelMaterializer.materialize(cls, [terms], db_conf=db_conf, _datetime_dump=_datetime_dump)[0]
+
+    def is_dirty(self):
+        """
+        Get if any column changed since this object loaded or saved.
+        """
+        return bool(self._dirty_fields)
+
+    def dirty_fields(self):
+        """
+        Get a set of columns changed since this object loaded or saved.
+        """
+        return set() if self._dirty_fields is None else set(self._dirty_fields)
+
+    def mark_clean(self, columns=None):
+        """
+        Forget changes of columns, as they are synchronized with DB.
+        :param columns: the columns to be marked clean, None to mark all columns clean
+        """
+        if columns is None or self._dirty_fields is None:
+            self._dirty_fields = None
+        else:
+            self._dirty_fields.difference_update(columns)
+            if len(self._dirty_fields) == 0:
+                self._dirty_fields = None
+
+    def _mark_dirty(self, column):
+        if self._dirty_fields is None:
+            self._dirty_fields = {column}
+        else:
+            self._dirty_fields.add(column)
 
     def columns(self):
         """
@@ -302,8 +1391,21 @@ class AbstractModel(metaclass=ABCMeta):
                         .on_duplicate_key_update(**duplicate_key_update_term)
                         .values(**insert_dict)
                         .go(return_last_id=True if auto_key is not None else False))
-        if auto_key is not None and self.get_ak() is None:
+        if isinstance(t, AsyncDBI):
+            return _then(re_affect_id, lambda r: self._after_insert(t, r, on_duplicate_key_replace))
+        if isinstance(re_affect_id, StatementHandle):
+            # auto increment key is set when the pipeline is flushed
+            return re_affect_id.then(lambda r: self._after_insert(t, r, on_duplicate_key_replace))
+        return self._after_insert(t, re_affect_id, on_duplicate_key_replace)
+
+    def _after_insert(self, t, re_affect_id, on_duplicate_key_replace):
+        if self.get_ak_name() is not None and self.get_ak() is None:
             self.set_ak(re_affect_id)
+        self.mark_clean()
+        if on_duplicate_key_replace != INSERT.DUPLICATE_KEY_EXCEPTION:
+            self._invalidate_entities(t, (self,))
+        if t is not None and t.identity_map is not None:
+            t.identity_map.add(self)
         return re_affect_id
 
     def delete(self, t=None, short_connection=True):
@@ -313,10 +1415,21 @@ class AbstractModel(metaclass=ABCMeta):
         :param short_connection: is using short connection creation, only available when `t` is None
         :return: affected row count
         """
-        return (DeleteQuery(self.__class__)
-                .set_session(model_db_conf=self.db_config_, dbi=t, short_connection=short_connection)
-                .where(**self.get_pk())
-                .go())
+        affected = (DeleteQuery(self.__class__)
+                    .set_session(model_db_conf=self.db_config_, dbi=t, short_connection=short_connection)
+                    .where(**self.get_pk())
+                    .go())
+        if isinstance(t, AsyncDBI):
+            return _then(affected, lambda r: self._after_delete(t, r))
+        if isinstance(affected, StatementHandle):
+            return affected.then(lambda r: self._after_delete(t, r))
+        return self._after_delete(t, affected)
+
+    def _after_delete(self, t, affected):
+        self._invalidate_entities(t, (self,))
+        if t is not None and t.identity_map is not None:
+            t.identity_map.discard(self)
+        return affected
 
     def update(self, ignore_columns=None, t=None, short_connection=True):
         """
@@ -330,29 +1443,155 @@ class AbstractModel(metaclass=ABCMeta):
 
     def save(self, ignore_columns=None, t=None, short_connection=True):
         """
-        Flush the change of this object to DB.
+        Flush the change of this object to DB, only columns changed since loaded or saved are written.
         :param ignore_columns: the columns to be ignore when update, such as `update_time`
         :param t transaction connection object
         :param short_connection: is using short connection creation, only available when `t` is None
-        :return: affected row count
+        :return: affected row count, 0 if nothing changed
         """
         update_field_dict = dict()
         # TODO primary key may be update but cannot handle now
         if ignore_columns is None:
-            ignore_columns = set()
+            ignore_columns = set(self.get_pk_name())
         else:
             ignore_columns = set(ignore_columns)
+            ignore_columns.update(self.get_pk_name())
         # extend default ignore columns
         if self.auto_update_ignore is not None:
             ignore_columns.update(set(self.auto_update_ignore))
+        dirty_fields = self.dirty_fields()
         for k in self.columns():
-            if k not in ignore_columns:
+            if k in dirty_fields and k not in ignore_columns:
                 update_field_dict[k] = self.get_value(k)
-        return (UpdateQuery(self.__class__)
-                .set_session(model_db_conf=self.db_config_, dbi=t, short_connection=short_connection)
-                .set(**update_field_dict)
-                .where(**self.get_pk())
-                .go())
+        if len(update_field_dict) == 0:
+            return _resolved(0) if isinstance(t, AsyncDBI) else 0
+        affected = (UpdateQuery(self.__class__)
+                    .set_session(model_db_conf=self.db_config_, dbi=t, short_connection=short_connection)
+                    .set(**update_field_dict)
+                    .where(**self.get_pk())
+                    .go())
+        if isinstance(t, AsyncDBI):
+            return _then(affected, lambda r: self._after_save(t, r, update_field_dict.keys()))
+        if isinstance(affected, StatementHandle):
+            return affected.then(lambda r: self._after_save(t, r, update_field_dict.keys()))
+        return self._after_save(t, affected, update_field_dict.keys())
+
+    def _after_save(self, t, affected, columns):
+        self.mark_clean(columns)
+        self._invalidate_entities(t, (self,))
+        return affected
+
+    @classmethod
+    def update_many(cls, models, columns=None, t=None, short_connection=True, _db_config=None, chunk_size=500):
+        """
+        Flush the change of a list of objects to DB by batched `UPDATE ... SET c = CASE ... END` statements,
+        all statements are performed on one connection in one transaction.
+        :param models: list of ORM objects of this model, identified by primary keys
+        :param columns: the columns to be updated, None to update all fields, primary keys and `auto_update_ignore`
+                        columns are never updated
+        :param t: connection context, None to use a new connection in a transaction
+        :param short_connection: is using short connection creation, only available when `t` is None
+        :param _db_config: db connection config, None to use config of the first object, or of each shard
+        :param chunk_size: max object number updated in one statement
+        :return: affected row count
+        """
+        models = list(models)
+        if len(models) == 0:
+            return 0
+        pk_names = list(cls.get_pk_name())
+        assert len(pk_names) > 0 and chunk_size > 0
+        if columns is None:
+            columns = models[0].get_fields()
+        ignore_columns = set(pk_names)
+        if cls.auto_update_ignore is not None:
+            ignore_columns.update(cls.auto_update_ignore)
+        columns = [k for k in columns if k not in ignore_columns]
+        if len(columns) == 0:
+            return 0
+        if t is not None:
+            return cls._update_chunks(t, models, pk_names, columns, chunk_size)
+        if _db_config is None and cls.shard_map is not None:
+            shard_groups = OrderedDict()
+            for model in models:
+                shard_groups.setdefault(id(model.db_config_), list()).append(model)
+            if len(shard_groups) > 1:
+                # one transaction on each shard
+                return sum(cls.update_many(group, columns=columns, short_connection=short_connection,
+                                           _db_config=group[0].db_config_, chunk_size=chunk_size)
+                           for group in shard_groups.values())
+        dbi = DBI(db_config=models[0].db_config_ if _db_config is None else _db_config,
+                  short_connection=short_connection)
+        try:
+            with dbi.start_transaction():
+                return cls._update_chunks(dbi, models, pk_names, columns, chunk_size)
+        finally:
+            dbi.close()
+
+    @staticmethod
+    def _match_pk_terms(models, pk_names, args):
+        """
+        Put primary key values of objects into `args`.
+        :return: a list of placeholder lists of primary keys of each object
+        """
+        match_terms = list()
+        for (row_idx, model) in enumerate(models):
+            pk_terms = list()
+            for (pk_idx, pk_name) in enumerate(pk_names):
+                arg_name = "__RIKO_PK_%d_%d" % (row_idx, pk_idx)
+                args[arg_name] = model.get_value(pk_name)
+                pk_terms.append("%(" + arg_name + ")s")
+            match_terms.append(pk_terms)
+        return match_terms
+
+    @staticmethod
+    def _pk_in_term(pk_names, match_terms):
+        if len(pk_names) == 1:
+            return pk_names[0] + " IN (" + ", ".join(m[0] for m in match_terms) + ")"
+        return ("(" + ", ".join(pk_names) + ") IN (" +
+                ", ".join("(" + ", ".join(m) + ")" for m in match_terms) + ")")
+
+    @classmethod
+    def _update_chunks(cls, dbi, models, pk_names, columns, chunk_size):
+        statements = list()
+        for begin in range(0, len(models), chunk_size):
+            chunk = models[begin:begin + chunk_size]
+            args = dict()
+            match_terms = cls._match_pk_terms(chunk, pk_names, args)
+            set_terms = list()
+            for (col_idx, column) in enumerate(columns):
+                case_terms = list()
+                for (row_idx, model) in enumerate(chunk):
+                    arg_name = "__RIKO_CASE_%d_%d" % (row_idx, col_idx)
+                    args[arg_name] = model.get_value(column)
+                    if len(pk_names) == 1:
+                        case_terms.append("WHEN " + match_terms[row_idx][0] + " THEN %(" + arg_name + ")s")
+                    else:
+                        case_terms.append("WHEN " + " AND ".join(pk_names[j] + " = " + match_terms[row_idx][j]
+                                                                 for j in range(len(pk_names))) +
+                                          " THEN %(" + arg_name + ")s")
+                case_head = "CASE " + pk_names[0] + " " if len(pk_names) == 1 else "CASE "
+                set_terms.append(column + " = " + case_head + " ".join(case_terms) + " ELSE " + column + " END")
+            statements.append((UpdateQuery(cls)
+                               .set_session(model_db_conf=None, dbi=dbi)
+                               .set_raw(set_terms)
+                               .where_raw(cls._pk_in_term(pk_names, match_terms)), args))
+
+        def after_update(affected):
+            for model in models:
+                model.mark_clean(columns)
+            cls._invalidate_entities(dbi, models)
+            return affected
+        if isinstance(dbi, AsyncDBI):
+            async def update_chunks():
+                affected = 0
+                for (update_query, args) in statements:
+                    affected += await update_query.go(args)
+                return after_update(affected)
+            return update_chunks()
+        chunk_affected = [update_query.go(args) for (update_query, args) in statements]
+        if isinstance(chunk_affected[0], StatementHandle):
+            return StatementHandle.combine(chunk_affected).then(after_update)
+        return after_update(sum(chunk_affected))
 
     @classmethod
     def count(cls, t=None, short_connection=True, _db_config=None, _where_raw=None, _args=None, **_where_terms):
@@ -368,6 +1607,12 @@ class AbstractModel(metaclass=ABCMeta):
         """
         cnt_ret = cls.get(t=t, short_connection=short_connection, _db_config=_db_config, return_columns=("count(1)",),
                           _where_raw=_where_raw, _args=_args, _parse_model=False, **_where_terms)
+        if isinstance(t, AsyncDBI):
+            return _then(cnt_ret, cls._count_of)
+        return cls._count_of(cnt_ret)
+
+    @staticmethod
+    def _count_of(cnt_ret):
         if len(cnt_ret) > 0:
             return cnt_ret[0]["count(1)"]
         else:
@@ -385,8 +1630,11 @@ class AbstractModel(metaclass=ABCMeta):
         :param _where_terms: where condition terms, only equal condition support only, combined with `AND`
         :return: a boolean of existence find result
         """
-        return cls.count(t=t, short_connection=short_connection, _db_config=_db_config, _where_raw=_where_raw,
-                         _args=_args, **_where_terms) > 0
+        counted = cls.count(t=t, short_connection=short_connection, _db_config=_db_config, _where_raw=_where_raw,
+                            _args=_args, **_where_terms)
+        if isinstance(t, AsyncDBI):
+            return _then(counted, lambda c: c > 0)
+        return counted > 0
 
     @classmethod
     def delete_many(cls, t=None, short_connection=True, _db_config=None, _where_raw=None, _args=None, **_where_terms):
@@ -400,13 +1648,21 @@ class AbstractModel(metaclass=ABCMeta):
         :param _where_terms: where condition terms, only equal condition support only, combined with `AND`
         :return: a boolean of existence find result
         """
-        delete_query = cls.delete_query().set_session(model_db_conf=cls._DB_CONF if _db_config is None else _db_config,
+        delete_query = cls.delete_query().set_session(model_db_conf=cls._db_config_of(_db_config, _where_terms),
                                                       dbi=t, short_connection=short_connection)
         if _where_raw:
             delete_query.where_raw(_where_raw)
         if _where_terms:
             delete_query.where(**_where_terms)
-        return delete_query.go(_args)
+        affected = delete_query.go(_args)
+
+        def after_delete(deleted):
+            if t is not None and t.identity_map is not None:
+                t.identity_map.discard_class(cls)
+            return deleted
+        if isinstance(t, AsyncDBI):
+            return _then(affected, after_delete)
+        return after_delete(affected)
 
     @classmethod
     def select(cls, t=None, short_connection=True, _db_config=None, return_columns=None):
@@ -493,10 +1749,30 @@ class AbstractModel(metaclass=ABCMeta):
                 .replace(is_replace)
                 .on_duplicate_key_update(**duplicate_key_update_term))
 
+    @classmethod
+    def bulk_load(cls, rows, columns=None, t=None, short_connection=True, _db_config=None,
+                  on_duplicate_key_replace=INSERT.DUPLICATE_KEY_EXCEPTION, charset="utf8mb4"):
+        """
+        Bulk load rows by `LOAD DATA LOCAL INFILE`, rows are streamed to server without a temporary file.
+        The connection config must enable `local_infile`. See `BatchInsertQuery.load`.
+        :param rows: iterable of value tuples or ORM objects, may be a generator
+        :param columns: tuple/list of fields of value tuples, None to use fields of the first ORM object
+        :param t: connection context, None to use default
+        :param short_connection: is using short connection creation, only available when `t` is None
+        :param _db_config: db connection config, None to use default
+        :param on_duplicate_key_replace: operation when primary key duplicated, only REPLACE and IGNORE support
+        :param charset: character set of the data, "binary" to load bytes not in UTF-8
+        :return: affected row count
+        """
+        return (cls.insert_many(t=t, short_connection=short_connection, _db_config=_db_config,
+                                on_duplicate_key_replace=on_duplicate_key_replace)
+                .load(rows=rows, columns=columns, charset=charset))
+
     @classmethod
     def get_many(cls, t=None, short_connection=True, _db_config=None, return_columns=None, _where_raw=None, _limit=None,
                  _offset=None,
-                 _order=None, _args=None, _parse_model=True, for_update=False, _datetime_dump=True, **_where_terms):
+                 _order=None, _args=None, _parse_model=True, for_update=False, _datetime_dump=True, _cached=False,
+                 _cache_ttl=None, **_where_terms):
         """
         Get objects satisfied given conditions. Alias for `get`.
         :param t: connection context, None to use default
@@ -511,17 +1787,20 @@ class AbstractModel(metaclass=ABCMeta):
         :param _parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
         :param for_update: Is select for update
         :param _datetime_dump: ensure datetime and date translated to string
+        :param _cached: True to read result through `Riko.result_cache`
+        :param _cache_ttl: seconds to keep the result in cache, None to use `Riko.result_cache.default_ttl`
         :param _where_terms: where condition terms, only equal condition support only, combined with `AND`
         :return: query result in the form of `_parse_model` pattern, default by a list of ORM models
         """
         return cls.get(t=t, short_connection=short_connection, _db_config=_db_config, return_columns=return_columns,
                        _where_raw=_where_raw, _limit=_limit, _offset=_offset, _order=_order, _args=_args,
-                       _parse_model=_parse_model, for_update=for_update, _datetime_dump=_datetime_dump, **_where_terms)
+                       _parse_model=_parse_model, for_update=for_update, _datetime_dump=_datetime_dump,
+                       _cached=_cached, _cache_ttl=_cache_ttl, **_where_terms)
 
     @classmethod
     def get(cls, t=None, short_connection=True, _db_config=None, return_columns=None, _where_raw=None,
             _limit=None, _offset=None, _order=None, _args=None, _parse_model=True, for_update=False,
-            _datetime_dump=True, **_where_terms):
+            _datetime_dump=True, _cached=False, _cache_ttl=None, **_where_terms):
         """
         Get objects satisfied given conditions.
         :param t: connection context, None to use default
@@ -536,21 +1815,53 @@ class AbstractModel(metaclass=ABCMeta):
         :param _parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
         :param for_update: Is select for update
         :param _datetime_dump: ensure datetime and date translated to string
+        :param _cached: True to read result through `Riko.result_cache`
+        :param _cache_ttl: seconds to keep the result in cache, None to use `Riko.result_cache.default_ttl`
         :param _where_terms: where condition te rms, only equal condition support only, combined with `AND`
         :return: query result in the form of `_parse_model` pattern, default by a list of ORM models
         """
         return (SelectQuery(cls, columns=return_columns, limit=_limit, offset=_offset, order_by=_order)
-                .set_session(model_db_conf=cls._DB_CONF if _db_config is None else _db_config,
+                .set_session(model_db_conf=cls._db_config_of(_db_config, _where_terms),
                              dbi=t, short_connection=short_connection)
                 .where_raw(*_where_raw if _where_raw else [])
                 .where(**_where_terms)
                 .for_update(for_update)
+                .cached(ttl=_cache_ttl, is_cached=_cached)
                 .get(args=_args, _datetime_dump=_datetime_dump, parse_model=_parse_model))
 
+    @classmethod
+    def iter(cls, t=None, short_connection=True, _db_config=None, return_columns=None, _where_raw=None,
+             _limit=None, _offset=None, _order=None, _args=None, _parse_model=True, _datetime_dump=True,
+             _batch_size=1000, **_where_terms):
+        """
+        Lazily iterate objects satisfied given conditions on a server-side cursor.
+        :param t: connection context, None to use default
+        :param short_connection: is using short connection creation, only available when `t` is None
+        :param _db_config: db connection config, None to use default
+        :param return_columns: return columns tuple, None to return all fields in mapping table
+        :param _where_raw: where condition tuple, each element give a condition and combined with `AND`
+        :param _limit: limit of query result row number
+        :param _offset: offset of query result
+        :param _order: ordering fields name tuple
+        :param _args: argument dict for SQL rendering
+        :param _parse_model: True to yield ORM model objects, False to yield dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param _batch_size: row number fetched from server per round
+        :param _where_terms: where condition terms, only equal condition support only, combined with `AND`
+        :return: a generator of query result in the form of `_parse_model` pattern
+        """
+        return (SelectQuery(cls, columns=return_columns, limit=_limit, offset=_offset, order_by=_order)
+                .set_session(model_db_conf=cls._db_config_of(_db_config, _where_terms),
+                             dbi=t, short_connection=short_connection)
+                .where_raw(*_where_raw if _where_raw else [])
+                .where(**_where_terms)
+                .stream(batch_size=_batch_size, args=_args, parse_model=_parse_model,
+                        _datetime_dump=_datetime_dump))
+
     @classmethod
     def get_one(cls, t=None, short_connection=True, _db_config=None, return_columns=None, _where_raw=None, _args=None,
                 _parse_model=True,
-                for_update=False, _datetime_dump=True, **_where_terms):
+                for_update=False, _datetime_dump=True, _cached=False, _cache_ttl=None, **_where_terms):
         """
         Get one object satisfied given conditions if exists, otherwise return `None`.
         :param t: connection context, None to use default
@@ -562,17 +1873,107 @@ class AbstractModel(metaclass=ABCMeta):
         :param _parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
         :param for_update: Is select for update
         :param _datetime_dump: ensure datetime and date translated to string
+        :param _cached: True to read result through `Riko.result_cache`
+        :param _cache_ttl: seconds to keep the result in cache, None to use `Riko.result_cache.default_ttl`
         :param _where_terms: where condition terms, only equal condition support only, combined with `AND`
         :return: a ORM model object, or None if not found
         """
-        return (SelectQuery(cls, columns=return_columns)
-                .set_session(model_db_conf=cls._DB_CONF if _db_config is None else _db_config,
-                             dbi=t, short_connection=short_connection)
-                .where_raw(*_where_raw if _where_raw else [])
-                .where(**_where_terms)
-                .limit(1)
-                .for_update(for_update)
-                .only(args=_args, _datetime_dump=_datetime_dump, parse_model=_parse_model))
+        if (t is not None and t.identity_map is not None and _parse_model and not for_update
+                and return_columns is None and not _where_raw and set(_where_terms) == set(cls.get_pk_name())):
+            loaded = t.identity_map.find(cls, _where_terms)
+            if loaded is not None:
+                return loaded
+        query = (SelectQuery(cls, columns=return_columns)
+                 .set_session(model_db_conf=cls._db_config_of(_db_config, _where_terms),
+                              dbi=t, short_connection=short_connection)
+                 .where_raw(*_where_raw if _where_raw else [])
+                 .where(**_where_terms)
+                 .limit(1)
+                 .for_update(for_update)
+                 .cached(ttl=_cache_ttl, is_cached=_cached))
+        if (cls.entity_cache is None or not _parse_model or for_update or not _datetime_dump
+                or return_columns is not None or _where_raw or _args or isinstance(t, AsyncDBI)
+                or (t is not None and t.in_transaction()) or set(_where_terms) != set(cls.get_pk_name())):
+            return query.only(args=_args, _datetime_dump=_datetime_dump, parse_model=_parse_model)
+        return query.only_entity(cls.entity_cache, tuple(_where_terms[k] for k in cls.get_pk_name()))
+
+    @classmethod
+    def _invalidate_entities(cls, t, models):
+        """
+        Drop objects from `entity_cache` after they are written, and again when transaction of `t` commits.
+        """
+        entity_cache = cls.entity_cache
+        if entity_cache is None:
+            return
+        written = [(m.db_config_ if t is None else t.get_config(), tuple(m.get_value(k) for k in cls.get_pk_name()))
+                   for m in models]
+
+        def invalidate():
+            for (db_config, pk_values) in written:
+                entity_cache.invalidate(entity_cache.make_key(db_config, cls.__name__, pk_values))
+        invalidate()
+        if t is not None and t.in_transaction():
+            t.on_commit(invalidate)
+
+
+class SqlRender:
+    """
+    Compile sql templates into segment lists once, then render each statement by a single join.
+    """
+    _PLACEHOLDER = re.compile(r"(\s*)(\{\{__RIKO_[A-Z_]+__\}\})")
+
+    _compiled = dict()
+
+    @staticmethod
+    def compile(template):
+        """
+        Compile a template into segments.
+        Each segment is a tuple of `(text, key)`, literal segments have `key` None, while placeholder segments
+        keep the whitespace before them in `text`, which is dropped together with an empty clause.
+        :param template: string template in `SqlQuery`
+        :return: a tuple of segments
+        """
+        segments = list()
+        pieces = SqlRender._PLACEHOLDER.split(template.strip())
+        for idx in range(0, len(pieces), 3):
+            if pieces[idx]:
+                segments.append((pieces[idx], None))
+            if idx + 2 < len(pieces):
+                segments.append((pieces[idx + 1], pieces[idx + 2]))
+        return tuple(segments)
+
+    @staticmethod
+    def render_compiled(segments, args):
+        """
+        Render compiled template segments, empty clauses are omitted.
+        :param segments: segments from `compile`
+        :param args: a dict for render
+        :return: rendered sql string
+        """
+        parts = list()
+        for (text, key) in segments:
+            if key is None:
+                parts.append(text)
+            else:
+                value = args.get(key)
+                if value:
+                    parts.append(text)
+                    parts.append(value)
+        return "".join(parts)
+
+    @staticmethod
+    def render(template, args):
+        """
+        Render sql template, the template is compiled at the first time it is rendered.
+        :param template: string template in `SqlQuery`
+        :param args: a dict for render
+        :return: rendered sql string
+        """
+        segments = SqlRender._compiled.get(template)
+        if segments is None:
+            segments = SqlRender.compile(template)
+            SqlRender._compiled[template] = segments
+        return SqlRender.render_compiled(segments, args)
 
 
 class SqlQuery(metaclass=ABCMeta):
@@ -621,14 +2022,26 @@ FROM {{__RIKO_TABLE__}}
 {{__RIKO_FOR_UPDATE__}}
 """
 
+    _Insert_Segments = SqlRender.compile(_Insert_Template)
+    _Delete_Segments = SqlRender.compile(_Delete_Template)
+    _Update_Segments = SqlRender.compile(_Update_Template)
+    _Select_Segments = SqlRender.compile(_Select_Template)
+
+    # Is executing this query a write to the model table
+    _writes_table = True
+
     def __init__(self, clazz):
         assert clazz is not None
         self._sql = None
         self._dbi = None
         self._clz_meta = clazz
         self._temporary_dbi = False
+        self._short_connection = True
         self._args = dict()
         self._is_batch = False
+        self._shard_map = None
+        # configs of shards the query is performed on, None if performed on one database
+        self._shards = None
 
     def __str__(self):
         return self._sql
@@ -636,15 +2049,18 @@ FROM {{__RIKO_TABLE__}}
     def set_session(self, model_db_conf, dbi, short_connection=True):
         """
         Binding db session for ORM operations.
-        :param model_db_conf: model _DB_CONF
+        :param model_db_conf: model _DB_CONF, None to use default `Riko.db_config`, or shards of a sharded model
         :param dbi: DBI object
         :param short_connection: is using short connection creation, only available when `dbi` is None
         """
+        self._shard_map = None
         if dbi is None:
             if model_db_conf is None:
+                self._shard_map = getattr(self._clz_meta, "shard_map", None)
                 model_db_conf = Riko.db_config
             self._dbi = DBI(db_config=model_db_conf, short_connection=short_connection)
             self._temporary_dbi = True
+            self._short_connection = short_connection
         else:
             self._dbi = dbi
             self._temporary_dbi = False
@@ -652,30 +2068,21 @@ FROM {{__RIKO_TABLE__}}
 
     def get(self, args=None, _datetime_dump=True, parse_model=False):
         """
-        Execute and get result of query.
+        Execute and get result of query, or an awaitable of it on an `AsyncDBI` session.
         :param args: argument dict for SQL rendering
-        :param _datetime_dump: ensure datetime and date translated to string
+        :param _datetime_dump: ensure datetime and date translated to string, `DATETIME_DUMP.LAZY` to translate
+                               values when they are read, in `LazyTemporalRow` mappings instead of dict objects
         :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
         :return: see `parse_model` parameter description
         """
-        self._prepare_sql()
+        self._prepare_sql(scatter=True)
         if args is not None:
             self._args.update(args)
+        if isinstance(self._dbi, AsyncDBI):
+            return self._get_async(parse_model, _datetime_dump)
         try:
-            raw_result = self._dbi.query(sql=self._sql, args=self._args, transactional=self._temporary_dbi)
-            if parse_model:
-                return [self._clz_meta.deserialize(db_conf=self._dbi.get_config(),
-                                                   _datetime_dump=_datetime_dump, **kvt)
-                        for kvt in raw_result]
-            else:
-                if _datetime_dump:
-                    for raw_item in raw_result:
-                        for (k, v) in raw_item.items():
-                            if isinstance(v, dt):
-                                raw_item[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-                            elif isinstance(v, date):
-                                raw_item[k] = v.strftime('%Y-%m-%d')
-                return raw_result
+            raw_result, description = self._fetch_described()
+            return self._handle_result(raw_result, description, parse_model, _datetime_dump)
         finally:
             if self._temporary_dbi:
                 self._dbi.close()
@@ -683,56 +2090,184 @@ FROM {{__RIKO_TABLE__}}
     def only(self, parse_model=False, _datetime_dump=True, args=None):
         """
         Execute and get result of query, but only one object will be returned.
+        An awaitable of the result is returned on an `AsyncDBI` session.
         :param args: argument dict for SQL rendering
-        :param _datetime_dump: ensure datetime and date translated to string
+        :param _datetime_dump: ensure datetime and date translated to string, `DATETIME_DUMP.LAZY` to translate
+                               values when they are read, in `LazyTemporalRow` mappings instead of dict objects
         :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
         :return: a ORM model object, or None if not found
         """
-        self._prepare_sql()
+        self._prepare_sql(scatter=True)
         if args is not None:
             self._args.update(args)
+        if isinstance(self._dbi, AsyncDBI):
+            return self._only_async(parse_model, _datetime_dump)
         try:
-            ret = self._dbi.query(sql=self._sql, args=self._args, transactional=self._temporary_dbi)
-            ret_raw = ret[0] if ret and len(ret) > 0 else None
-            if ret_raw is None:
+            ret, description = self._fetch_described()
+            if not ret:
                 return None
-            if parse_model is False:
-                if _datetime_dump:
-                    for (k, v) in ret_raw.items():
-                        if _datetime_dump:
-                            if isinstance(v, dt):
-                                ret_raw[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-                            elif isinstance(v, date):
-                                ret_raw[k] = v.strftime('%Y-%m-%d')
-                return ret_raw
-            else:
-                return self._clz_meta.deserialize(db_conf=self._dbi.get_config(),
-                                                  _datetime_dump=_datetime_dump, **ret_raw)
+            return self._handle_result(ret[:1], description, parse_model, _datetime_dump)[0]
         finally:
             if self._temporary_dbi:
                 self._dbi.close()
 
+    def only_entity(self, entity_cache, pk_values):
+        """
+        Get the ORM model object of a primary key through a `SharedEntityCache`, performing the query on a miss.
+        The query is performed without the cache if it is on many shards.
+        :param entity_cache: a `SharedEntityCache` object
+        :param pk_values: tuple of primary key values the query is conditioned by
+        :return: a ORM model object, or None if not found
+        """
+        self._prepare_sql(scatter=True)
+        if self._shards is not None:
+            return self.only(parse_model=True)
+        db_conf = self._dbi.get_config()
+        entity_key = entity_cache.make_key(db_conf, self._clz_meta.__name__, pk_values)
+        cached = entity_cache.get(entity_key)
+        if cached is not None:
+            if self._temporary_dbi:
+                self._dbi.close()
+            model = ModelMaterializer.materialize(self._clz_meta, [dict(zip(*cached))], db_conf=db_conf,
+                                                  _datetime_dump=False)
+            if self._dbi.identity_map is not None:
+                model = self._dbi.identity_map.merge(model, cached[0])
+            return model[0]
+        stamp = entity_cache.stamp(entity_key)
+        model = self.only(parse_model=True)
+        if model is not None:
+            columns = model.get_columns()
+            entity_cache.put(entity_key, columns, tuple(model.get_value(c) for c in columns), stamp)
+        return model
+
+    async def _get_async(self, parse_model, _datetime_dump):
+        raw_result, description = await self._fetch_described_async()
+        return self._handle_result(raw_result, description, parse_model, _datetime_dump)
+
+    async def _only_async(self, parse_model, _datetime_dump):
+        ret, description = await self._fetch_described_async()
+        if not ret:
+            return None
+        return self._handle_result(ret[:1], description, parse_model, _datetime_dump)[0]
+
+    async def _fetch_described_async(self):
+        """
+        Perform the prepared query on an `AsyncDBI` session, and get a tuple of (result rows, cursor description).
+        """
+        return await self._dbi.query(sql=self._sql, args=self._args, return_pattern=DBI.RETURN_DESCRIBED_RESULT)
+
+    def _fetch_described(self):
+        """
+        Perform the prepared query, and get a tuple of (result rows, cursor description).
+        """
+        self._prepare_tables()
+        return self._dbi.query(sql=self._sql, args=self._args, transactional=self._temporary_dbi,
+                               return_pattern=DBI.RETURN_DESCRIBED_RESULT)
+
+    def _note_written(self):
+        """
+        Drop cached results and entities of the table, and start read-your-writes window of replica topology after
+        a write.
+        """
+        if self._writes_table:
+            table = self._clz_meta.__name__
+            Riko.result_cache.invalidate(table)
+            if self._dbi.in_transaction():
+                self._dbi.on_commit(lambda: Riko.result_cache.invalidate(table))
+            if self._clz_meta.entity_cache is not None:
+                self._invalidate_entities(self._clz_meta.entity_cache)
+            if Riko.topologies:
+                topology = Riko.topology_of(self._dbi.get_config())
+                if topology is not None:
+                    topology.note_write()
+
+    def _invalidate_entities(self, entity_cache):
+        """
+        Drop entities of rows the query writes, or all entities of the table if the rows are unknown, and again
+        when transaction of the session commits.
+        """
+        table = self._clz_meta.__name__
+        db_configs = [self._dbi.get_config()] if self._shards is None else self._shards
+        written = self._written_pk_values()
+        if written is not None and len(written) == 0:
+            return
+
+        def invalidate():
+            for db_config in db_configs:
+                if written is None:
+                    entity_cache.invalidate_table(db_config, table)
+                else:
+                    for pk_values in written:
+                        entity_cache.invalidate(entity_cache.make_key(db_config, table, pk_values))
+        invalidate()
+        if self._dbi.in_transaction():
+            self._dbi.on_commit(invalidate)
+
+    def _written_pk_values(self):
+        """
+        Get primary key values of existing rows the query may change.
+        :return: a list of primary key value tuples, or None if unknown
+        """
+        return None
+
+    def _handle_result(self, rows, description, parse_model, _datetime_dump):
+        """
+        Parse result rows to models, or translate their datetime values for `DATETIME_DUMP` mode.
+        """
+        if parse_model:
+            # objects from many shards find their shard by shard key
+            db_conf = self._dbi.get_config() if self._shards is None else None
+            models = ModelMaterializer.materialize(self._clz_meta, rows, db_conf=db_conf,
+                                                   _datetime_dump=_datetime_dump, description=description)
+            if self._dbi.identity_map is not None and len(models) > 0:
+                complete = not isinstance(self, SelectQuery) or self._is_all_columns()
+                models = self._dbi.identity_map.merge(models, tuple(rows[0].keys()), complete=complete)
+            return models
+        if _datetime_dump == DATETIME_DUMP.LAZY:
+            return TemporalDumper.lazy(rows, TemporalDumper.temporal_keys(rows, description))
+        if _datetime_dump:
+            TemporalDumper.dump(rows, TemporalDumper.temporal_keys(rows, description))
+        return rows
+
     def go(self, args=None, return_last_id=False):
         """
-        Execute the query.
+        Execute the query, or get an awaitable of it on an `AsyncDBI` session.
         :param args: argument dict for SQL rendering
         :param return_last_id: True to return last insert id, False to return affected row count
         :return: see `return_last_id` parameter description
         """
-        self._prepare_sql()
+        # an UPDATE or DELETE without shard key is performed on all shards
+        self._prepare_sql(scatter=isinstance(self, ConditionQuery) and not return_last_id)
         if args is not None:
             self._args.update(args)
+        if isinstance(self._dbi, AsyncDBI):
+            return self._go_async(return_last_id)
         try:
+            if self._shards is not None:
+                return sum(self._broadcast(DBI.RETURN_AFFECTED_ROW))
             if self._is_batch is False:
+                self._prepare_tables()
                 return self._dbi.query(sql=self._sql, args=self._args, transactional=self._temporary_dbi,
                                        return_pattern=DBI.RETURN_AFFECTED_ROW
                                        if return_last_id is False else DBI.RETURN_LAST_ROW_ID)
             else:
                 return self._dbi.insert_many(sql_tpl=self._sql, args=self._args, transactional=self._temporary_dbi)
         finally:
+            self._note_written()
             if self._temporary_dbi:
                 self._dbi.close()
 
+    async def _go_async(self, return_last_id):
+        try:
+            if self._is_batch is False:
+                return await self._dbi.query(sql=self._sql, args=self._args,
+                                             return_pattern=DBI.RETURN_AFFECTED_ROW
+                                             if return_last_id is False else DBI.RETURN_LAST_ROW_ID)
+            else:
+                return await self._dbi.insert_many(sql_tpl=self._sql, args=self._args)
+        finally:
+            self._note_written()
+
     def cursor(self, args=None):
         """
         Execute the query and get result fetching cursor, it should be close by yourself.
@@ -742,8 +2277,12 @@ FROM {{__RIKO_TABLE__}}
         self._prepare_sql()
         if args is not None:
             self._args.update(args)
-        return self._dbi.query(sql=self._sql, args=self._args,
-                               transactional=self._temporary_dbi, return_pattern=DBI.RETURN_NONE)
+        try:
+            self._prepare_tables()
+            return self._dbi.query(sql=self._sql, args=self._args,
+                                   transactional=self._temporary_dbi, return_pattern=DBI.RETURN_NONE)
+        finally:
+            self._note_written()
 
     @contextlib.contextmanager
     def with_cursor(self, args=None):
@@ -756,21 +2295,93 @@ FROM {{__RIKO_TABLE__}}
         if args is not None:
             self._args.update(args)
         try:
+            self._prepare_tables()
             ptr = self._dbi.query(sql=self._sql, args=self._args,
                                   transactional=self._temporary_dbi, return_pattern=DBI.RETURN_NONE)
             yield ptr
         finally:
+            self._note_written()
             if ptr:
                 ptr.close()
             if self._temporary_dbi:
                 self._dbi.close()
 
+    def _prepare_tables(self):
+        """
+        Create temporary tables the prepared SQL reads, right before it is performed.
+        """
+        pass
+
+    def _prepare_sql(self, scatter=False):
+        """
+        Render the SQL of query, and bind a query of a sharded model to its shard.
+        :param scatter: True if the query can be performed on all shards when it has no shard key
+        """
+        cache = Riko.sql_cache
+        shape = self._sql_shape() if cache.enabled else None
+        if shape is not None:
+            try:
+                hash(shape)
+            except TypeError:
+                shape = None
+        sql = cache.lookup(shape) if shape is not None else None
+        if sql is None:
+            sql = self._render_sql()
+            if shape is not None:
+                cache.store(shape, sql)
+        self._sql = sql
+        if self._shard_map is not None:
+            self._route_shards(scatter)
+
+    def _route_shards(self, scatter):
+        shards = self._shard_map.configs_of(self._args, getattr(self, "_where_in", None))
+        if len(shards) == 1:
+            shard_map = self._shard_map
+            self.set_session(shards[0], None, short_connection=self._short_connection)
+            self._shard_map = shard_map
+            self._shards = None
+        elif scatter:
+            self._shards = shards
+        else:
+            raise Exception("Query of sharded model " + self._clz_meta.__name__ + " needs shard key `" +
+                            self._shard_map.key + "` or a db config")
+
+    def _shard_session(self, db_config):
+        """
+        Create a session on a shard for a query performed on many shards.
+        """
+        return DBI(db_config, short_connection=False)
+
+    def _broadcast(self, return_pattern):
+        """
+        Perform the query on every shard concurrently.
+        :return: a list of results of shards
+        """
+        def perform_on(db_config):
+            dbi = self._shard_session(db_config)
+            try:
+                return dbi.query(sql=self._sql, args=self._args, return_pattern=return_pattern)
+            finally:
+                dbi.close()
+
+        batch = QueryBatch(max_workers=len(self._shards))
+        for db_config in self._shards:
+            batch.add(lambda db_config=db_config: perform_on(db_config))
+        return batch.run()
+
+    def _sql_shape(self):
+        return self.__class__, self._clz_meta
+
     @abstractmethod
-    def _prepare_sql(self):
+    def _render_sql(self):
         pass
 
 
 class ConditionQuery(SqlQuery):
+    # candidate values of `where_in` and `where_not_in` are loaded into a temporary table when there are more
+    # than this number of them, None to always bind them as a list
+    in_table_threshold = 5000
+
     def __init__(self, clazz, where=None):
         super().__init__(clazz)
         if where is not None:
@@ -782,6 +2393,8 @@ class ConditionQuery(SqlQuery):
             self._where = list()
         self._where_in = dict()
         self._where_not_in = dict()
+        # terms of candidate values in temporary tables, as a dict of (term name, is NOT IN) to table name
+        self._in_tables = dict()
 
     def where_raw(self, *condition_terms):
         """
@@ -811,11 +2424,12 @@ class ConditionQuery(SqlQuery):
             if term_name not in self._where_in:
                 self._where_in[term_name] = list()
             self._where_in[term_name].extend(candidate_values)
+            self._args["__RIKO_IN_" + term_name] = tuple(self._where_in[term_name])
         return self
 
     def where_not_in(self, term_name, candidate_values):
         """
-        Set WHERE `term_name IN candidate_values` condition by given pattern, combined with `AND`.
+        Set WHERE `term_name NOT IN candidate_values` condition by given pattern, combined with `AND`.
         :param term_name: field name
         :param candidate_values: candidate value in list
         """
@@ -823,37 +2437,75 @@ class ConditionQuery(SqlQuery):
             if term_name not in self._where_not_in:
                 self._where_not_in[term_name] = list()
             self._where_not_in[term_name].extend(candidate_values)
+            self._args["__RIKO_NOT_IN_" + term_name] = tuple(self._where_not_in[term_name])
         return self
 
     def _construct_where_clause(self):
-        in_term = ""
-        if len(self._where_in) > 0:
-            in_term_list = list()
-            for (in_key, in_val) in self._where_in.items():
-                current_term_list = list()
-                for val_item in in_val:
-                    current_term_list.append("'%s'" % val_item)
-                in_term_list.append(in_key + " IN (" + ",".join(current_term_list) + ")")
-            in_term += " AND ".join(in_term_list)
-        not_term = ""
-        if len(self._where_not_in) > 0:
-            not_term_list = list()
-            for (not_key, not_val) in self._where_not_in.items():
-                current_term_list = list()
-                for val_item in not_val:
-                    current_term_list.append("'%s'" % val_item)
-                not_term_list.append(not_key + " NOT IN (" + ",".join(current_term_list) + ")")
-            not_term += " AND ".join(not_term_list)
-        if in_term != "":
-            self._where.append(in_term)
-        if not_term != "":
-            self._where.append(not_term)
-        if len(self._where) == 0:
+        where_terms = list(self._where)
+        for (terms, operator, arg_prefix) in ((self._where_in, " IN ", "__RIKO_IN_"),
+                                              (self._where_not_in, " NOT IN ", "__RIKO_NOT_IN_")):
+            for term_name in terms:
+                table = self._in_tables.get((term_name, operator == " NOT IN "))
+                if table is None:
+                    # pymysql renders a tuple argument as a parenthesized list
+                    where_terms.append(term_name + operator + "%(" + arg_prefix + term_name + ")s")
+                else:
+                    where_terms.append(term_name + operator + "(SELECT v FROM " + table + ")")
+        if len(where_terms) == 0:
             return ""
-        return "WHERE " + " AND ".join(self._where)
+        return "WHERE " + " AND ".join(where_terms)
+
+    def _sql_shape(self):
+        return super()._sql_shape() + (tuple(self._where), tuple(self._where_in), tuple(self._where_not_in),
+                                       tuple(self._in_tables.items()))
+
+    def _written_pk_values(self):
+        pk_names = self._clz_meta.get_pk_name()
+        if len(pk_names) == 0:
+            return None
+        if all("__RIKO_WHERE_" + k in self._args for k in pk_names):
+            return [tuple(self._args["__RIKO_WHERE_" + k] for k in pk_names)]
+        if len(pk_names) == 1 and pk_names[0] in self._where_in:
+            return [(v,) for v in self._where_in[pk_names[0]]]
+        return None
+
+    def _prepare_sql(self, scatter=False):
+        self._in_tables = dict()
+        threshold = ConditionQuery.in_table_threshold
+        if threshold is not None and isinstance(self._dbi, DBI) and self._shard_map is None:
+            for (terms, is_not) in ((self._where_in, False), (self._where_not_in, True)):
+                for (term_name, values) in terms.items():
+                    if len(values) > threshold:
+                        self._in_tables[(term_name, is_not)] = "__riko_in_" + str(len(self._in_tables))
+        for (terms, is_not, arg_prefix) in ((self._where_in, False, "__RIKO_IN_"),
+                                            (self._where_not_in, True, "__RIKO_NOT_IN_")):
+            for (term_name, values) in terms.items():
+                if (term_name, is_not) in self._in_tables:
+                    # values in a temporary table are not escaped into each statement
+                    self._args.pop(arg_prefix + term_name, None)
+                elif arg_prefix + term_name not in self._args:
+                    self._args[arg_prefix + term_name] = tuple(values)
+        super()._prepare_sql(scatter)
+
+    def _prepare_tables(self):
+        try:
+            for ((term_name, is_not), table) in self._in_tables.items():
+                values = (self._where_not_in if is_not else self._where_in)[term_name]
+                self._dbi.load_temporary_table(table, "SELECT " + term_name + " AS v FROM " + self._source_table() +
+                                               " LIMIT 0", [(v,) for v in values], transactional=self._temporary_dbi)
+        except Exception as ex:
+            if self._temporary_dbi:
+                self._dbi.close()
+            raise ex
+
+    def _source_table(self):
+        """
+        Get the table clause candidate value tables copy column type from.
+        """
+        return self._clz_meta.__name__
 
     @abstractmethod
-    def _prepare_sql(self):
+    def _render_sql(self):
         pass
 
 
@@ -885,16 +2537,24 @@ class OrderedQuery(ConditionQuery):
             return ""
         return "ORDER BY " + ", ".join(self._order_by)
 
+    def _sql_shape(self):
+        return super()._sql_shape() + (tuple(self._order_by),)
+
     @abstractmethod
-    def _prepare_sql(self):
+    def _render_sql(self):
         pass
 
 
 class PaginationOrderQuery(OrderedQuery):
+    # ordering term of keyset pagination, a column optionally qualified by table
+    _KEYSET_COLUMN = re.compile(r"(`?\w+`?\.)?`?\w+`?")
+
     def __init__(self, clazz, where=None, limit=None, offset=None, order_by=None):
         super().__init__(clazz, where, order_by)
         self._limit = limit
         self._offset = offset
+        self._keyset = False
+        self._seek_row = None
 
     def pagination(self, page, per_page):
         """
@@ -922,18 +2582,187 @@ class PaginationOrderQuery(OrderedQuery):
         self._offset = offset
         return self
 
+    def keyset(self, is_keyset=True):
+        """
+        Set keyset (seek) pagination mode. Rows are ordered by `order_by` columns plus primary keys as tie-breaker,
+        and pages are located by the key of the last row instead of OFFSET, so a page costs the same at any depth.
+        Ordering columns must not be NULL in the row a page starts after.
+        :param is_keyset: is keyset pagination mode, default True
+        """
+        self._keyset = is_keyset
+        return self
+
+    def seek(self, **last_key):
+        """
+        Fetch rows after the given key in keyset pagination mode.
+        :param last_key: key-value pair of ordering columns and primary keys of the last row fetched, like `aid=3`
+        """
+        self._keyset = True
+        self._seek_row = last_key
+        return self
+
+    def after(self, last_row):
+        """
+        Fetch rows after the given row in keyset pagination mode.
+        :param last_row: the last ORM model object or dict object fetched, None to fetch the first page
+        """
+        self._keyset = True
+        self._seek_row = last_row
+        return self
+
+    def continue_from(self, token):
+        """
+        Fetch rows after the position of a continuation token in keyset pagination mode.
+        :param token: token from `continuation_token` or `keyset_page`, None to fetch the first page
+        """
+        self._keyset = True
+        if token is None:
+            self._seek_row = None
+            return self
+        key_columns = self._keyset_columns()
+        try:
+            decoded = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf8"))
+            names, descending, values = decoded["c"], decoded["d"], decoded["v"]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # tokens come from clients, a malformed one is rejected as one of another ordering
+            names, descending, values = None, None, None
+        if names != [name for (_, name, _) in key_columns] or descending != [desc for (_, _, desc) in key_columns] \
+                or not isinstance(values, list) or len(values) != len(names):
+            raise Exception("Miss match continuation token for query ordering: " + str(token))
+        self._seek_row = dict(zip(names, values))
+        return self
+
+    def continuation_token(self, last_row):
+        """
+        Get an opaque token marking the position after a row in keyset pagination mode.
+        :param last_row: the last ORM model object or dict object fetched
+        :return: a url-safe token string
+        """
+        key_columns = self._keyset_columns()
+        names = [name for (_, name, _) in key_columns]
+        values = [PaginationOrderQuery._row_value(last_row, name) for name in names]
+        dumped = json.dumps({"c": names, "d": [desc for (_, _, desc) in key_columns], "v": values},
+                            default=str, separators=(",", ":"))
+        return base64.urlsafe_b64encode(dumped.encode("utf8")).decode("ascii")
+
+    def keyset_page(self, per_page, token=None, args=None, parse_model=False, _datetime_dump=True):
+        """
+        Fetch a page in keyset pagination mode.
+        :param per_page: record number per page
+        :param token: continuation token from previous page, None to fetch the first page
+        :param args: argument dict for SQL rendering
+        :param parse_model: True to parse result to a list of ORM model objects, False to get list of dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a tuple of (rows of this page, token for next page or None if no more pages)
+        """
+        self._limit = per_page
+        rows = self.continue_from(token).get(args=args, _datetime_dump=_datetime_dump, parse_model=parse_model)
+        next_token = self.continuation_token(rows[-1]) if len(rows) == per_page else None
+        return rows, next_token
+
+    @staticmethod
+    def _row_value(row, name):
+        if isinstance(row, AbstractModel):
+            return row.get_value(name)
+        if name not in row:
+            raise Exception("Miss match keyset column in row: " + name)
+        return row[name]
+
+    def _order_columns(self):
+        """
+        Get ORDER BY terms as a list of `(expression, column name, is descending)`.
+        """
+        order_columns = list()
+        for term in self._order_by:
+            parts = term.split()
+            descending = len(parts) > 1 and parts[-1].upper() == "DESC"
+            expression = parts[0] if len(parts) > 1 and parts[-1].upper() in ("ASC", "DESC") else term
+            order_columns.append((expression, expression.split(".")[-1], descending))
+        return order_columns
+
+    def _keyset_columns(self):
+        """
+        Get keyset columns as a list of `(expression, column name, is descending)`.
+        """
+        key_columns = self._order_columns()
+        for (expression, _, _) in key_columns:
+            if PaginationOrderQuery._KEYSET_COLUMN.fullmatch(expression) is None:
+                raise Exception("Keyset ordering term must be a column, not an expression: " + expression)
+        key_columns = [(expression, name.strip("`"), descending) for (expression, name, descending) in key_columns]
+        tie_descending = key_columns[-1][2] if len(key_columns) > 0 else False
+        ordered_names = {name for (_, name, _) in key_columns}
+        # primary keys are qualified, joined tables may have columns of the same names
+        table = getattr(self, "_alias", None) or self._clz_meta.__name__
+        for pk_name in self._clz_meta.get_pk_name():
+            if pk_name not in ordered_names:
+                key_columns.append((str(table) + "." + pk_name, pk_name, tie_descending))
+        return key_columns
+
+    def _construct_seek_term(self):
+        key_columns = self._keyset_columns()
+        placeholders = ["%(__RIKO_SEEK_" + str(idx) + ")s" for idx in range(len(key_columns))]
+        directions = {descending for (_, _, descending) in key_columns}
+        if len(directions) == 1:
+            operator = " < " if key_columns[0][2] else " > "
+            if len(key_columns) == 1:
+                return key_columns[0][0] + operator + placeholders[0]
+            return ("(" + ", ".join(expression for (expression, _, _) in key_columns) + ")" + operator +
+                    "(" + ", ".join(placeholders) + ")")
+        # mixed directions cannot be compared as a row constructor, expand it to OR terms
+        or_terms = list()
+        for idx in range(len(key_columns)):
+            and_terms = [key_columns[j][0] + " = " + placeholders[j] for j in range(idx)]
+            and_terms.append(key_columns[idx][0] + (" < " if key_columns[idx][2] else " > ") + placeholders[idx])
+            or_terms.append("(" + " AND ".join(and_terms) + ")")
+        return "(" + " OR ".join(or_terms) + ")"
+
+    def _construct_where_clause(self):
+        where_clause = super()._construct_where_clause()
+        if not self._keyset or self._seek_row is None:
+            return where_clause
+        if not where_clause:
+            return "WHERE " + self._construct_seek_term()
+        # raw terms may have OR at top level
+        return "WHERE (" + where_clause[len("WHERE "):] + ") AND " + self._construct_seek_term()
+
+    def _construct_order_by_clause(self):
+        if not self._keyset:
+            return super()._construct_order_by_clause()
+        return "ORDER BY " + ", ".join(expression + (" DESC" if descending else "")
+                                       for (expression, _, descending) in self._keyset_columns())
+
     def _construct_limit_clause(self):
         if self._limit is None:
             return ""
-        return "LIMIT " + str(self._limit)
+        return "LIMIT %(__RIKO_LIMIT)s"
 
     def _construct_offset_clause(self):
-        if self._offset is None:
+        if self._offset is None or self._keyset:
             return ""
-        return "OFFSET " + str(self._offset)
+        return "OFFSET %(__RIKO_OFFSET)s"
+
+    def _prepare_sql(self, scatter=False):
+        if self._keyset and self._seek_row is not None:
+            for (idx, (_, name, _)) in enumerate(self._keyset_columns()):
+                value = PaginationOrderQuery._row_value(self._seek_row, name)
+                if value is None:
+                    # NULL is not comparable, rows after it cannot be located
+                    raise Exception("Keyset column value is NULL: " + name)
+                self._args["__RIKO_SEEK_" + str(idx)] = value
+        # bound rather than rendered, so every page shares one cached SQL
+        for (name, value) in (("__RIKO_LIMIT", self._limit), ("__RIKO_OFFSET", self._offset)):
+            if value is None:
+                self._args.pop(name, None)
+            else:
+                self._args[name] = int(value)
+        super()._prepare_sql(scatter)
+
+    def _sql_shape(self):
+        return super()._sql_shape() + (self._limit is not None, self._offset is not None, self._keyset,
+                                       self._seek_row is not None)
 
     @abstractmethod
-    def _prepare_sql(self):
+    def _render_sql(self):
         pass
 
 
@@ -944,6 +2773,7 @@ class InsertQuery(SqlQuery):
         self._on_duplicate_key_replace = False
         self._insert_fields = list()
         self._duplicate_update = list()
+        self._duplicate_args = dict()
 
     def on_duplicate_key_update_raw(self, *update_terms):
         """
@@ -961,6 +2791,7 @@ class InsertQuery(SqlQuery):
         for (k, v) in update_terms.items():
             self._duplicate_update.append(k + " = %(__RIKO_UPSERT_" + k + ")s")
             self._args["__RIKO_UPSERT_" + k] = v
+            self._duplicate_args["__RIKO_UPSERT_" + k] = v
         return self
 
     def ignore(self, is_ignore=True):
@@ -998,7 +2829,18 @@ class InsertQuery(SqlQuery):
             return ""
         return "ON DUPLICATE KEY UPDATE " + ", ".join(self._duplicate_update)
 
-    def _prepare_sql(self):
+    def _sql_shape(self):
+        return super()._sql_shape() + (self._on_duplicate_key_ignore, self._on_duplicate_key_replace,
+                                       tuple(self._insert_fields), tuple(self._duplicate_update))
+
+    def _written_pk_values(self):
+        # an insert without replace or update of duplicate key changes no existing row, while the row changed by
+        # them may be found by any unique key
+        if self._on_duplicate_key_replace or (not self._on_duplicate_key_ignore and len(self._duplicate_update) > 0):
+            return None
+        return []
+
+    def _render_sql(self):
         pass
 
 
@@ -1038,8 +2880,10 @@ class SingleInsertQuery(InsertQuery):
         assert len(self._insert_values) > 0
         return ", ".join(self._insert_values)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Insert_Template
+    def _sql_shape(self):
+        return super()._sql_shape() + (tuple(self._insert_values),)
+
+    def _render_sql(self):
         r_dict = {
             SqlQuery._KW_INSERT_REPLACE: self._construct_insert_operator_clause(),
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
@@ -1047,10 +2891,15 @@ class SingleInsertQuery(InsertQuery):
             SqlQuery._KW_VALUES: self._construct_insert_values_clause(),
             SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: self._construct_on_duplicate_key_update_clause()
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render_compiled(SqlQuery._Insert_Segments, r_dict)
 
 
 class BatchInsertQuery(InsertQuery):
+    # escaping of field text in TSV data for LOAD DATA
+    _TSV_ESCAPE = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", "\0": "\\0"})
+    _TSV_BYTES_ESCAPE = {b"\\": b"\\\\", b"\t": b"\\t", b"\n": b"\\n", b"\r": b"\\r", b"\0": b"\\0"}
+    _TSV_BYTES_SPECIAL = re.compile(rb"[\\\t\n\r\0]")
+
     def __init__(self, clazz):
         super().__init__(clazz)
         self._insert_value_tuples = list()
@@ -1099,8 +2948,135 @@ class BatchInsertQuery(InsertQuery):
             placeholder.append("%s")
         return ", ".join(placeholder)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Insert_Template
+    def go(self, args=None, return_last_id=False):
+        """
+        Execute the query as multi-row statements in chunks fitting in server `max_allowed_packet`, or get an
+        awaitable of it on an `AsyncDBI` session.
+        :param args: argument dict for rendering ON DUPLICATE KEY UPDATE terms
+        :param return_last_id: not supported, affected row count is returned
+        :return: affected row count
+        """
+        if isinstance(self._dbi, AsyncDBI):
+            return super().go(args, return_last_id)
+        if args is not None:
+            self._duplicate_args.update(args)
+        return sum(self.go_chunked())
+
+    def go_chunked(self, max_rows=1000, max_bytes=None, commit_per_chunk=False):
+        """
+        Execute the query as multi-row `INSERT ... VALUES (...), (...)` statements in chunks.
+        A chunk is closed when it reaches `max_rows` rows or its encoded statement reaches `max_bytes`.
+        :param max_rows: max row number of one statement
+        :param max_bytes: max encoded byte size of one statement, None to fit in server `max_allowed_packet`
+        :param commit_per_chunk: True to commit after each chunk, False to insert all chunks in one transaction,
+                                 not allowed in a `start_transaction` scope
+        :return: a list of affected row count of each chunk
+        """
+        if self._shard_map is not None:
+            self._route_shards(scatter=False)
+        statement_head = (self._construct_insert_operator_clause() + " INTO " + self._clz_meta.__name__ +
+                          "(" + self._construct_insert_fields_clause() + ") VALUES ")
+        row_template = "(" + self._construct_insert_values_clause() + ")"
+        try:
+            return self._dbi.insert_chunked(statement_head=statement_head, row_template=row_template,
+                                            rows=self._insert_value_tuples,
+                                            statement_tail=self._construct_on_duplicate_key_update_clause(),
+                                            tail_args=self._duplicate_args, max_rows=max_rows, max_bytes=max_bytes,
+                                            transactional=self._temporary_dbi, commit_per_chunk=commit_per_chunk)
+        finally:
+            self._note_written()
+            if self._temporary_dbi:
+                self._dbi.close()
+
+    def load(self, rows=None, columns=None, charset="utf8mb4"):
+        """
+        Execute the query by `LOAD DATA LOCAL INFILE`, rows are streamed to server as escaped TSV data
+        without a temporary file. The connection config must enable `local_infile`.
+        Duplicated key policy follows `ignore` and `replace`, ON DUPLICATE KEY UPDATE is not supported.
+        Strings are sent in UTF-8 and bytes as they are. If `rows` raises, rows loaded are rolled back, unless the
+        query is on a session in autocommit mode, where the rows before the error are kept.
+        :param rows: iterable of value tuples or ORM objects, may be a generator, None to use rows set by
+                     `values` or `from_objects`
+        :param columns: tuple/list of fields of value tuples, None to use fields set by `values` or `from_objects`,
+                        or fields of the first ORM object
+        :param charset: character set of the data, "binary" to load bytes not in UTF-8 into BLOB and VARBINARY
+                        columns with strings to utf8mb4 columns only
+        :return: affected row count
+        """
+        if len(self._duplicate_update) > 0 and not (self._on_duplicate_key_ignore or self._on_duplicate_key_replace):
+            raise Exception("ON DUPLICATE KEY UPDATE is not supported by LOAD DATA")
+        assert re.fullmatch(r"\w+", charset)
+        rows = iter(self._insert_value_tuples if rows is None else rows)
+        if columns is None and len(self._insert_fields) > 0:
+            columns = self._insert_fields
+        if columns is None:
+            sampled = next(rows, None)
+            if sampled is None:
+                return 0
+            assert isinstance(sampled, self._clz_meta)
+            columns = sampled.get_fields()
+            rows = itertools.chain((sampled,), rows)
+        if self._on_duplicate_key_replace:
+            duplicate_policy = "REPLACE "
+        elif self._on_duplicate_key_ignore:
+            duplicate_policy = "IGNORE "
+        else:
+            duplicate_policy = ""
+        sql_tpl = ("LOAD DATA LOCAL INFILE %s " + duplicate_policy +
+                   "INTO TABLE " + self._clz_meta.__name__ + " CHARACTER SET " + charset + " " +
+                   "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' " +
+                   "(" + ", ".join(columns) + ")")
+        try:
+            return self._dbi.load_infile(sql_tpl=sql_tpl, data_blocks=BatchInsertQuery._tsv_blocks(rows, columns),
+                                         transactional=self._temporary_dbi)
+        finally:
+            self._note_written()
+            if self._temporary_dbi:
+                self._dbi.close()
+
+    @staticmethod
+    def _tsv_field(value):
+        """
+        Encode a value into an escaped TSV field, strings in UTF-8 and bytes as they are.
+        """
+        if value is None:
+            return b"\\N"
+        if value is True or value is False:
+            return b"1" if value else b"0"
+        if isinstance(value, (bytes, bytearray)):
+            return BatchInsertQuery._TSV_BYTES_SPECIAL.sub(lambda m: BatchInsertQuery._TSV_BYTES_ESCAPE[m.group()],
+                                                           bytes(value))
+        if isinstance(value, dt):
+            value = value.isoformat(" ")
+        elif isinstance(value, date):
+            value = value.isoformat()
+        return str(value).translate(BatchInsertQuery._TSV_ESCAPE).encode("utf8")
+
+    @staticmethod
+    def _tsv_blocks(rows, columns, block_size=65536):
+        """
+        Encode rows into blocks of TSV data for `LOAD DATA`.
+        """
+        lines = list()
+        buffered = 0
+        for row in rows:
+            if isinstance(row, AbstractModel):
+                row = [row.get_value(k) for k in columns]
+            line = b"\t".join([BatchInsertQuery._tsv_field(v) for v in row]) + b"\n"
+            lines.append(line)
+            buffered += len(line)
+            if buffered >= block_size:
+                yield b"".join(lines)
+                lines = list()
+                buffered = 0
+        if len(lines) > 0:
+            yield b"".join(lines)
+
+    def _prepare_sql(self, scatter=False):
+        super()._prepare_sql(scatter)
+        self._args = self._insert_value_tuples
+
+    def _render_sql(self):
         r_dict = {
             SqlQuery._KW_INSERT_REPLACE: self._construct_insert_operator_clause(),
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
@@ -1108,21 +3084,19 @@ class BatchInsertQuery(InsertQuery):
             SqlQuery._KW_VALUES: self._construct_insert_values_clause(),
             SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: self._construct_on_duplicate_key_update_clause()
         }
-        self._args = self._insert_value_tuples
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render_compiled(SqlQuery._Insert_Segments, r_dict)
 
 
 class DeleteQuery(ConditionQuery):
     def __init__(self, clazz, where=None):
         super().__init__(clazz, where)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Delete_Template
+    def _render_sql(self):
         r_dict = {
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
             SqlQuery._KW_WHERE: self._construct_where_clause()
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render_compiled(SqlQuery._Delete_Segments, r_dict)
 
 
 class UpdateQuery(ConditionQuery):
@@ -1152,19 +3126,25 @@ class UpdateQuery(ConditionQuery):
         assert len(self._update_set) > 0
         return ", ".join(self._update_set)
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Update_Template
+    def _sql_shape(self):
+        return super()._sql_shape() + (tuple(self._update_set),)
+
+    def _render_sql(self):
         r_dict = {
             SqlQuery._KW_TABLE: self._clz_meta.__name__,
             SqlQuery._KW_WHERE: self._construct_where_clause(),
             SqlQuery._KW_FIELDS: self._construct_update_set_clause()
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
+        return SqlRender.render_compiled(SqlQuery._Update_Segments, r_dict)
 
 
 class SelectQuery(PaginationOrderQuery):
+    _writes_table = False
+
     def __init__(self, clazz, columns=None, where=None, limit=None, offset=None, order_by=None):
         super().__init__(clazz, where, limit, offset, order_by)
+        self._cache_ttl = None
+        self._cache_enabled = False
         self._return_columns = list() if columns is None else list(columns)
         self._distinct = False
         self._for_update = False
@@ -1183,12 +3163,206 @@ class SelectQuery(PaginationOrderQuery):
         self._alias = alias
         return self
 
+    def set_session(self, model_db_conf, dbi, short_connection=True):
+        """
+        Binding db session for ORM operations, see `SqlQuery.set_session`.
+        A temporary session of a primary db config with `Topology` reads from replicas.
+        """
+        super().set_session(model_db_conf, dbi, short_connection=short_connection)
+        if self._temporary_dbi and Riko.topologies:
+            topology = Riko.topology_of(self._dbi.get_config())
+            if topology is not None:
+                self._dbi = ReplicaDBI(topology)
+                self._dbi.pin_primary(self._for_update)
+        return self
+
+    def _shard_session(self, db_config):
+        topology = Riko.topology_of(db_config) if Riko.topologies else None
+        if topology is None:
+            return super()._shard_session(db_config)
+        dbi = ReplicaDBI(topology)
+        dbi.pin_primary(self._for_update)
+        return dbi
+
+    # aggregate functions of return columns combined across shards
+    _AGGREGATE_PATTERN = re.compile(r"^\s*(count|sum|min|max|avg)\s*\(\s*(distinct\b)?", re.IGNORECASE)
+
+    _ALIAS_PATTERN = re.compile(r"\s+as\s+`?(\w+)`?\s*$", re.IGNORECASE)
+
+    def _aggregate_columns(self):
+        """
+        Get aggregate return columns as a list of `(result column name, function name)`.
+        """
+        aggregates = list()
+        for column in self._return_columns:
+            matched = SelectQuery._AGGREGATE_PATTERN.match(column)
+            if matched is None:
+                continue
+            if matched.group(1).lower() == "avg" or matched.group(2) is not None:
+                raise Exception("Cannot combine aggregate across shards, select SUM and COUNT instead: " + column)
+            alias = SelectQuery._ALIAS_PATTERN.search(column)
+            aggregates.append((alias.group(1) if alias else column.strip(), matched.group(1).lower()))
+        if len(aggregates) > 0 and len(self._having) > 0:
+            raise Exception("Cannot combine aggregate with HAVING across shards")
+        return aggregates
+
+    def _prepare_scatter(self, aggregates):
+        """
+        Render the SQL performed on each shard: a shard returns all groups of an aggregate query, or the first
+        `offset + limit` rows of a limited query.
+        :return: a tuple of (offset, limit) applied to the merged result
+        """
+        offset = 0 if self._keyset or self._offset is None else self._offset
+        limit = self._limit
+        if (limit is not None and offset > 0) or (limit is not None and len(aggregates) > 0):
+            saved = (self._offset, self._limit)
+            self._offset, self._limit = None, None if len(aggregates) > 0 else offset + limit
+            try:
+                self._prepare_sql(scatter=True)
+            finally:
+                self._offset, self._limit = saved
+        return offset, limit
+
+    def _merge_key(self):
+        """
+        Get the function of a row giving its merge order, None if the query is not ordered.
+        """
+        order_columns = self._keyset_columns() if self._keyset else self._order_columns()
+        if len(order_columns) == 0:
+            return None
+        names = [name for (_, name, _) in order_columns]
+        descending = [desc for (_, _, desc) in order_columns]
+
+        def key_of(row):
+            try:
+                return _MergeKey([row[name] for name in names], descending)
+            except KeyError as ex:
+                raise Exception("ORDER BY column must be selected to merge results of shards: " + str(ex))
+        return key_of
+
+    def _scatter_fetch(self):
+        """
+        Perform the query on all shards concurrently, and merge the results.
+        :return: a tuple of (rows, cursor description)
+        """
+        aggregates = self._aggregate_columns()
+        offset, limit = self._prepare_scatter(aggregates)
+        results = self._broadcast(DBI.RETURN_DESCRIBED_RESULT)
+        description = results[0][1]
+        key_of = self._merge_key()
+        if len(aggregates) > 0:
+            rows = SelectQuery._combine_aggregates([rows for (rows, _) in results], aggregates)
+            if key_of is not None:
+                rows.sort(key=key_of)
+            merged = iter(rows)
+        elif key_of is not None:
+            merged = heapq.merge(*[rows for (rows, _) in results], key=key_of)
+        else:
+            merged = itertools.chain.from_iterable(rows for (rows, _) in results)
+        if len(aggregates) == 0:
+            merged = self._unique_rows(merged)
+        return list(itertools.islice(merged, offset, None if limit is None else offset + limit)), description
+
+    def _scatter_stream(self, batch_size, parse_model, _datetime_dump):
+        """
+        Iterate the query result of all shards on server-side cursors, merged by order of the query.
+        """
+        aggregates = self._aggregate_columns()
+        if len(aggregates) > 0:
+            raise Exception("Cannot stream aggregate query across shards, use `get` instead")
+        offset, limit = self._prepare_scatter(aggregates)
+        streams = list()
+        try:
+            for db_config in self._shards:
+                streams.append(self._shard_session(db_config).stream(sql=self._sql, args=self._args,
+                                                                     batch_size=batch_size, release=True))
+            key_of = self._merge_key()
+            if key_of is not None:
+                merged = heapq.merge(*streams, key=key_of)
+            else:
+                merged = itertools.chain.from_iterable(streams)
+            merged = itertools.islice(self._unique_rows(merged), offset, None if limit is None else offset + limit)
+            description = streams[0].description
+            while True:
+                batch = list(itertools.islice(merged, batch_size))
+                if not batch:
+                    break
+                for item in self._handle_result(batch, description, parse_model, _datetime_dump):
+                    yield item
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def _unique_rows(self, rows):
+        """
+        Drop rows repeated by shards of a DISTINCT or GROUP BY query, the first of them is kept.
+        """
+        if len(self._group_by) > 0:
+            names = [term.split()[0].split(".")[-1] for term in self._group_by]
+        elif self._distinct:
+            names = None
+        else:
+            return rows
+
+        def unique():
+            seen = set()
+            for row in rows:
+                try:
+                    key = tuple(row.values()) if names is None else tuple(row[name] for name in names)
+                except KeyError as ex:
+                    raise Exception("GROUP BY column must be selected to merge results of shards: " + str(ex))
+                if key not in seen:
+                    seen.add(key)
+                    yield row
+        return unique()
+
+    @staticmethod
+    def _combine_aggregates(results, aggregates):
+        """
+        Combine aggregate rows of shards by group, COUNT and SUM are added, MIN and MAX are compared.
+        """
+        functions = dict(aggregates)
+        combined = OrderedDict()
+        for rows in results:
+            for row in rows:
+                group = tuple(v for (k, v) in row.items() if k not in functions)
+                merged = combined.get(group)
+                if merged is None:
+                    combined[group] = dict(row)
+                    continue
+                for (name, function) in aggregates:
+                    value = row[name]
+                    if value is None:
+                        continue
+                    if merged[name] is None:
+                        merged[name] = value
+                    elif function in ("count", "sum"):
+                        merged[name] += value
+                    elif function == "min":
+                        merged[name] = min(merged[name], value)
+                    else:
+                        merged[name] = max(merged[name], value)
+        return list(combined.values())
+
     def for_update(self, is_for_update=True):
         """
-        Set SELECT FOR UPDATE for query.
+        Set SELECT FOR UPDATE for query, which is always performed on primary.
         :param is_for_update: is select for update mode, default True
         """
         self._for_update = is_for_update
+        if isinstance(self._dbi, ReplicaDBI):
+            self._dbi.pin_primary(is_for_update)
+        return self
+
+    def cached(self, ttl=None, is_cached=True):
+        """
+        Read result of `get` and `only` through `Riko.result_cache`.
+        Results are not cached for SELECT FOR UPDATE, or for a session in transaction.
+        :param ttl: seconds to keep the result, None to use `Riko.result_cache.default_ttl`
+        :param is_cached: True to read through the cache, False to always query DB
+        """
+        self._cache_enabled = is_cached
+        self._cache_ttl = ttl
         return self
 
     def distinct(self, is_distinct=True):
@@ -1288,6 +3462,80 @@ class SelectQuery(PaginationOrderQuery):
             self._args["__RIKO_HAVING_" + k] = v
         return self
 
+    def stream(self, batch_size=1000, args=None, parse_model=True, _datetime_dump=True):
+        """
+        Execute and lazily iterate the query result on an unbuffered server-side cursor.
+        Rows are fetched `batch_size` at a time, so memory stays flat however many rows are selected.
+        The connection is released when the iterator is exhausted, closed or garbage collected, and it
+        cannot run other queries before that.
+        :param batch_size: row number fetched from server per round
+        :param args: argument dict for SQL rendering
+        :param parse_model: True to yield ORM model objects, False to yield dict objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :return: a generator of query result rows, or an async generator on an `AsyncDBI` session
+        """
+        self._prepare_sql(scatter=True)
+        if args is not None:
+            self._args.update(args)
+        if isinstance(self._dbi, AsyncDBI):
+            return self._stream_async(batch_size, parse_model, _datetime_dump)
+        return self._stream_sync(batch_size, parse_model, _datetime_dump)
+
+    def _stream_sync(self, batch_size, parse_model, _datetime_dump):
+        if self._shards is not None:
+            yield from self._scatter_stream(batch_size, parse_model, _datetime_dump)
+            return
+        self._prepare_tables()
+        result = self._dbi.stream(sql=self._sql, args=self._args, batch_size=batch_size,
+                                  release=self._temporary_dbi)
+        with contextlib.closing(result):
+            for batch in result.batches():
+                for item in self._handle_result(batch, result.description, parse_model, _datetime_dump):
+                    yield item
+
+    async def _stream_async(self, batch_size, parse_model, _datetime_dump):
+        async with self._dbi.stream(sql=self._sql, args=self._args, batch_size=batch_size) as result:
+            async for batch in result.batches():
+                for item in self._handle_result(batch, result.description, parse_model, _datetime_dump):
+                    yield item
+
+    def columns_result(self, args=None):
+        """
+        Execute and get result of query in columns, without building a dict for each row.
+        Numeric and temporal columns are NumPy arrays if NumPy is installed, other columns are lists.
+        :param args: argument dict for SQL rendering
+        :return: a `ColumnarResult` object
+        """
+        self._prepare_sql()
+        if args is not None:
+            self._args.update(args)
+        try:
+            self._prepare_tables()
+            rows, description = self._dbi.query(sql=self._sql, args=self._args, transactional=self._temporary_dbi,
+                                                return_pattern=DBI.RETURN_DESCRIBED_RESULT,
+                                                cursor_class=pymysql.cursors.Cursor)
+            return ColumnarResult(description, rows)
+        finally:
+            if self._temporary_dbi:
+                self._dbi.close()
+
+    def columns_stream(self, chunk_size=100000, args=None):
+        """
+        Execute and lazily iterate the query result in column chunks on an unbuffered server-side cursor.
+        :param chunk_size: row number of each chunk
+        :param args: argument dict for SQL rendering
+        :return: a generator of `ColumnarResult` objects
+        """
+        self._prepare_sql()
+        if args is not None:
+            self._args.update(args)
+        self._prepare_tables()
+        result = self._dbi.stream(sql=self._sql, args=self._args, batch_size=chunk_size,
+                                  cursor_class=pymysql.cursors.SSCursor, release=self._temporary_dbi)
+        with contextlib.closing(result):
+            for batch in result.batches():
+                yield ColumnarResult(result.description, batch)
+
     def __handle_join(self, join_type, join_clazz, alias=None, on=None, **on_terms):
         actual_join_term = join_clazz.__name__ + (" AS " + alias if alias is not None else "")
         self._join.append(actual_join_term)
@@ -1303,6 +3551,58 @@ class SelectQuery(PaginationOrderQuery):
         self._join_type[actual_join_term] = join_type
         return self
 
+    def _fetch_described(self):
+        if self._shards is not None:
+            return self._scatter_fetch()
+        cache_key = self._result_cache_key()
+        if cache_key is None:
+            return super()._fetch_described()
+        cache = Riko.result_cache
+        cached = cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+        tables = self._read_tables()
+        stamp = cache.stamp(tables)
+        rows, description = super()._fetch_described()
+        cache.store(cache_key, tables, rows, description, ttl=self._cache_ttl, stamp=stamp)
+        return rows, description
+
+    async def _fetch_described_async(self):
+        cache_key = self._result_cache_key()
+        if cache_key is None:
+            return await super()._fetch_described_async()
+        cache = Riko.result_cache
+        cached = cache.lookup(cache_key)
+        if cached is not None:
+            return cached
+        tables = self._read_tables()
+        stamp = cache.stamp(tables)
+        rows, description = await super()._fetch_described_async()
+        cache.store(cache_key, tables, rows, description, ttl=self._cache_ttl, stamp=stamp)
+        return rows, description
+
+    def _result_cache_key(self):
+        """
+        Get the `Riko.result_cache` key of the query, or None if the query is not read through the cache.
+        """
+        if not self._cache_enabled or self._for_update or self._dbi.in_transaction():
+            return None
+        args = self._args
+        if self._in_tables:
+            # candidate values loaded into a temporary table are keyed by their digest
+            args = dict(args)
+            for ((term_name, is_not), table) in self._in_tables.items():
+                values = (self._where_not_in if is_not else self._where_in)[term_name]
+                args[table] = hashlib.blake2b(repr(values).encode("utf-8"), digest_size=16).digest()
+        return ResultCache.make_key(self._dbi.get_config(), self._sql, args)
+
+    def _read_tables(self):
+        return [self._clz_meta.__name__] + [j.split(" ", 1)[0] for j in self._join]
+
+    def _source_table(self):
+        join_clause = self._construct_join_clause()
+        return self._construct_alias_table_clause() + (" " + join_clause if join_clause else "")
+
     def _construct_alias_table_clause(self):
         return self._clz_meta.__name__ if self._alias is None else (self._clz_meta.__name__ + " AS " + str(self._alias))
 
@@ -1312,6 +3612,9 @@ class SelectQuery(PaginationOrderQuery):
     def _construct_for_update_clause(self):
         return "FOR UPDATE" if self._for_update else ""
 
+    def _is_all_columns(self):
+        return len(self._return_columns) == 0 or any(c.endswith("*") for c in self._return_columns)
+
     def _construct_select_fields_clause(self):
         if len(self._return_columns) == 0:
             return "*"
@@ -1338,10 +3641,15 @@ class SelectQuery(PaginationOrderQuery):
                 join_clause += " LEFT JOIN " + join_term + " ON " + " AND ".join(self._join_on[join_term])
             elif self._join_type[join_term] == "RIGHT":
                 join_clause += " RIGHT JOIN " + join_term + " ON " + " AND ".join(self._join_on[join_term])
-        return join_clause
+        return join_clause.lstrip()
+
+    def _sql_shape(self):
+        return super()._sql_shape() + (self._alias, self._distinct, self._for_update,
+                                       tuple(self._return_columns), tuple(self._group_by), tuple(self._having),
+                                       tuple((j, self._join_type[j], tuple(self._join_on.get(j, ())))
+                                             for j in self._join))
 
-    def _prepare_sql(self):
-        self._sql = SqlQuery._Select_Template
+    def _render_sql(self):
         r_dict = {
             SqlQuery._KW_DISTINCT: self._construct_distinct_clause(),
             SqlQuery._KW_FIELDS: self._construct_select_fields_clause(),
@@ -1355,22 +3663,7 @@ class SelectQuery(PaginationOrderQuery):
             SqlQuery._KW_OFFSET: self._construct_offset_clause(),
             SqlQuery._KW_FORUPDATE: self._construct_for_update_clause(),
         }
-        self._sql = SqlRender.render(self._sql, r_dict)
-
-
-class SqlRender:
-    @staticmethod
-    def render(template, args):
-        """
-        Render sql naively by replace.
-        :param template: string template in `SqlQuery`
-        :param args: a dict for render
-        :return: rendered sql string
-        """
-        _render = template
-        for (k, v) in args.items():
-            _render = _render.replace(k, v)
-        return _render
+        return SqlRender.render_compiled(SqlQuery._Select_Segments, r_dict)
 
 
 class DictModel(AbstractModel, dict):
@@ -1378,6 +3671,8 @@ class DictModel(AbstractModel, dict):
     Basic object model in dict structure, inherit this and set `pk` and `fields`.
     """
 
+    __slots__ = ("_db_conf", "_dirty_fields")
+
     # Fields list
     fields = ()
 
@@ -1389,6 +3684,44 @@ class DictModel(AbstractModel, dict):
         dict.__init__(self)
         AbstractModel.__init__(self, _db_config)
 
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._mark_dirty(key)
+
+    # methods changing items mark them dirty as `__setitem__` does, a removed column is written as NULL by `save`
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._mark_dirty(key)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._mark_dirty(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        (key, value) = dict.popitem(self)
+        self._mark_dirty(key)
+        return key, value
+
+    def clear(self):
+        for key in self:
+            self._mark_dirty(key)
+        dict.clear(self)
+
     def get_ak(self):
         if self.ak in self:
             return self[self.ak]
@@ -1399,17 +3732,16 @@ class DictModel(AbstractModel, dict):
         self[self.ak] = value
 
     def get_fields(self):
-        return self.fields
+        return self._meta.fields
 
     def get_columns(self):
-        return tuple(self.pk) + tuple(self.fields)
+        return self._meta.columns
 
     def get_value(self, column):
-        return self[column] if column in self else None
+        return dict.get(self, column)
 
     def set_value(self, column, value):
-        cols = self.get_columns()
-        if column in cols:
+        if column in self._meta.column_set:
             self[column] = value
         else:
             raise Exception("Miss match column in Model: " + column)
@@ -1417,65 +3749,1112 @@ class DictModel(AbstractModel, dict):
 
 class ObjectModel(AbstractModel):
     """
-    Basic object model in object mapping structure, inherit this and set `pk` and `fields`.
+    Basic object model in object mapping structure, inherit this and set `pk`, then define fields as
+    attributes in `__init__`, or declare `fields`.
+    Set `slots = True` along with `fields` to store columns compactly in `__slots__`, such objects take no other
+    attributes.
     """
+    __slots__ = ("_db_conf", "_dirty_fields")
+
+    # Subclasses declaring `fields` may opt in to columns in `__slots__`
+    _slots_on_fields = True
+    slots = False
 
     def __init__(self, _db_config=None):
         super().__init__(_db_config)
-        self._model_fields = None
-        self._model_columns = None
+        if self._meta.fields is not None:
+            for column in self._meta.columns:
+                object.__setattr__(self, column, None)
+
+    def __setattr__(self, key, value):
+        object.__setattr__(self, key, value)
+        if key[0] != "_" and key not in self._abstract_inner_var:
+            self._mark_dirty(key)
+
+    @classmethod
+    def _compile_columns(cls, fields):
+        return tuple(fields) + tuple(cls.pk)
 
     def get_ak(self):
         return getattr(self, self.ak)
 
     def set_ak(self, value):
-        if hasattr(self, self.ak):
+        if self.ak in self._column_set():
             setattr(self, self.ak, value)
         else:
             raise Exception("Miss match auto increment column in Model: " + self.ak)
 
     def get_fields(self):
-        if self._model_fields is None:
-            self._model_fields = list(vars(self).keys())
-            for _ik in self._abstract_inner_var:
-                self._model_fields.remove(_ik)
-            self._model_fields.remove("_model_fields")
-            self._model_fields.remove("_model_columns")
-            for pkt in self.pk:
-                self._model_fields.remove(pkt)
-        return self._model_fields
+        meta = self._meta
+        if meta.fields is not None:
+            return meta.fields
+        pk_names = set(meta.pk)
+        if meta.probing:
+            # called by `__init__` of the object being probed
+            return tuple(k for k in vars(self).keys() if k not in self._abstract_inner_var and k not in pk_names)
+        # columns are attributes set by `__init__` alone, not helpers assigned to an object later
+        meta.probing = True
+        try:
+            try:
+                clean = self.__class__(_db_config=None)
+            except TypeError:
+                clean = self.__class__()
+        finally:
+            meta.probing = False
+        meta.define(self.__class__, [k for k in vars(clean).keys()
+                                     if k not in self._abstract_inner_var and k not in pk_names])
+        return meta.fields
 
     def get_columns(self):
-        return tuple(self.get_fields()) + tuple(self.pk)
+        if self._meta.columns is None:
+            self.get_fields()
+        return self._meta.columns
 
     def get_value(self, column):
-        if hasattr(self, column):
-            return getattr(self, column)
-        else:
-            return None
+        return getattr(self, column, None)
 
     def set_value(self, column, value):
-        if hasattr(self, column):
+        if column in self._column_set():
             setattr(self, column, value)
         else:
             raise Exception("Miss match column in Model: " + column)
 
+    def _column_set(self):
+        if self._meta.column_set is None:
+            self.get_fields()
+        return self._meta.column_set
 
-class DBI:
+
+class ModelMaterializer:
     """
-    DB connection session.
+    Build model objects from raw result rows in a tight loop.
+    A materializer is compiled once per model class and result column list: result columns are validated and
+    the model constructor is probed once, then each row costs a dict update or slot assignments, without
+    calling `__init__`, `set_value` or handling exceptions.
+    Classes defining their own `__init__` are built by calling it for each row, as it may compute defaults.
     """
-    RETURN_NONE = 0
-    RETURN_CURSOR = 1
-    RETURN_RESULT = 2
-    RETURN_LAST_ROW_ID = 3
-    RETURN_AFFECTED_ROW = 4
+    _IMMUTABLE_TYPES = (type(None), bool, int, float, complex, str, bytes, Decimal, date, dt, time, timedelta)
+
+    # max number of compiled materializers, cleared when exceeded
+    _CAPACITY = 1024
+
+    _compiled = dict()
 
     @staticmethod
-    def get_connection(db_config=None, short_connection=True):
+    def materialize(clazz, rows, db_conf=None, _datetime_dump=True, description=None):
         """
-        Get a DBI object by connecting with DB using config.
-        :param db_config: DB connection config, None to use default `Riko.db_config`
+        Build model objects from rows of one result set.
+        :param clazz: model class
+        :param rows: list of dict objects, all with the same keys in the same order
+        :param db_conf: db connection config of the objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param description: cursor description of rows, None to check type of every value for datetime dump
+        :return: a list of model objects
+        """
+        if len(rows) == 0:
+            return list()
+        return ModelMaterializer.of(clazz, tuple(rows[0].keys())).build(
+            rows, db_conf, _datetime_dump, TemporalDumper.temporal_keys(rows, description))
+
+    @staticmethod
+    def of(clazz, columns):
+        """
+        Get compiled materializer of a model class and result column list.
+        :param clazz: model class
+        :param columns: result column names tuple
+        """
+        compile_key = (clazz, columns)
+        materializer = ModelMaterializer._compiled.get(compile_key)
+        if materializer is None:
+            materializer = ModelMaterializer(clazz, columns)
+            if len(ModelMaterializer._compiled) >= ModelMaterializer._CAPACITY:
+                ModelMaterializer._compiled.clear()
+            ModelMaterializer._compiled[compile_key] = materializer
+        return materializer
+
+    def __init__(self, clazz, columns):
+        self._clazz = clazz
+        self._columns = columns
+        try:
+            prototype = clazz(_db_config=None)
+            self._accept_db_config = True
+        except TypeError:
+            prototype = clazz()
+            self._accept_db_config = False
+        column_set = set(prototype.get_columns())
+        for column in columns:
+            if column not in column_set:
+                raise Exception("Miss match column in Model: " + column)
+        # state of a fresh object, copied to each object if `__init__` is not overridden and left nothing mutable
+        self._dict_defaults = dict(vars(prototype)) if hasattr(prototype, "__dict__") else dict()
+        self._item_defaults = dict(prototype) if isinstance(prototype, dict) else None
+        self._slot_defaults = list()
+        db_conf_slot = getattr(clazz, "_db_conf", None)
+        if hasattr(db_conf_slot, "__set__"):
+            self._set_db_conf = db_conf_slot.__set__
+        else:
+            self._set_db_conf = lambda obj, value: object.__setattr__(obj, "_db_conf", value)
+        if clazz._meta.slotted:
+            self._slot_defaults = [(getattr(clazz, k), getattr(prototype, k, None))
+                                   for k in clazz._meta.columns if k not in columns]
+            self._slot_setters = [getattr(clazz, k).__set__ for k in columns]
+        defaults = list(self._dict_defaults.values()) + [v for (_, v) in self._slot_defaults]
+        if self._item_defaults:
+            defaults.extend(self._item_defaults.values())
+        self._copy_prototype = clazz.__init__ in (AbstractModel.__init__, DictModel.__init__, ObjectModel.__init__) \
+            and all(isinstance(v, ModelMaterializer._IMMUTABLE_TYPES) for v in defaults)
+
+    def build(self, rows, db_conf=None, _datetime_dump=True, temporal_keys=None):
+        """
+        Build model objects from rows.
+        :param rows: list of dict objects with keys in the compiled column list
+        :param db_conf: db connection config of the objects
+        :param _datetime_dump: ensure datetime and date translated to string
+        :param temporal_keys: keys of temporal columns, None to check type of every value for datetime dump
+        :return: a list of model objects
+        """
+        if _datetime_dump:
+            TemporalDumper.dump(rows, temporal_keys)
+        if not self._copy_prototype:
+            return [self._build_by_constructor(row, db_conf) for row in rows]
+        clazz = self._clazz
+        new = clazz.__new__
+        set_db_conf = self._set_db_conf
+        dict_defaults = self._dict_defaults
+        built = list()
+        if self._item_defaults is not None:
+            item_defaults = self._item_defaults
+            for row in rows:
+                obj = new(clazz)
+                if item_defaults:
+                    dict.update(obj, item_defaults)
+                dict.update(obj, row)
+                if dict_defaults:
+                    obj.__dict__.update(dict_defaults)
+                set_db_conf(obj, db_conf)
+                built.append(obj)
+        elif self._clazz._meta.slotted:
+            slot_setters = self._slot_setters
+            slot_defaults = self._slot_defaults
+            for row in rows:
+                obj = new(clazz)
+                for (setter, value) in zip(slot_setters, row.values()):
+                    setter(obj, value)
+                for (slot, value) in slot_defaults:
+                    slot.__set__(obj, value)
+                if dict_defaults:
+                    obj.__dict__.update(dict_defaults)
+                set_db_conf(obj, db_conf)
+                built.append(obj)
+        else:
+            for row in rows:
+                obj = new(clazz)
+                obj_dict = obj.__dict__
+                obj_dict.update(dict_defaults)
+                obj_dict.update(row)
+                set_db_conf(obj, db_conf)
+                built.append(obj)
+        return built
+
+    def _build_by_constructor(self, row, db_conf):
+        if self._accept_db_config:
+            obj = self._clazz(_db_config=db_conf)
+        else:
+            obj = self._clazz()
+            obj.db_config_ = db_conf
+        for (k, v) in row.items():
+            obj.set_value(k, v)
+        obj.mark_clean()
+        return obj
+
+
+class TemporalDumper:
+    """
+    Translate datetime and date values in result rows to string.
+    Temporal columns are found once per result set from cursor description, so other columns are never checked.
+    """
+    _TEMPORAL_TYPES = frozenset((FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP, FIELD_TYPE.DATE, FIELD_TYPE.NEWDATE))
+
+    # max number of cached date strings, dates repeat a lot in result sets
+    _DATE_CACHE_CAPACITY = 4096
+
+    _date_strings = dict()
+
+    @staticmethod
+    def temporal_keys(rows, description):
+        """
+        Get row keys of temporal columns.
+        :param rows: list of dict objects from a cursor
+        :param description: cursor description of rows
+        :return: a tuple of keys, or None if description is not available
+        """
+        if description is None or len(rows) == 0:
+            return None
+        # keys follow description order, and are renamed as `table.column` on conflict
+        keys = tuple(rows[0].keys())
+        if len(keys) != len(description):
+            return None
+        return tuple(k for (k, d) in zip(keys, description) if d[1] in TemporalDumper._TEMPORAL_TYPES)
+
+    @staticmethod
+    def dump_value(value):
+        """
+        Translate a datetime or date value to string, other values are returned as is.
+        """
+        if isinstance(value, dt):
+            return value.isoformat(' ', 'seconds')
+        if isinstance(value, date):
+            dumped = TemporalDumper._date_strings.get(value)
+            if dumped is None:
+                dumped = value.isoformat()
+                if len(TemporalDumper._date_strings) < TemporalDumper._DATE_CACHE_CAPACITY:
+                    TemporalDumper._date_strings[value] = dumped
+            return dumped
+        return value
+
+    @staticmethod
+    def dump(rows, temporal_keys=None):
+        """
+        Translate datetime and date values of rows in place.
+        :param rows: list of dict objects
+        :param temporal_keys: keys of temporal columns, None to check every value
+        """
+        dump_value = TemporalDumper.dump_value
+        if temporal_keys is None:
+            for row in rows:
+                for (k, v) in row.items():
+                    if isinstance(v, date):
+                        row[k] = dump_value(v)
+            return
+        if len(temporal_keys) == 0:
+            return
+        for row in rows:
+            for k in temporal_keys:
+                v = row[k]
+                if v is not None:
+                    row[k] = dump_value(v)
+
+    @staticmethod
+    def lazy(rows, temporal_keys=None):
+        """
+        Wrap rows to translate datetime and date values when they are read.
+        :param rows: list of dict objects
+        :param temporal_keys: keys of temporal columns, None to check every value when it is read
+        :return: a list of `LazyTemporalRow` objects, or the rows as is if there is no temporal column
+        """
+        if temporal_keys is not None and len(temporal_keys) == 0:
+            return rows
+        temporal_keys = None if temporal_keys is None else frozenset(temporal_keys)
+        return [LazyTemporalRow(row, temporal_keys) for row in rows]
+
+
+class LazyTemporalRow(MutableMapping):
+    """
+    Result row translating datetime and date values to string when they are read.
+    It is a mapping but not a dict, so `dict(row)` and `{**row}` read values through it, while `json.dumps` needs
+    the dict from `dump`.
+    """
+    __slots__ = ("_row", "_temporal_keys")
+
+    def __init__(self, row, temporal_keys=None):
+        self._row = dict(row)
+        self._temporal_keys = temporal_keys
+
+    def __getitem__(self, key):
+        value = self._row[key]
+        if self._temporal_keys is None or key in self._temporal_keys:
+            dumped = TemporalDumper.dump_value(value)
+            if dumped is not value:
+                self._row[key] = dumped
+            return dumped
+        return value
+
+    def __setitem__(self, key, value):
+        self._row[key] = value
+
+    def __delitem__(self, key):
+        del self._row[key]
+
+    def __contains__(self, key):
+        return key in self._row
+
+    def __iter__(self):
+        return iter(self._row)
+
+    def __len__(self):
+        return len(self._row)
+
+    def __repr__(self):
+        return repr(self.dump())
+
+    def get(self, key, default=None):
+        return self[key] if key in self._row else default
+
+    def copy(self):
+        return self.dump()
+
+    def dump(self):
+        """
+        Translate all datetime and date values now.
+        :return: the row as a dict object
+        """
+        keys = tuple(self._row) if self._temporal_keys is None else self._temporal_keys
+        for k in keys:
+            if k in self._row:
+                self[k]
+        return dict(self._row)
+
+
+def _key_value(value):
+    """
+    Get a key value compared as MySQL compares it with an integer column, so `3`, `"3"` and `3.0` are one key.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (float, Decimal)):
+        try:
+            integral = int(value)
+        except (ValueError, OverflowError):
+            return value
+        return integral if integral == value else value
+    if isinstance(value, str) and _CANONICAL_INTEGER.fullmatch(value):
+        return int(value)
+    return value
+
+
+_CANONICAL_INTEGER = re.compile(r"-?(0|[1-9][0-9]*)")
+
+
+class IdentityMap:
+    """
+    Model objects loaded in a session, keyed by model class and primary key, so each row maps to one object.
+    """
+
+    def __init__(self):
+        self._objects = dict()
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, obj):
+        key = IdentityMap.key_of(obj)
+        return key is not None and self._objects.get(key) is obj
+
+    @staticmethod
+    def key_of(obj):
+        """
+        Get identity key of a model object.
+        :return: a tuple of model class and primary key values, or None if any primary key is not set
+        """
+        pk_values = tuple(_key_value(obj.get_value(k)) for k in obj.get_pk_name())
+        if len(pk_values) == 0 or None in pk_values:
+            return None
+        return obj.__class__, pk_values
+
+    def find(self, clazz, pk_terms):
+        """
+        Find a loaded object.
+        :param clazz: model class
+        :param pk_terms: dict of primary key values
+        :return: the loaded object, or None if not loaded
+        """
+        loaded = self._objects.get((clazz, tuple(_key_value(pk_terms.get(k)) for k in clazz.get_pk_name())))
+        if loaded is not None:
+            self.hits += 1
+        return loaded
+
+    def add(self, obj):
+        """
+        Put an object into map, replacing the object of the same identity if exists.
+        """
+        key = IdentityMap.key_of(obj)
+        if key is not None:
+            self._objects[key] = obj
+
+    def discard(self, obj):
+        """
+        Remove an object from map if exists.
+        """
+        key = IdentityMap.key_of(obj)
+        if key is not None and self._objects.get(key) is obj:
+            del self._objects[key]
+
+    def discard_class(self, clazz):
+        """
+        Remove all objects of a model class from map.
+        """
+        for key in [k for k in self._objects if k[0] is clazz]:
+            del self._objects[key]
+
+    def clear(self):
+        """
+        Remove all objects from map.
+        """
+        self._objects.clear()
+
+    def objects(self):
+        """
+        Get a list of all objects in map.
+        """
+        return list(self._objects.values())
+
+    def merge(self, models, columns, complete=True):
+        """
+        Merge freshly loaded objects into map.
+        For an object already loaded, the fresh values of `columns` are written to it except columns with unsaved
+        changes, and it takes the place of the fresh one in the result.
+        :param models: a list of freshly loaded model objects
+        :param columns: columns loaded in the fresh objects
+        :param complete: False if the objects are loaded with part of columns, they are not put into map then
+        :return: a list of model objects in map
+        """
+        merged = list()
+        for model in models:
+            key = IdentityMap.key_of(model)
+            loaded = None if key is None else self._objects.get(key)
+            if loaded is None:
+                if key is not None and complete:
+                    self._objects[key] = model
+                merged.append(model)
+                continue
+            dirty_fields = loaded.dirty_fields()
+            refreshed = [c for c in columns if c not in dirty_fields]
+            for column in refreshed:
+                loaded.set_value(column, model.get_value(column))
+            loaded.mark_clean(refreshed)
+            merged.append(loaded)
+        return merged
+
+
+class Session:
+    """
+    Unit of work, writing models added, changed and deleted in it at `commit`, in one transaction.
+    Writes are grouped by model and operation into multi-row inserts, batched updates by `update_many` and
+    `DELETE ... WHERE pk IN (...)`, performed in order of inserts, updates and deletes.
+    Changed models are found in objects loaded through `dbi` of the session, which keeps an identity map, and
+    objects given to `add` or `track`.
+    """
+
+    def __init__(self, db_config=None, short_connection=True, chunk_size=500):
+        """
+        Create a session.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        :param short_connection: is using short connection creation
+        :param chunk_size: max object number written in one statement
+        """
+        assert chunk_size > 0
+        self.dbi = DBI(Riko.db_config if db_config is None else db_config, short_connection=short_connection)
+        self.dbi.use_identity_map()
+        self._chunk_size = chunk_size
+        self._new = OrderedDict()
+        self._tracked = OrderedDict()
+        self._deleted = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+    def add(self, *models):
+        """
+        Insert objects at commit.
+        """
+        for model in models:
+            self._deleted.pop(id(model), None)
+            self._new[id(model)] = model
+
+    def track(self, *models):
+        """
+        Update objects at commit if they are changed, for objects not loaded through `dbi`.
+        """
+        for model in models:
+            self._tracked[id(model)] = model
+
+    def delete(self, *models):
+        """
+        Delete objects at commit, an object added and not inserted yet is just dropped.
+        """
+        for model in models:
+            if self._new.pop(id(model), None) is None:
+                self._deleted[id(model)] = model
+            self._tracked.pop(id(model), None)
+
+    def dirty(self):
+        """
+        Get a list of persistent objects changed since loaded or saved.
+        """
+        found = OrderedDict()
+        for model in itertools.chain(self.dbi.identity_map.objects(), self._tracked.values()):
+            if model.is_dirty() and id(model) not in self._new and id(model) not in self._deleted:
+                found[id(model)] = model
+        return list(found.values())
+
+    def flush(self):
+        """
+        Write all changes now, in the current transaction of `dbi` if it is in one.
+        """
+        new, dirty, deleted = list(self._new.values()), self.dirty(), list(self._deleted.values())
+        self._insert_all(new)
+        self._update_all(dirty)
+        self._delete_all(deleted)
+        self._new.clear()
+        self._deleted.clear()
+        for model in new:
+            self._tracked[id(model)] = model
+
+    def commit(self):
+        """
+        Write all changes in one transaction.
+        If it fails, objects are restored as they were before, so the changes can be committed again.
+        """
+        state = self._snapshot()
+        try:
+            with self.dbi.start_transaction():
+                self.flush()
+        except Exception:
+            self._restore(state)
+            raise
+
+    def _snapshot(self):
+        """
+        Save states of session and its objects changed by `flush`, which are kept only if the transaction commits.
+        """
+        changed = [(model, model.dirty_fields(), model.get_ak_name() is not None and model.get_ak() is None)
+                   for model in itertools.chain(self._new.values(), self.dirty())]
+        return (OrderedDict(self._new), OrderedDict(self._tracked), OrderedDict(self._deleted),
+                self.dbi.identity_map.objects(), changed)
+
+    def _restore(self, state):
+        (self._new, self._tracked, self._deleted, loaded, changed) = state
+        for (model, dirty_fields, auto_key_unset) in changed:
+            if auto_key_unset:
+                model.set_ak(None)
+            model.mark_clean()
+            for column in dirty_fields:
+                model._mark_dirty(column)
+        self.dbi.identity_map.clear()
+        for model in loaded:
+            self.dbi.identity_map.add(model)
+
+    def rollback(self):
+        """
+        Drop all changes not written, and objects tracked.
+        """
+        self._new.clear()
+        self._deleted.clear()
+        self._tracked.clear()
+        self.dbi.identity_map.clear()
+
+    def close(self):
+        """
+        Close the connection of session.
+        """
+        self.dbi.close()
+
+    def _insert_all(self, models):
+        groups = OrderedDict()
+        for model in models:
+            auto_key = model.get_ak_name() is not None and model.get_ak() is None
+            columns = tuple(k for k in model.columns() if model.get_value(k) is not None)
+            groups.setdefault((model.__class__, auto_key, columns), list()).append(model)
+        for ((clazz, auto_key, columns), group) in groups.items():
+            if auto_key:
+                # auto increment ids of a multi-row insert are not reliable, insert one by one for them
+                self._insert_each(group)
+                continue
+            (clazz.insert_many(t=self.dbi)
+             .values(columns, [tuple(m.get_value(k) for k in columns) for m in group])
+             .go_chunked(max_rows=self._chunk_size))
+            for model in group:
+                model.mark_clean()
+                self.dbi.identity_map.add(model)
+
+    def _insert_each(self, models):
+        if len(models) > 1 and getattr(self.dbi._conn, "client_flag", 0) & CLIENT.MULTI_STATEMENTS:
+            with self.dbi.pipeline():
+                for model in models:
+                    model.insert(t=self.dbi)
+        else:
+            for model in models:
+                model.insert(t=self.dbi)
+
+    def _update_all(self, models):
+        groups = OrderedDict()
+        for model in models:
+            dirty_fields = model.dirty_fields()
+            columns = tuple(k for k in model.columns() if k in dirty_fields)
+            groups.setdefault((model.__class__, columns), list()).append(model)
+        for ((clazz, columns), group) in groups.items():
+            clazz.update_many(group, columns=list(columns), t=self.dbi, chunk_size=self._chunk_size)
+
+    def _delete_all(self, models):
+        groups = OrderedDict()
+        for model in models:
+            groups.setdefault(model.__class__, list()).append(model)
+        for (clazz, group) in groups.items():
+            pk_names = list(clazz.get_pk_name())
+            assert len(pk_names) > 0
+            for model in group:
+                if IdentityMap.key_of(model) is None:
+                    raise Exception("Cannot delete object without primary key: " + clazz.__name__)
+            for begin in range(0, len(group), self._chunk_size):
+                chunk = group[begin:begin + self._chunk_size]
+                args = dict()
+                match_terms = clazz._match_pk_terms(chunk, pk_names, args)
+                clazz.delete_query(t=self.dbi).where_raw(clazz._pk_in_term(pk_names, match_terms)).go(args)
+            clazz._invalidate_entities(self.dbi, group)
+            for model in group:
+                self.dbi.identity_map.discard(model)
+
+
+class ShardMap:
+    """
+    Placement of rows of a model on several databases by a shard key column.
+    Objects are written to the shard of their key, and queries with an equal or IN condition on the key are
+    performed on its shards only. Other queries are performed on all shards concurrently, with ordered results
+    merged, and COUNT, SUM, MIN and MAX combined.
+    """
+
+    _INTEGER = re.compile(r"[+-]?[0-9]+")
+
+    def __init__(self, key, shards, strategy=SHARD.HASH, bounds=None):
+        """
+        Create a shard map.
+        :param key: shard key column name
+        :param shards: a list of db config dicts of shards
+        :param strategy: `SHARD.HASH` to place a row by hash of its key, `SHARD.RANGE` by range of its key
+        :param bounds: for `SHARD.RANGE`, sorted lower bounds of keys of shards except the first one
+        """
+        assert len(shards) > 0
+        self.key = key
+        self.shards = list(shards)
+        self.strategy = strategy
+        if strategy == SHARD.RANGE:
+            assert bounds is not None and len(bounds) == len(self.shards) - 1
+            assert all(bounds[i] < bounds[i + 1] for i in range(len(bounds) - 1))
+            self.bounds = list(bounds)
+        else:
+            assert strategy == SHARD.HASH and bounds is None
+            self.bounds = None
+
+    def index_of(self, value):
+        """
+        Get index of the shard of a shard key value.
+        Integer keys are hashed by modulo, and others by MD5 of their string, both stable across processes.
+        A key is compared as MySQL does with the column, so `3`, `"3"` and `Decimal(3)` are on the same shard.
+        """
+        if value is None:
+            raise Exception("Shard key is not set: " + self.key)
+        if self.strategy == SHARD.RANGE:
+            bound_type = type(self.bounds[0]) if len(self.bounds) > 0 else None
+            if bound_type is not None and not isinstance(value, bound_type):
+                try:
+                    value = bound_type(value)
+                except (TypeError, ValueError):
+                    raise Exception("Shard key " + self.key + " is not comparable with bounds: " + repr(value))
+            return bisect.bisect_right(self.bounds, value)
+        value = ShardMap._normalized(value)
+        if isinstance(value, int):
+            return value % len(self.shards)
+        digest = hashlib.md5(str(value).encode("utf8")).digest()
+        return int.from_bytes(digest[:8], "big") % len(self.shards)
+
+    @staticmethod
+    def _normalized(value):
+        """
+        Get the integer of a key value with an integral number, or the value itself.
+        """
+        if isinstance(value, bytes):
+            value = value.decode("utf8", "surrogateescape")
+        if isinstance(value, str) and ShardMap._INTEGER.fullmatch(value.strip()):
+            return int(value)
+        return _key_value(value)
+
+    def config_of(self, value):
+        """
+        Get db config of the shard of a shard key value.
+        """
+        return self.shards[self.index_of(value)]
+
+    def configs_of(self, args, where_in=None):
+        """
+        Get db configs of shards a query touches, by its shard key arguments and IN conditions.
+        """
+        if isinstance(args, dict):
+            for prefix in ("__RIKO_WHERE_", "__RIKO_VALUES_"):
+                if prefix + self.key in args:
+                    return [self.config_of(args[prefix + self.key])]
+        if where_in and self.key in where_in:
+            return [self.shards[i] for i in sorted({self.index_of(v) for v in where_in[self.key]})]
+        return self.shards
+
+
+class _MergeKey:
+    """
+    Sort key of a row merged from shards, by column values in ascending or descending order, NULL first as MySQL.
+    """
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for (mine, theirs, descending) in zip(self.values, other.values, self.descending):
+            if mine == theirs:
+                continue
+            if mine is None or theirs is None:
+                return (mine is None) != descending
+            return (mine > theirs) if descending else (mine < theirs)
+        return False
+
+
+class Topology:
+    """
+    A primary database server and its replicas.
+    SELECT queries on temporary sessions of the primary config are routed to a replica picked by weight, through
+    a connection pool of each replica, while writes, `for_update` queries and explicit sessions stay on primary.
+    A replica is ejected for a while when it fails a connection, and skipped while its replication lag is over
+    `max_lag`. Reads of a thread go to primary for `read_your_writes` seconds after its last write.
+    """
+
+    # errors of a replica down or overloaded: lost connection, can't connect, and too many connections
+    _REPLICA_DOWN_ERRORS = frozenset((0, 2006, 2013, 2055, 2002, 2003, 1040))
+
+    def __init__(self, primary, replicas, max_lag=None, lag_check_interval=5, eject_seconds=30,
+                 read_your_writes=1, hedge_after=None):
+        """
+        Create a topology.
+        :param primary: primary db config dict
+        :param replicas: a list of replica db config dicts, or tuples of (db config dict, weight)
+        :param max_lag: max seconds of replication lag a replica is read, None to not check lag
+        :param lag_check_interval: seconds between replication lag checks
+        :param eject_seconds: seconds a replica is not read after it fails
+        :param read_your_writes: seconds reads of a thread go to primary after its write, 0 to disable
+        :param hedge_after: seconds to wait a replica read before sending it to another replica too, and taking
+                            the faster result, None to disable hedged reads
+        """
+        assert primary is not None
+        self.primary = primary
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.eject_seconds = eject_seconds
+        self.read_your_writes = read_your_writes
+        self.hedge_after = hedge_after
+        # replica entries of [db config, weight, ejected until, lag]
+        self._replicas = list()
+        for replica in replicas:
+            db_config, weight = replica if isinstance(replica, tuple) else (replica, 1)
+            assert weight > 0
+            self._replicas.append([db_config, weight, 0, None])
+        self._local = threading.local()
+        self._lag_mutex = threading.Lock()
+        self._lag_checked_at = None
+        self._hedger = None
+        self._hedger_mutex = threading.Lock()
+        self._hedged_reads = 0
+        self._hedge_wins = 0
+
+    def note_write(self):
+        """
+        Start read-your-writes window of current thread.
+        """
+        self._local.last_write = time_monotonic()
+
+    def choose_replica(self, exclude=None):
+        """
+        Pick a readable replica by weight.
+        :param exclude: a replica db config not to pick
+        :return: a replica db config, or None to read from primary
+        """
+        now = time_monotonic()
+        last_write = getattr(self._local, "last_write", None)
+        if last_write is not None and now - last_write < self.read_your_writes:
+            return None
+        if self.max_lag is not None and (self._lag_checked_at is None
+                                         or now - self._lag_checked_at >= self.lag_check_interval):
+            self._check_lag_in_background(now)
+        readable = [r for r in self._replicas if r[2] <= now and r[0] is not exclude
+                    and (self.max_lag is None or (r[3] is not None and r[3] <= self.max_lag))]
+        if not readable:
+            return None
+        if len(readable) == 1:
+            return readable[0][0]
+        return random.choices(readable, weights=[r[1] for r in readable])[0][0]
+
+    def eject(self, db_config):
+        """
+        Stop reading a replica for `eject_seconds`.
+        """
+        for replica in self._replicas:
+            if replica[0] is db_config:
+                replica[2] = time_monotonic() + self.eject_seconds
+                logging.warning("riko: replica %s:%s ejected", db_config.get("host"), db_config.get("port"))
+
+    def check_lag(self):
+        """
+        Fetch replication lag of every replica, a replica failing the check is ejected.
+        """
+        for replica in self._replicas:
+            try:
+                replica[3] = Topology._lag_of(replica[0])
+            except pymysql.err.MySQLError:
+                replica[3] = None
+                self.eject(replica[0])
+        self._lag_checked_at = time_monotonic()
+
+    def stats(self):
+        """
+        Get state of replicas and hedged reads.
+        :return: a dict of statistic
+        """
+        now = time_monotonic()
+        return dict(
+            replicas=[dict(host=r[0].get("host"), port=r[0].get("port"), weight=r[1], ejected=r[2] > now, lag=r[3])
+                      for r in self._replicas],
+            hedged_reads=self._hedged_reads,
+            hedge_wins=self._hedge_wins,
+        )
+
+    def _check_lag_in_background(self, now):
+        if not self._lag_mutex.acquire(blocking=False):
+            return
+        self._lag_checked_at = now
+
+        def check():
+            try:
+                self.check_lag()
+            finally:
+                self._lag_mutex.release()
+
+        threading.Thread(target=check, name="riko-lag-check", daemon=True).start()
+
+    @staticmethod
+    def _lag_of(db_config):
+        """
+        Get replication lag seconds of a replica, None if replication is not running.
+        """
+        dbi = DBI(db_config, short_connection=False)
+        try:
+            try:
+                status = dbi.query("SHOW REPLICA STATUS", None)
+            except pymysql.err.ProgrammingError:
+                # server before MySQL 8.0.22
+                status = dbi.query("SHOW SLAVE STATUS", None)
+        finally:
+            dbi.close()
+        if not status:
+            return None
+        row = status[0]
+        if not isinstance(row, dict):
+            return None
+        lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+        return None if lag is None else int(lag)
+
+    def _hedged_query(self, replica, sql, args, return_pattern, cursor_class):
+        """
+        Perform a read on a replica, and on another replica too if the first one does not finish in
+        `hedge_after` seconds or fails before. The first result succeeded is returned, and the read is performed
+        on primary if all replicas tried are down.
+        """
+        def read_on(db_config):
+            dbi = DBI(db_config, short_connection=False)
+            try:
+                return dbi.query(sql, args, return_pattern=return_pattern, cursor_class=cursor_class)
+            finally:
+                dbi.close()
+
+        if self._hedger is None:
+            with self._hedger_mutex:
+                if self._hedger is None:
+                    self._hedger = ThreadPoolExecutor(max_workers=max(4, 2 * len(self._replicas)),
+                                                      thread_name_prefix="riko-hedge")
+        pending = {self._hedger.submit(read_on, replica): replica}
+        hedged = False
+        failure = None
+        while pending:
+            done, _ = wait(pending, timeout=None if hedged else self.hedge_after, return_when=FIRST_COMPLETED)
+            for future in done:
+                db_config = pending.pop(future)
+                try:
+                    result = future.result()
+                except pymysql.err.MySQLError as ex:
+                    if len(ex.args) > 0 and ex.args[0] in Topology._REPLICA_DOWN_ERRORS:
+                        self.eject(db_config)
+                    else:
+                        # an error of the query itself is raised rather than reading from primary
+                        failure = ex
+                    continue
+                if db_config is not replica:
+                    self._hedge_wins += 1
+                return result
+            if not hedged:
+                hedged = True
+                second = self.choose_replica(exclude=replica)
+                if second is not None:
+                    self._hedged_reads += 1
+                    pending[self._hedger.submit(read_on, second)] = second
+        if failure is not None:
+            raise failure
+        return read_on(self.primary)
+
+
+class QueryBatch:
+    """
+    Independent queries performed concurrently by worker threads, so the time of a batch is about its slowest
+    query instead of the sum of all.
+    A `SelectQuery` is performed by `get`, and other `SqlQuery` by `go`. A query on a temporary session is
+    performed on a pooled connection, while queries bound to the same session are performed one by one, as a
+    connection cannot be used by two threads at the same time.
+    All batches share one pool of `max_threads` worker threads. A batch run on a worker thread, like a query on
+    all shards of a sharded model in `Riko.gather`, is performed on that thread one query by one, since waiting
+    for other workers of the pool from a worker may wait forever.
+    """
+
+    # max queries in flight of a batch created without `max_workers`
+    default_max_workers = 16
+
+    # worker threads shared by all batches, set before the first batch is run
+    max_threads = 32
+
+    _executor = None
+
+    _executor_lock = threading.Lock()
+
+    _worker = threading.local()
+
+    def __init__(self, max_workers=None):
+        """
+        Create an empty batch.
+        :param max_workers: max queries in flight, None for `default_max_workers`
+        """
+        self._max_workers = QueryBatch.default_max_workers if max_workers is None else max_workers
+        assert self._max_workers > 0
+        self._calls = list()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def add(self, query, parse_model=False, _datetime_dump=True, args=None):
+        """
+        Add a query into batch.
+        :param query: a `SqlQuery` object, or a function without arguments
+        :param parse_model: True to parse result of a `SelectQuery` to ORM model objects
+        :param _datetime_dump: ensure datetime and date of a `SelectQuery` result translated to string
+        :param args: argument dict for SQL rendering
+        :return: index of the query result in result list of `run`
+        """
+        if isinstance(query, SelectQuery):
+            session = QueryBatch._pooled_session_of(query)
+            call = (lambda: query.get(args=args, _datetime_dump=_datetime_dump, parse_model=parse_model))
+        elif isinstance(query, SqlQuery):
+            session = QueryBatch._pooled_session_of(query)
+            call = (lambda: query.go(args=args))
+        else:
+            assert callable(query)
+            session, call = None, query
+        self._calls.append((session, call))
+        return len(self._calls) - 1
+
+    def run(self, return_exceptions=False):
+        """
+        Perform all queries of batch, and wait until all of them finish.
+        :param return_exceptions: True to put exception of a failed query in its result place,
+                                  False to raise the exception of the first failed query
+        :return: a list of query results in order of adding
+        """
+        lanes = OrderedDict()
+        for index, (session, call) in enumerate(self._calls):
+            lanes.setdefault(index if session is None else id(session), list()).append((index, call))
+        results = [None] * len(self._calls)
+        failed = [False] * len(self._calls)
+
+        def perform(lane):
+            for index, call in lane:
+                try:
+                    results[index] = call()
+                except Exception as ex:
+                    results[index] = ex
+                    failed[index] = True
+
+        lanes = list(lanes.values())
+        if len(lanes) == 1 or getattr(QueryBatch._worker, "active", False):
+            for lane in lanes:
+                perform(lane)
+        else:
+            pending = list(reversed(lanes))
+            pending_lock = threading.Lock()
+
+            def work():
+                # a worker performs lanes until none is left, so at most `max_workers` queries are in flight
+                QueryBatch._worker.active = True
+                try:
+                    while True:
+                        with pending_lock:
+                            if len(pending) == 0:
+                                return
+                            lane = pending.pop()
+                        perform(lane)
+                finally:
+                    QueryBatch._worker.active = False
+
+            executor = QueryBatch._shared_executor()
+            for future in [executor.submit(work) for _ in range(min(self._max_workers, len(lanes)))]:
+                future.result()
+        if not return_exceptions:
+            for index, is_failed in enumerate(failed):
+                if is_failed:
+                    raise results[index]
+        return results
+
+    @staticmethod
+    def _pooled_session_of(query):
+        """
+        Get the session a query is performed on, moving a temporary session not connected yet to pooled connection.
+        """
+        if query._temporary_dbi and query._dbi.is_short_connection() and query._dbi._connection is None:
+            query._dbi = DBI(db_config=query._dbi.get_config(), short_connection=False)
+        return query._dbi
+
+    @staticmethod
+    def _shared_executor():
+        if QueryBatch._executor is None:
+            with QueryBatch._executor_lock:
+                if QueryBatch._executor is None:
+                    QueryBatch._executor = ThreadPoolExecutor(max_workers=QueryBatch.max_threads,
+                                                              thread_name_prefix="riko-batch")
+        return QueryBatch._executor
+
+
+class DBI:
+    """
+    DB connection session.
+    """
+    RETURN_NONE = 0
+    RETURN_CURSOR = 1
+    RETURN_RESULT = 2
+    RETURN_LAST_ROW_ID = 3
+    RETURN_AFFECTED_ROW = 4
+    RETURN_DESCRIBED_RESULT = 5
+
+    # bytes reserved in a packet for protocol header
+    _PACKET_HEADROOM = 1024
+
+    _max_allowed_packet = dict()
+
+    @staticmethod
+    def get_connection(db_config=None, short_connection=True):
+        """
+        Get a DBI object by connecting with DB using config.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
         :param short_connection: True to create a short connection, False to create a long connection
         :return: DBI object, represent a connection session
         """
@@ -1484,11 +4863,19 @@ class DBI:
     def __init__(self, db_config, short_connection=True):
         assert db_config is not None
         self._db_conf = db_config
+        self._is_thread_connection = False
+        if short_connection and Riko.connection_mode == CONNECTION.POOLED:
+            short_connection = False
+        elif short_connection and Riko.connection_mode == CONNECTION.THREAD_LOCAL:
+            self._is_thread_connection = True
         self._is_short_connection = short_connection
-        if self._is_short_connection:
-            self._conn = Riko.shaded_pool.short_connection(db_config)
-        else:
-            self._conn = Riko.shaded_pool.pooled_connection(db_config)
+        # connected when the first statement is performed
+        self._connection = None
+        self._in_transaction = False
+        self._commit_callbacks = list()
+        self._pipeline = None
+        self._temporary_tables = set()
+        self.identity_map = None
 
     def get_config(self):
         """
@@ -1497,37 +4884,135 @@ class DBI:
         """
         return self._db_conf
 
+    def is_short_connection(self):
+        """
+        Get if this session is on a short connection.
+        """
+        return self._is_short_connection
+
+    def in_transaction(self):
+        """
+        Get if this session is in a `start_transaction` scope.
+        """
+        return self._in_transaction
+
+    def on_commit(self, callback):
+        """
+        Call a function after the transaction of current `start_transaction` scope commits.
+        :param callback: a function without arguments
+        """
+        assert self._in_transaction
+        self._commit_callbacks.append(callback)
+
+    def use_identity_map(self, enabled=True):
+        """
+        Keep model objects loaded in this session in an identity map.
+        Primary key lookups by `get_one` return loaded objects without query, and loaded rows are merged into
+        the objects already loaded.
+        :param enabled: True to enable identity map, False to disable and drop it
+        :return: the `IdentityMap` object, or None if disabled
+        """
+        if not enabled:
+            self.identity_map = None
+        elif self.identity_map is None:
+            self.identity_map = IdentityMap()
+        return self.identity_map
+
+    @property
+    def _conn(self):
+        if self._connection is None:
+            if not self._is_short_connection:
+                self._connection = Riko.shaded_pool.pooled_connection(self._db_conf)
+            elif self._is_thread_connection:
+                self._connection = Riko.shaded_pool.thread_connection(self._db_conf)
+            else:
+                self._connection = Riko.shaded_pool.short_connection(self._db_conf)
+        return self._connection
+
     def close(self):
         """
-        Close the connection.
+        Close the connection, or give it back if it is a thread or pooled connection.
+        Temporary tables created by `load_temporary_table` are dropped before a connection is given back.
         """
-        self._conn.close()
+        if self._connection is not None:
+            if self._temporary_tables and not (self._is_short_connection and not self._is_thread_connection):
+                self._drop_temporary_tables()
+            self._connection.close()
+            self._connection = None
+        self._temporary_tables = set()
 
-    def query(self, sql, args, transactional=True, return_pattern=RETURN_RESULT):
+    def _discard_connection(self):
+        """
+        Close the connection without reading its pending result, unless it keeps work of this session.
+        :return: True if the connection is closed
+        """
+        conn = self._connection
+        if conn is None or self._in_transaction or self._temporary_tables or \
+                getattr(conn, "server_status", 0) & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            return False
+        self._connection = None
+        conn.close()
+        return True
+
+    def load_temporary_table(self, table, source_sql, rows, transactional=True):
+        """
+        Create a temporary table with columns typed as result of a query, and insert rows into it.
+        A temporary table of the same name is replaced, and the table is dropped when this session is closed.
+        :param table: temporary table name
+        :param source_sql: a query giving columns of the table, like "SELECT uid AS v FROM user LIMIT 0"
+        :param rows: value tuples of rows
+        :param transactional: using temporary connection, but not provided transactional connection
+        """
+        self.query("DROP TEMPORARY TABLE IF EXISTS " + table, None, transactional=transactional,
+                   return_pattern=DBI.RETURN_NONE)
+        self.query("CREATE TEMPORARY TABLE " + table + " " + source_sql, None, transactional=transactional,
+                   return_pattern=DBI.RETURN_NONE)
+        self._temporary_tables.add(table)
+        if len(rows) > 0:
+            self.insert_chunked("INSERT INTO " + table + " VALUES ", "(" + ", ".join(["%s"] * len(rows[0])) + ")",
+                                rows, max_rows=10000, transactional=transactional)
+
+    def _drop_temporary_tables(self):
+        try:
+            cursor = self._connection.cursor()
+            try:
+                cursor.execute("DROP TEMPORARY TABLE IF EXISTS " + ", ".join(sorted(self._temporary_tables)))
+            finally:
+                cursor.close()
+        except pymysql.err.MySQLError:
+            # a lost connection has no temporary table
+            pass
+
+    def query(self, sql, args, transactional=True, return_pattern=RETURN_RESULT, cursor_class=None):
         """
         Perform a raw query.
         :param sql: sql to perform
         :param args: argument dict for sql rendering
         :param transactional: using temporary connection, but not provided transactional connection
         :param return_pattern: result return pattern, default `RETURN_RESULT`
-        :return: RETURN_RESULT       - a list of dict objects
-                 RETURN_CURSOR       - a cursor for fetching result
-                 RETURN_LAST_ROW_ID  - inserted record auto increment id
-                 RETURN_AFFECTED_ROW - query affected row count
-        """
+        :param cursor_class: cursor class, None to use the connection default
+        :return: RETURN_RESULT           - a list of dict objects
+                 RETURN_CURSOR           - a cursor for fetching result
+                 RETURN_LAST_ROW_ID      - inserted record auto increment id
+                 RETURN_AFFECTED_ROW     - query affected row count
+                 RETURN_DESCRIBED_RESULT - a tuple of (result rows list, cursor description)
+                 a `StatementHandle` for RETURN_LAST_ROW_ID and RETURN_AFFECTED_ROW in a `pipeline` scope
+        """
+        if self._pipeline is not None:
+            if return_pattern in (DBI.RETURN_AFFECTED_ROW, DBI.RETURN_LAST_ROW_ID):
+                return self._pipeline.add(sql, args, return_pattern)
+            self._pipeline.flush()
         ret_val = None
         try:
-            self._conn.ping(reconnect=transactional)
-            cursor = self._conn.cursor()
-            affected = cursor.execute(sql, args)
-            if return_pattern == DBI.RETURN_RESULT:
+            cursor, affected = self._execute(sql, args, reconnect=transactional, cursor_class=cursor_class)
+            if return_pattern in (DBI.RETURN_RESULT, DBI.RETURN_DESCRIBED_RESULT):
                 fetched = cursor.fetchall()
                 if fetched is not None and isinstance(fetched, list) is False:
                     try:
                         fetched = list(fetched)
                     except:
                         pass
-                ret_val = fetched
+                ret_val = fetched if return_pattern == DBI.RETURN_RESULT else (fetched, cursor.description)
             elif return_pattern == DBI.RETURN_CURSOR:
                 ret_val = cursor
             elif return_pattern == DBI.RETURN_LAST_ROW_ID:
@@ -1543,6 +5028,26 @@ class DBI:
                 self._conn.commit()
             return ret_val
 
+    def stream(self, sql, args, batch_size=1000, cursor_class=pymysql.cursors.SSDictCursor, release=False):
+        """
+        Perform a raw query on an unbuffered server-side cursor.
+        :param sql: sql to perform
+        :param args: argument dict for sql rendering
+        :param batch_size: row number fetched from server per round
+        :param cursor_class: unbuffered cursor class, default `SSDictCursor`
+        :param release: True to close this DBI when the result stream is closed
+        :return: a `ResultStream` object
+        """
+        assert batch_size > 0
+        self._flush_pipeline()
+        try:
+            cursor, _ = self._execute(sql, args, reconnect=release, cursor_class=cursor_class)
+        except Exception as ex:
+            if release:
+                self.close()
+            raise ex
+        return ResultStream(self, cursor, batch_size=batch_size, release=release)
+
     def insert_many(self, sql_tpl, args, transactional=True):
         """
         Perform multiple insert query.
@@ -1551,8 +5056,9 @@ class DBI:
         :param transactional: using temporary connection, but not provided transactional connection
         :return: affected row count
         """
+        self._flush_pipeline()
         try:
-            self._conn.ping(reconnect=transactional)
+            self._ensure_alive(reconnect=transactional)
             cursor = self._conn.cursor()
             ret_val = cursor.executemany(sql_tpl, args)
         except Exception as ex:
@@ -1564,33 +5070,947 @@ class DBI:
                 self._conn.commit()
             return ret_val
 
+    def insert_chunked(self, statement_head, row_template, rows, statement_tail="", tail_args=None, max_rows=1000,
+                       max_bytes=None, transactional=True, commit_per_chunk=False):
+        """
+        Perform multiple insert query by multi-row statements split in chunks.
+        :param statement_head: statement before rows, like "INSERT INTO t(a, b) VALUES "
+        :param row_template: placeholders of one row, like "(%s, %s)"
+        :param rows: args for insert values in tuple in list
+        :param statement_tail: statement after rows, like "ON DUPLICATE KEY UPDATE ..."
+        :param tail_args: argument dict for rendering `statement_tail`
+        :param max_rows: max row number of one statement
+        :param max_bytes: max encoded byte size of one statement, None to fit in server `max_allowed_packet`
+        :param transactional: using temporary connection, but not provided transactional connection
+        :param commit_per_chunk: True to commit after each chunk, False to insert all chunks in one transaction,
+                                 not allowed in a `start_transaction` scope
+        :return: a list of affected row count of each chunk
+        """
+        assert max_rows > 0
+        if commit_per_chunk and self._in_transaction:
+            raise Exception("Cannot commit per chunk in a transaction")
+        self._flush_pipeline()
+        chunk_counts = list()
+        try:
+            self._ensure_alive(reconnect=transactional)
+            if max_bytes is None:
+                max_bytes = self.max_statement_bytes()
+            cursor = self._conn.cursor()
+            if statement_tail:
+                statement_tail = " " + cursor.mogrify(statement_tail, tail_args)
+            if transactional and not commit_per_chunk:
+                self._conn.begin()
+            base_bytes = DBI._encoded_size(statement_head) + DBI._encoded_size(statement_tail)
+            chunk, chunk_bytes = list(), base_bytes
+            for row in rows:
+                literal = cursor.mogrify(row_template, row)
+                literal_bytes = DBI._encoded_size(literal) + 1
+                if len(chunk) > 0 and (len(chunk) >= max_rows or chunk_bytes + literal_bytes > max_bytes):
+                    chunk_counts.append(cursor.execute(statement_head + ",".join(chunk) + statement_tail))
+                    if commit_per_chunk:
+                        self._conn.commit()
+                    chunk, chunk_bytes = list(), base_bytes
+                chunk.append(literal)
+                chunk_bytes += literal_bytes
+            if len(chunk) > 0:
+                chunk_counts.append(cursor.execute(statement_head + ",".join(chunk) + statement_tail))
+        except Exception as ex:
+            if transactional:
+                self._conn.rollback()
+            raise ex
+        else:
+            if transactional:
+                self._conn.commit()
+            return chunk_counts
+
+    def load_infile(self, sql_tpl, data_blocks, transactional=True):
+        """
+        Perform a `LOAD DATA LOCAL INFILE` query, data is streamed to server through a named pipe.
+        The connection must be created with `local_infile=True`.
+        If `data_blocks` raises, the server has loaded a truncated stream, which is rolled back, to a savepoint if
+        `transactional` is False, except on a connection in autocommit mode.
+        :param sql_tpl: load data sql, with a `%s` placeholder for the file name
+        :param data_blocks: iterable of encoded data blocks, may be a generator
+        :param transactional: using temporary connection, but not provided transactional connection
+        :return: affected row count
+        """
+        if not hasattr(os, "mkfifo"):
+            raise Exception("LOAD DATA streaming needs named pipe, which is not supported on this platform")
+        self._flush_pipeline()
+        pipe_dir = tempfile.mkdtemp(prefix="riko-")
+        pipe_path = os.path.join(pipe_dir, "load.tsv")
+        os.mkfifo(pipe_path, 0o600)
+        feeder = _PipeFeeder(pipe_path, data_blocks)
+        feeder.start()
+        savepoint = False
+        try:
+            self._ensure_alive(reconnect=transactional)
+            if transactional:
+                self._conn.begin()
+            cursor = self._conn.cursor()
+            savepoint = not transactional and not self._conn.get_autocommit()
+            if savepoint:
+                cursor.execute("SAVEPOINT riko_load")
+            affected = cursor.execute(sql_tpl, (pipe_path,))
+            feeder.finish()
+        except Exception as ex:
+            if transactional:
+                self._conn.rollback()
+            elif savepoint:
+                try:
+                    cursor.execute("ROLLBACK TO SAVEPOINT riko_load")
+                except pymysql.err.MySQLError:
+                    pass
+            raise ex
+        else:
+            if transactional:
+                self._conn.commit()
+            elif savepoint:
+                cursor.execute("RELEASE SAVEPOINT riko_load")
+            return affected
+        finally:
+            feeder.abort()
+            os.remove(pipe_path)
+            os.rmdir(pipe_dir)
+
+    def _ensure_alive(self, reconnect):
+        """
+        Ping the connection before a statement as `Riko.ping_policy` requires, and record its last used time.
+        """
+        conn = self._conn
+        now = time_monotonic()
+        policy = Riko.ping_policy
+        if policy == PING.ALWAYS or (policy == PING.IDLE and
+                                     now - getattr(conn, "riko_last_used", -Riko.ping_idle_interval) >=
+                                     Riko.ping_idle_interval):
+            conn.ping(reconnect=reconnect)
+        conn.riko_last_used = now
+
+    def _execute(self, sql, args, reconnect, cursor_class=None):
+        """
+        Perform a statement on a new cursor.
+        A read query is performed once more after reconnecting if the connection is lost, when `reconnect` is
+        allowed and there was no ping before it.
+        :return: a tuple of (cursor, affected row count)
+        """
+        self._ensure_alive(reconnect)
+        cursor = self._conn.cursor() if cursor_class is None else self._conn.cursor(cursor_class)
+        try:
+            return cursor, cursor.execute(sql, args)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as ex:
+            cursor.close()
+            if not (reconnect and Riko.ping_policy != PING.ALWAYS and not self._in_transaction
+                    and DBI._is_connection_lost(ex) and DBI._is_idempotent_read(sql)):
+                raise ex
+        self._conn.ping(reconnect=True)
+        cursor = self._conn.cursor() if cursor_class is None else self._conn.cursor(cursor_class)
+        try:
+            return cursor, cursor.execute(sql, args)
+        except Exception:
+            cursor.close()
+            raise
+
+    # client errors of a lost connection: gone away, lost during query, server lost, and already closed
+    _CONNECTION_LOST_ERRORS = frozenset((0, 2006, 2013, 2055))
+
+    @staticmethod
+    def _is_connection_lost(ex):
+        return len(ex.args) > 0 and ex.args[0] in DBI._CONNECTION_LOST_ERRORS
+
+    @staticmethod
+    def _is_idempotent_read(sql):
+        head = sql.lstrip()[:6].upper()
+        return head == "SELECT" and "FOR UPDATE" not in sql.upper() and "LOCK IN SHARE MODE" not in sql.upper()
+
+    def max_statement_bytes(self):
+        """
+        Get the max byte size of a statement can be sent to server, according to server `max_allowed_packet`.
+        The value is fetched once for each server.
+        """
+        server_key = (self._db_conf.get("host"), self._db_conf.get("port"), self._db_conf.get("unix_socket"))
+        packet_limit = DBI._max_allowed_packet.get(server_key)
+        if packet_limit is None:
+            cursor = self._conn.cursor()
+            try:
+                cursor.execute("SELECT @@max_allowed_packet")
+                fetched = cursor.fetchone()
+            finally:
+                cursor.close()
+            packet_limit = int(fetched[0] if isinstance(fetched, (list, tuple)) else list(fetched.values())[0])
+            DBI._max_allowed_packet[server_key] = packet_limit
+        return packet_limit - DBI._PACKET_HEADROOM
+
+    @staticmethod
+    def _encoded_size(text):
+        return len(text) if text.isascii() else len(text.encode("utf8"))
+
     def rollback(self):
         """
-        Try to rollback transaction of this DBI connection.
+        Try to rollback transaction of this DBI connection, statements not sent in `pipeline` are dropped.
         """
+        if self._pipeline is not None:
+            self._pipeline.discard()
         self._conn.rollback()
 
     def commit(self):
         """
         Try to commit transaction of this DBI conneciton.
         """
+        self._flush_pipeline()
         self._conn.commit()
 
+    @contextlib.contextmanager
+    def pipeline(self):
+        """
+        Create a scoped context collecting statements of this session which return affected row count or last
+        insert id, such as `go`, `insert`, `save` and `delete`, and sending them in multi-statement packets, one
+        round trip for many statements.
+        Collected statements return `StatementHandle` objects, resolved when the pipeline is flushed: at the end
+        of the scope, before a statement returning rows, and before commit of transaction.
+        The connection config must enable `client_flag=CLIENT.MULTI_STATEMENTS`.
+        :return: a `Pipeline` object
+        """
+        assert self._pipeline is None
+        pipeline = Pipeline(self)
+        self._pipeline = pipeline
+        try:
+            yield pipeline
+            pipeline.flush()
+        except Exception:
+            pipeline.discard()
+            raise
+        finally:
+            self._pipeline = None
+
+    def _flush_pipeline(self):
+        if self._pipeline is not None:
+            self._pipeline.flush()
+
     @contextlib.contextmanager
     def start_transaction(self):
         """
         Create a scoped context with all operations as one transaction.
         """
+        self._flush_pipeline()
         if self._is_short_connection:
             _auto_commit = self._conn.get_autocommit()
             self._conn.autocommit(False)
         self._conn.begin()
+        self._in_transaction = True
         try:
             yield self
+            self._flush_pipeline()
             self._conn.commit()
         except Exception as ex:
+            if self._pipeline is not None:
+                self._pipeline.discard()
             self._conn.rollback()
             raise ex
+        else:
+            self._in_transaction = False
+            for callback in self._commit_callbacks:
+                callback()
         finally:
+            self._in_transaction = False
+            self._commit_callbacks = list()
             if self._is_short_connection:
                 self._conn.autocommit(_auto_commit)
+
+
+class StatementHandle:
+    """
+    Result of a statement collected in `DBI.pipeline`, available after the pipeline is flushed.
+    """
+    __slots__ = ("affected", "last_row_id", "error", "done", "_return_pattern", "_watchers")
+
+    def __init__(self, return_pattern=DBI.RETURN_AFFECTED_ROW):
+        self.affected = None
+        self.last_row_id = None
+        self.error = None
+        self.done = False
+        self._return_pattern = return_pattern
+        self._watchers = list()
+
+    @property
+    def value(self):
+        """
+        Get the result as returned without pipeline: last insert id or affected row count.
+        """
+        if not self.done:
+            raise Exception("Statement is not performed yet, flush the pipeline first")
+        if self.error is not None:
+            raise self.error
+        return self.last_row_id if self._return_pattern == DBI.RETURN_LAST_ROW_ID else self.affected
+
+    def then(self, callback):
+        """
+        Call a function with `value` after the statement succeeds.
+        :param callback: a function with one argument
+        """
+        self._watch(lambda handle: callback(handle.value) if handle.error is None else None)
+        return self
+
+    @staticmethod
+    def combine(handles):
+        """
+        Get a handle of the total affected row count of statements, resolved after all of them are performed.
+        """
+        combined = StatementHandle()
+        remaining = [len(handles)]
+
+        def settle(_):
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            failed = [h.error for h in handles if h.error is not None]
+            if failed:
+                combined._fail(failed[0])
+            else:
+                combined._resolve(sum(h.affected for h in handles), None)
+        for handle in handles:
+            handle._watch(settle)
+        return combined
+
+    def _watch(self, watcher):
+        if self.done:
+            watcher(self)
+        else:
+            self._watchers.append(watcher)
+
+    def _resolve(self, affected, last_row_id):
+        self.affected = affected
+        self.last_row_id = last_row_id
+        self._settle()
+
+    def _fail(self, error):
+        self.error = error
+        self._settle()
+
+    def _settle(self):
+        self.done = True
+        watchers, self._watchers = self._watchers, list()
+        for watcher in watchers:
+            watcher(self)
+
+
+class Pipeline:
+    """
+    Statements collected by `DBI.pipeline`, rendered on the client and sent joined by `;` in packets up to
+    server `max_allowed_packet`. Results of statements are read in order by `nextset`, if a statement fails the
+    server skips the rest, and handles of them fail with the error.
+    """
+
+    def __init__(self, dbi):
+        self._dbi = dbi
+        self._cursor = None
+        self._pending = list()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, sql, args, return_pattern=DBI.RETURN_AFFECTED_ROW):
+        """
+        Add a statement into pipeline.
+        :return: a `StatementHandle` object
+        """
+        if self._cursor is None:
+            self._cursor = self._dbi._conn.cursor()
+        handle = StatementHandle(return_pattern)
+        self._pending.append((self._cursor.mogrify(sql, args).strip(), handle))
+        return handle
+
+    def flush(self):
+        """
+        Send all statements collected, and wait for their results.
+        """
+        pending, self._pending = self._pending, list()
+        if len(pending) == 0:
+            return
+        if len(pending) > 1 and not getattr(self._dbi._conn, "client_flag", 0) & CLIENT.MULTI_STATEMENTS:
+            self._abort(pending, Exception("Pipeline is not performed"))
+            raise Exception("DBI.pipeline needs `client_flag=CLIENT.MULTI_STATEMENTS` in db config")
+        max_bytes = self._dbi.max_statement_bytes() if len(pending) > 1 else None
+        begin = 0
+        while begin < len(pending):
+            end, size = begin, 0
+            while end < len(pending):
+                size += DBI._encoded_size(pending[end][0]) + 1
+                if end > begin and size > max_bytes:
+                    break
+                end += 1
+            try:
+                self._send(pending[begin:end])
+            except Exception as ex:
+                self._abort(pending[begin:], ex)
+                raise
+            begin = end
+
+    def discard(self):
+        """
+        Drop statements not sent, their handles fail.
+        """
+        pending, self._pending = self._pending, list()
+        self._abort(pending, Exception("Pipeline is discarded before the statement is performed"))
+
+    def _send(self, packet):
+        cursor = None
+        index = 0
+        try:
+            cursor, _ = self._dbi._execute(";\n".join(statement for (statement, _) in packet), None, reconnect=False)
+            while True:
+                packet[index][1]._resolve(cursor.rowcount, cursor.lastrowid)
+                index += 1
+                if index == len(packet):
+                    break
+                cursor.nextset()
+        except Exception as ex:
+            self._abort(packet[index:], ex)
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    @staticmethod
+    def _abort(pending, error):
+        for (_, handle) in pending:
+            if not handle.done:
+                handle._fail(error)
+
+
+class ReplicaDBI(DBI):
+    """
+    Temporary session of a SELECT query of a primary with `Topology`, connecting to a replica chosen when the
+    first statement is performed. The query is performed on primary if no replica is readable, and once more on
+    primary if the replica fails.
+    `get_config` gives the primary config, so models loaded from a replica are written to primary.
+    """
+
+    def __init__(self, topology):
+        super().__init__(topology.primary, short_connection=False)
+        self._topology = topology
+        self._replica = None
+        self._primary_pinned = False
+
+    def pin_primary(self, pinned=True):
+        """
+        Perform statements of this session on primary.
+        """
+        assert self._connection is None
+        self._primary_pinned = pinned
+
+    @property
+    def _conn(self):
+        if self._connection is None:
+            self._replica = None if self._primary_pinned else self._topology.choose_replica()
+            self._connection = Riko.shaded_pool.pooled_connection(
+                self._db_conf if self._replica is None else self._replica)
+        return self._connection
+
+    def query(self, sql, args, transactional=True, return_pattern=DBI.RETURN_RESULT, cursor_class=None):
+        """
+        Perform a raw query on a replica, see `DBI.query`.
+        """
+        topology = self._topology
+        if (topology.hedge_after is not None and self._connection is None and not self._primary_pinned
+                and return_pattern in (DBI.RETURN_RESULT, DBI.RETURN_DESCRIBED_RESULT)
+                and DBI._is_idempotent_read(sql)):
+            replica = topology.choose_replica()
+            if replica is not None:
+                return topology._hedged_query(replica, sql, args, return_pattern, cursor_class)
+        try:
+            return super().query(sql, args, transactional=transactional, return_pattern=return_pattern,
+                                 cursor_class=cursor_class)
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as ex:
+            if (self._replica is None or return_pattern == DBI.RETURN_CURSOR or not DBI._is_idempotent_read(sql)
+                    or len(ex.args) == 0 or ex.args[0] not in Topology._REPLICA_DOWN_ERRORS):
+                raise ex
+            topology.eject(self._replica)
+        self.close()
+        self._primary_pinned = True
+        return super().query(sql, args, transactional=transactional, return_pattern=return_pattern,
+                             cursor_class=cursor_class)
+
+
+class _ConnectionProxy:
+    """
+    A connection handed out for reuse, closing it releases it instead.
+    """
+
+    def __init__(self, conn, release):
+        self._raw_conn = conn
+        self._release = release
+
+    def __getattr__(self, name):
+        if self._raw_conn is None:
+            raise Exception("Connection is already released")
+        return getattr(self._raw_conn, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_raw_conn", "_release"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._raw_conn, name, value)
+
+    def close(self):
+        if self._raw_conn is not None:
+            conn, self._raw_conn = self._raw_conn, None
+            self._release(conn)
+
+
+class _PipeFeeder(threading.Thread):
+    """
+    Write data blocks into a named pipe in background, until the reader side consumed them all.
+    """
+
+    def __init__(self, pipe_path, data_blocks):
+        super().__init__(daemon=True)
+        self._pipe_path = pipe_path
+        self._data_blocks = data_blocks
+        self._aborted = False
+        self._error = None
+
+    def run(self):
+        try:
+            with open(self._pipe_path, "wb") as pipe:
+                if self._aborted:
+                    return
+                for block in self._data_blocks:
+                    if self._aborted:
+                        return
+                    pipe.write(block)
+        except Exception as ex:
+            self._error = ex
+
+    def finish(self):
+        """
+        Wait for all data written, and raise the error occurred when producing data.
+        If the data source raised, the reader has seen a truncated stream, so the load must be rolled back.
+        """
+        self.join()
+        if self._error is not None and not isinstance(self._error, BrokenPipeError):
+            raise self._error
+
+    def abort(self):
+        """
+        Stop writing and make sure the thread is not blocked at opening the pipe.
+        """
+        self._aborted = True
+        while self.is_alive():
+            try:
+                fd = os.open(self._pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            self.join(0.05)
+
+
+class ResultStream:
+    """
+    Query result fetched lazily from an unbuffered server-side cursor.
+    """
+
+    def __init__(self, dbi, cursor, batch_size=1000, release=False):
+        self._dbi = dbi
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._release = release
+        self._exhausted = False
+        self._closed = False
+        self.description = cursor.description
+
+    def __iter__(self):
+        for batch in self.batches():
+            for row in batch:
+                yield row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def batches(self):
+        """
+        Iterate the result in batches of rows.
+        """
+        while not self._closed:
+            batch = self._cursor.fetchmany(self._batch_size)
+            if not batch:
+                self._exhausted = True
+                break
+            yield batch
+
+    def close(self):
+        """
+        Release the cursor, and the connection if this stream owns it.
+        A connection abandoned halfway is closed instead of reading the remaining rows, pools and threads do not
+        reuse it. The rows are read only if the connection keeps a transaction or temporary tables of its session.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._exhausted or not (self._release or self._dbi._discard_connection()):
+                self._cursor.close()
+            else:
+                # nothing is left for the cursor to drain on a closed connection
+                self._cursor.connection = None
+        finally:
+            if self._release:
+                self._dbi.close()
+
+
+class AsyncDBI:
+    """
+    DB session for asyncio, performing statements on a bounded aiomysql connection pool shared by sessions of
+    the same config in an event loop.
+    Queries bound to it return awaitables from `get`, `only` and `go`, and an async generator from `stream`.
+    Each statement checks out a connection of the pool, so one session can have many statements in flight, except
+    in a `transaction` scope which holds one connection.
+    """
+
+    # settings of aiomysql pools
+    pool_settings = dict(minsize=1, maxsize=32, pool_recycle=3600)
+
+    _pools = dict()
+
+    def __init__(self, db_config=None):
+        """
+        Create an async session.
+        :param db_config: DB connection config, None to use default `Riko.db_config`
+        """
+        self._db_conf = Riko.db_config if db_config is None else db_config
+        self._held_conn = None
+        self._in_transaction = False
+        self._commit_callbacks = list()
+        self.identity_map = None
+
+    def get_config(self):
+        """
+        Get current session connection config.
+        :return: a dict of connection config
+        """
+        return self._db_conf
+
+    def is_short_connection(self):
+        return False
+
+    def in_transaction(self):
+        """
+        Get if this session is a `transaction` scope.
+        """
+        return self._in_transaction
+
+    def on_commit(self, callback):
+        """
+        Call a function after the transaction of this `transaction` scope commits.
+        :param callback: a function without arguments
+        """
+        assert self._in_transaction
+        self._commit_callbacks.append(callback)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    async def close_pools():
+        """
+        Close connection pools of current event loop.
+        """
+        loop = asyncio.get_running_loop()
+        for key in [k for k in AsyncDBI._pools if k[1] is loop]:
+            pool = await AsyncDBI._pools.pop(key)
+            pool.close()
+            await pool.wait_closed()
+
+    async def query(self, sql, args, transactional=True, return_pattern=DBI.RETURN_RESULT, cursor_class=None):
+        """
+        Perform a raw query, see `DBI.query`. `RETURN_CURSOR` is not supported.
+        """
+        async with self._connection() as conn:
+            cursor = await conn.cursor(AsyncDBI._cursor_class(cursor_class))
+            try:
+                affected = await cursor.execute(sql, args)
+                if return_pattern in (DBI.RETURN_RESULT, DBI.RETURN_DESCRIBED_RESULT):
+                    fetched = list(await cursor.fetchall())
+                    ret_val = fetched if return_pattern == DBI.RETURN_RESULT else (fetched, cursor.description)
+                elif return_pattern == DBI.RETURN_LAST_ROW_ID:
+                    ret_val = cursor.lastrowid
+                elif return_pattern == DBI.RETURN_AFFECTED_ROW:
+                    ret_val = affected
+                elif return_pattern == DBI.RETURN_CURSOR:
+                    raise Exception("RETURN_CURSOR is not supported by AsyncDBI")
+                else:
+                    ret_val = None
+            finally:
+                await cursor.close()
+            await self._end_statement(conn)
+            return ret_val
+
+    async def insert_many(self, sql_tpl, args, transactional=True):
+        """
+        Perform multiple insert query, see `DBI.insert_many`.
+        """
+        async with self._connection() as conn:
+            cursor = await conn.cursor()
+            try:
+                affected = await cursor.executemany(sql_tpl, args)
+            finally:
+                await cursor.close()
+            await self._end_statement(conn)
+            return affected
+
+    def stream(self, sql, args, batch_size=1000, cursor_class=pymysql.cursors.SSDictCursor):
+        """
+        Perform a raw query on an unbuffered server-side cursor.
+        :return: an `AsyncResultStream` object, to be entered by `async with`
+        """
+        assert batch_size > 0
+        return AsyncResultStream(self, sql, args, batch_size, AsyncDBI._cursor_class(cursor_class))
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Create a scoped session performing all statements on one connection as one transaction.
+        """
+        pool = await self._pool()
+        conn = await pool.acquire()
+        scoped = AsyncDBI(self._db_conf)
+        scoped._held_conn = conn
+        scoped._in_transaction = True
+        scoped.identity_map = self.identity_map
+        try:
+            await conn.begin()
+            yield scoped
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            scoped._in_transaction = False
+            for callback in scoped._commit_callbacks:
+                callback()
+        finally:
+            scoped._held_conn = None
+            await pool.release(conn)
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        if self._held_conn is not None:
+            yield self._held_conn
+            return
+        pool = await self._pool()
+        conn = await pool.acquire()
+        try:
+            yield conn
+        except BaseException:
+            conn.close()
+            raise
+        finally:
+            await pool.release(conn)
+
+    async def _end_statement(self, conn):
+        if not self._in_transaction and not conn.get_autocommit():
+            await conn.commit()
+
+    async def _pool(self):
+        loop = asyncio.get_running_loop()
+        key = (Riko.shaded_pool.config_key(self._db_conf), loop)
+        pool = AsyncDBI._pools.get(key)
+        if pool is None:
+            config = dict(AsyncDBI.pool_settings)
+            config.update(self._db_conf)
+            if "database" in config:
+                config["db"] = config.pop("database")
+            config["cursorclass"] = _aiomysql().DictCursor
+            pool = AsyncDBI._pools[key] = asyncio.ensure_future(_aiomysql().create_pool(**config))
+        try:
+            return await pool
+        except Exception:
+            if AsyncDBI._pools.get(key) is pool:
+                del AsyncDBI._pools[key]
+            raise
+
+    @staticmethod
+    def _cursor_class(cursor_class):
+        aiomysql = _aiomysql()
+        return {
+            None: aiomysql.DictCursor,
+            pymysql.cursors.Cursor: aiomysql.Cursor,
+            pymysql.cursors.DictCursor: aiomysql.DictCursor,
+            pymysql.cursors.SSCursor: aiomysql.SSCursor,
+            pymysql.cursors.SSDictCursor: aiomysql.SSDictCursor,
+        }.get(cursor_class, cursor_class)
+
+
+class AsyncResultStream:
+    """
+    Query result fetched lazily from an unbuffered server-side cursor of an `AsyncDBI` session.
+    """
+
+    def __init__(self, dbi, sql, args, batch_size, cursor_class):
+        self._dbi = dbi
+        self._sql = sql
+        self._args = args
+        self._batch_size = batch_size
+        self._cursor_class = cursor_class
+        self._connection = None
+        self._cursor = None
+        self._exhausted = False
+        self.description = None
+
+    async def __aenter__(self):
+        self._connection = self._dbi._connection()
+        conn = await self._connection.__aenter__()
+        try:
+            self._cursor = await conn.cursor(self._cursor_class)
+            await self._cursor.execute(self._sql, self._args)
+        except BaseException as ex:
+            await self._connection.__aexit__(type(ex), ex, ex.__traceback__)
+            raise
+        self.description = self._cursor.description
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        conn = self._cursor.connection
+        if self._exhausted:
+            await self._cursor.close()
+            await self._dbi._end_statement(conn)
+        else:
+            # a connection abandoned halfway is closed instead of reading the remaining rows
+            conn.close()
+        await self._connection.__aexit__(exc_type, exc_val, exc_tb)
+
+    def __aiter__(self):
+        return self._rows()
+
+    async def _rows(self):
+        async for batch in self.batches():
+            for row in batch:
+                yield row
+
+    async def batches(self):
+        """
+        Iterate the result in batches of rows.
+        """
+        while True:
+            batch = await self._cursor.fetchmany(self._batch_size)
+            if not batch:
+                self._exhausted = True
+                break
+            yield batch
+
+
+class ColumnarResult:
+    """
+    Query result stored in columns.
+    Integer, float and temporal columns are NumPy arrays if NumPy is installed, with NULL as NaN or NaT, and
+    integer columns with NULL turned to float. Other columns, including DECIMAL, are Python lists.
+    """
+    _INT_TYPES = frozenset((FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.INT24, FIELD_TYPE.LONG,
+                            FIELD_TYPE.LONGLONG, FIELD_TYPE.YEAR))
+    _FLOAT_TYPES = frozenset((FIELD_TYPE.FLOAT, FIELD_TYPE.DOUBLE))
+    _DATETIME_TYPES = frozenset((FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP))
+
+    def __init__(self, description, rows):
+        """
+        Create columns from a cursor description and tuple rows, column names must be unique.
+        :param description: cursor description
+        :param rows: a list of tuple rows
+        """
+        self.names = [d[0] for d in description] if description else list()
+        if len(set(self.names)) != len(self.names):
+            # description has no table names to tell columns of joined tables apart as dict rows do
+            duplicated = sorted({name for name in self.names if self.names.count(name) > 1})
+            raise Exception("Duplicated column in columnar result, select it with an alias: " + ", ".join(duplicated))
+        self.row_count = len(rows)
+        values = list(zip(*rows)) if rows else [() for _ in self.names]
+        self.columns = OrderedDict((d[0], ColumnarResult._to_column(d[1], list(v)))
+                                   for (d, v) in zip(description or (), values))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return self.row_count
+
+    def to_dict(self):
+        """
+        Get columns as a dict of column name to column values.
+        """
+        return dict(self.columns)
+
+    @staticmethod
+    def _to_column(type_code, values):
+        np = _numpy()
+        if np is None:
+            return values
+        try:
+            if type_code in ColumnarResult._INT_TYPES:
+                if None in values:
+                    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+                return np.array(values, dtype=np.int64)
+            if type_code in ColumnarResult._FLOAT_TYPES:
+                return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+            if type_code in ColumnarResult._DATETIME_TYPES:
+                return np.array(values, dtype="datetime64[us]")
+            if type_code == FIELD_TYPE.DATE:
+                return np.array(values, dtype="datetime64[D]")
+            if type_code == FIELD_TYPE.TIME:
+                return np.array(values, dtype="timedelta64[us]")
+        except (OverflowError, ValueError, TypeError):
+            # BIGINT UNSIGNED beyond int64, or zero dates returned as strings
+            pass
+        return values
+
+
+async def _then(awaitable, callback):
+    return callback(await awaitable)
+
+
+async def _resolved(value):
+    return value
+
+
+_aiomysql_module = None
+
+
+def _aiomysql():
+    """
+    Import aiomysql lazily, as it is an optional dependency for `AsyncDBI`.
+    """
+    global _aiomysql_module
+    if _aiomysql_module is None:
+        try:
+            import aiomysql
+        except ImportError:
+            raise Exception("AsyncDBI requires aiomysql, which is not installed")
+        _aiomysql_module = aiomysql
+    return _aiomysql_module
+
+
+_numpy_module = None
+
+
+def _numpy():
+    """
+    Import NumPy lazily, as it is an optional dependency.
+    :return: numpy module, or None if it is not installed
+    """
+    global _numpy_module
+    if _numpy_module is None:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = False
+    return _numpy_module or None
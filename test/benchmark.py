@@ -0,0 +1,216 @@
+"""
+Micro-benchmarks for Riko internals, run from the project root: `PYTHONPATH=. python test/benchmark.py`.
+Benchmarks here do not need a database connection, except those enabled by `--db` which use `Riko.db_config`.
+"""
+import sys
+import timeit
+import tracemalloc
+from datetime import date, datetime as dt
+
+from pymysql.constants import FIELD_TYPE
+
+from src.riko import Riko, CONNECTION, PING, SqlQuery, SqlRender, DictModel, ObjectModel, ModelMaterializer, \
+    TemporalDumper
+
+
+class BenchUser(DictModel):
+    ak = "uid"
+    pk = ["uid"]
+    fields = ["username", "age"]
+
+
+class BenchArticle(ObjectModel):
+    """
+    Object model with columns in per-object `__dict__`.
+    """
+    ak = "aid"
+    pk = ["aid"]
+
+    def __init__(self):
+        super().__init__()
+        self.aid = None
+        self.author_uid = 0
+        self.title = ""
+        self.content = ""
+
+
+class BenchCompactArticle(ObjectModel):
+    """
+    Object model with columns in `__slots__`.
+    """
+    ak = "aid"
+    pk = ["aid"]
+    fields = ["author_uid", "title", "content"]
+    slots = True
+
+
+class BenchDictArticle(DictModel):
+    ak = "aid"
+    pk = ["aid"]
+    fields = ["author_uid", "title", "content"]
+
+
+def legacy_render(template, args):
+    """
+    The former `SqlRender.render`, which rescanned the template once per placeholder.
+    """
+    _render = template
+    for (k, v) in args.items():
+        _render = _render.replace(k, v)
+    return _render
+
+
+def legacy_deserialize(cls, db_conf, _datetime_dump=True, **terms):
+    """
+    The former `AbstractModel.deserialize`, which called `__init__` and `set_value` for each row.
+    """
+    try:
+        des_obj = cls(_db_config=db_conf)
+    except Exception as ce:
+        des_obj = cls()
+    for (k, v) in terms.items():
+        if _datetime_dump:
+            if isinstance(v, dt):
+                v = v.strftime('%Y-%m-%d %H:%M:%S')
+            elif isinstance(v, date):
+                v = v.strftime('%Y-%m-%d')
+        des_obj.set_value(k, v)
+    des_obj.mark_clean()
+    return des_obj
+
+
+def legacy_datetime_dump(rows):
+    """
+    The former datetime dump of `SqlQuery.get`, which checked type of every value.
+    """
+    for raw_item in rows:
+        for (k, v) in raw_item.items():
+            if isinstance(v, dt):
+                raw_item[k] = v.strftime('%Y-%m-%d %H:%M:%S')
+            elif isinstance(v, date):
+                raw_item[k] = v.strftime('%Y-%m-%d')
+
+
+RENDER_CASES = {
+    "insert": (SqlQuery._Insert_Template, SqlQuery._Insert_Segments, {
+        SqlQuery._KW_INSERT_REPLACE: "INSERT",
+        SqlQuery._KW_TABLE: "BenchUser",
+        SqlQuery._KW_FIELDS: "username, age",
+        SqlQuery._KW_VALUES: "%(__RIKO_VALUES_username)s, %(__RIKO_VALUES_age)s",
+        SqlQuery._KW_ON_DUPLICATE_KEY_UPDATE: "",
+    }),
+    "delete": (SqlQuery._Delete_Template, SqlQuery._Delete_Segments, {
+        SqlQuery._KW_TABLE: "BenchUser",
+        SqlQuery._KW_WHERE: "WHERE uid = %(__RIKO_WHERE_uid)s",
+    }),
+    "update": (SqlQuery._Update_Template, SqlQuery._Update_Segments, {
+        SqlQuery._KW_TABLE: "BenchUser",
+        SqlQuery._KW_WHERE: "WHERE uid = %(__RIKO_WHERE_uid)s",
+        SqlQuery._KW_FIELDS: "username = %(__RIKO_SET_username)s, age = %(__RIKO_SET_age)s",
+    }),
+    "select": (SqlQuery._Select_Template, SqlQuery._Select_Segments, {
+        SqlQuery._KW_DISTINCT: "",
+        SqlQuery._KW_FIELDS: "*",
+        SqlQuery._KW_TABLE: "BenchUser",
+        SqlQuery._KW_JOIN: "",
+        SqlQuery._KW_WHERE: "WHERE username = %(__RIKO_WHERE_username)s",
+        SqlQuery._KW_GROUP_BY: "",
+        SqlQuery._KW_HAVING: "",
+        SqlQuery._KW_ORDER_BY: "ORDER BY age",
+        SqlQuery._KW_LIMIT: "LIMIT 10",
+        SqlQuery._KW_OFFSET: "",
+        SqlQuery._KW_FORUPDATE: "",
+    }),
+}
+
+
+def bench_render(number=200000):
+    print("== sql template rendering (ns per statement) ==")
+    for (name, (template, segments, terms)) in RENDER_CASES.items():
+        before = timeit.timeit(lambda: legacy_render(template, terms), number=number) / number * 1e9
+        after = timeit.timeit(lambda: SqlRender.render_compiled(segments, terms), number=number) / number * 1e9
+        print("%-8s before: %8.1f  after: %8.1f  speedup: %.2fx" % (name, before, after, before / after))
+
+
+def bench_models(number=100000):
+    print("== %d model objects: memory and access ==" % number)
+    rows = [{"aid": i, "author_uid": i % 100, "title": "title %d" % i, "content": "content"} for i in range(number)]
+    for clazz in (BenchArticle, BenchCompactArticle, BenchDictArticle):
+        tracemalloc.start()
+        objects = [clazz.deserialize(None, **row) for row in rows]
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        build = timeit.timeit(lambda: [clazz.deserialize(None, **row) for row in rows], number=1) / number * 1e9
+        access = timeit.timeit(lambda: [o.get_value("title") for o in objects], number=1) / number * 1e9
+        print("%-20s memory: %6.1f bytes/object  deserialize: %7.1f ns  get_value: %5.1f ns" %
+              (clazz.__name__, memory / number, build, access))
+
+
+def bench_materialize(number=1000000):
+    print("== materialize %d rows (ns per row) ==" % number)
+    rows = [{"aid": i, "author_uid": i % 100, "title": "title %d" % i, "content": "content"} for i in range(number)]
+    for clazz in (BenchArticle, BenchCompactArticle, BenchDictArticle):
+        before = timeit.timeit(lambda: [legacy_deserialize(clazz, None, **row) for row in rows], number=1)
+        after = timeit.timeit(lambda: ModelMaterializer.materialize(clazz, rows), number=1)
+        print("%-20s before: %7.1f  after: %7.1f  speedup: %.2fx" %
+              (clazz.__name__, before / number * 1e9, after / number * 1e9, before / after))
+
+
+def bench_datetime_dump(number=100000, width=20):
+    print("== datetime dump of %d rows, %d columns with 2 temporal (ns per row) ==" % (number, width))
+    description = [("c%d" % i, FIELD_TYPE.LONG) + (None,) * 5 for i in range(width - 2)]
+    description += [("created", FIELD_TYPE.DATETIME) + (None,) * 5, ("day", FIELD_TYPE.DATE) + (None,) * 5]
+    template = dict(("c%d" % i, i) for i in range(width - 2))
+    template.update(created=dt(2020, 1, 2, 3, 4, 5), day=date(2020, 1, 2))
+
+    def fresh_rows():
+        return [dict(template) for _ in range(number)]
+    rows = fresh_rows()
+    before = timeit.timeit(lambda: legacy_datetime_dump(rows), number=1)
+    rows = fresh_rows()
+    after = timeit.timeit(lambda: TemporalDumper.dump(rows, TemporalDumper.temporal_keys(rows, description)),
+                          number=1)
+    print("before: %7.1f  after: %7.1f  speedup: %.2fx" % (before / number * 1e9, after / number * 1e9, before / after))
+
+
+def point_query_latency(number):
+    BenchUser.get_one(uid=1)
+    samples = list()
+    for _ in range(number):
+        begin = timeit.default_timer()
+        BenchUser.get_one(uid=1)
+        samples.append((timeit.default_timer() - begin) * 1e6)
+    samples.sort()
+    return samples[len(samples) // 2], samples[len(samples) * 99 // 100]
+
+
+def bench_connection_modes(number=1000):
+    print("== %d point queries by connection mode (us per call, needs a database) ==" % number)
+    modes = (("short", CONNECTION.SHORT), ("thread-local", CONNECTION.THREAD_LOCAL), ("pooled", CONNECTION.POOLED))
+    for (name, mode) in modes:
+        Riko.set_connection_mode(mode)
+        print("%-12s p50: %8.1f  p99: %8.1f" % ((name,) + point_query_latency(number)))
+    Riko.set_connection_mode(CONNECTION.SHORT)
+    Riko.shaded_pool.close_thread_connections()
+
+
+def bench_ping_policies(number=1000):
+    print("== %d point queries on a thread-local connection by ping policy (us per call, needs a database) =="
+          % number)
+    Riko.set_connection_mode(CONNECTION.THREAD_LOCAL)
+    for (name, policy) in (("always", PING.ALWAYS), ("idle", PING.IDLE), ("never", PING.NEVER)):
+        Riko.set_ping_policy(policy)
+        print("%-12s p50: %8.1f  p99: %8.1f" % ((name,) + point_query_latency(number)))
+    Riko.set_ping_policy(PING.IDLE)
+    Riko.set_connection_mode(CONNECTION.SHORT)
+    Riko.shaded_pool.close_thread_connections()
+
+
+if __name__ == '__main__':
+    bench_render()
+    bench_models()
+    bench_materialize()
+    bench_datetime_dump()
+    if "--db" in sys.argv:
+        bench_connection_modes()
+        bench_ping_policies()
@@ -1,4 +1,4 @@
-from src.riko import Riko, DictModel, ObjectModel, INSERT
+from src.riko import Riko, DictModel, ObjectModel, INSERT, DATETIME_DUMP, CONNECTION, AsyncDBI, Session
 
 
 class BlogArticle(ObjectModel):
@@ -48,7 +48,8 @@ if __name__ == '__main__':
     article1_id = article1.insert()
     # update object fields
     article1.content += " (updated)"
-    article1.save()
+    article1_dirty_fields = article1.dirty_fields()  # {'content'}
+    article1.save()  # only `content` is written, nothing is sent if no column changed
     # delete object
     article1.delete()
 
@@ -61,6 +62,24 @@ if __name__ == '__main__':
     article_page1 = BlogArticle.get(return_columns=("title",), _order="title", _limit=5, _offset=1)
     article_page2 = BlogArticle.get(return_columns=("title",), _order=("title", "author_uid"), _limit=5, _offset=1)
 
+    # stream a large result lazily on a server-side cursor
+    streamed_title_bytes = 0
+    for article in BlogArticle.iter(_batch_size=500, author_uid=12):
+        streamed_title_bytes += len(article.title)
+    streamed_usernames = set()
+    for row in BlogUser.select().where(age=17).stream(batch_size=1000, parse_model=False):
+        streamed_usernames.add(row["username"])
+
+    # datetime values translated to string only when they are read
+    lazy_rows = BlogArticle.select().where(author_uid=12).get(_datetime_dump=DATETIME_DUMP.LAZY)
+
+    # columnar result, with NumPy arrays for numeric and temporal columns if NumPy is installed
+    age_columns = BlogUser.select(return_columns=("uid", "age")).columns_result()
+    ages = age_columns["age"]
+    chunked_rows = 0
+    for chunk in BlogArticle.select(return_columns=("aid", "author_uid")).columns_stream(chunk_size=100000):
+        chunked_rows += len(chunk)
+
     # select query
     select_result1 = (BlogUser
                       .select()
@@ -68,6 +87,10 @@ if __name__ == '__main__':
                       .pagination(1, 3)
                       .order_by("age")
                       .get())
+    # keyset pagination, each page costs the same at any depth
+    page1, next_token = BlogArticle.select().order_by("title").keyset_page(per_page=5)
+    page2, next_token = BlogArticle.select().order_by("title").keyset_page(per_page=5, token=next_token)
+    page_after = BlogArticle.select().order_by("title").seek(title="Koito yuu", aid=3).limit(5).get()
     select_result2 = (BlogArticle
                       .select(return_columns=('title',))
                       .alias("t")
@@ -91,6 +114,11 @@ if __name__ == '__main__':
                      .insert_many()
                      .values(["author_uid", "title", "content"], articles2insert)
                      .go())
+    # batch insert in multi-row statements, split by row count and statement byte size
+    chunk_affected_rows = (BlogArticle
+                           .insert_many()
+                           .values(["author_uid", "title", "content"], articles2insert)
+                           .go_chunked(max_rows=1000, max_bytes=4 * 1024 * 1024, commit_per_chunk=False))
     article_x4 = BlogArticle.create(author_uid=13, title="Bloom into you 4", content="Test content 4")
     article_x5 = BlogArticle.create(author_uid=13, title="Bloom into you 5", content="Test content 5")
     affected_row2 = (BlogArticle
@@ -98,6 +126,11 @@ if __name__ == '__main__':
                      .from_objects([article_x4, article_x5])
                      .go())
 
+    # bulk load by LOAD DATA LOCAL INFILE, needs `local_infile=True` in db config
+    # loaded_rows = BlogArticle.bulk_load(((12, "Bulk %d" % i, "Bulk content") for i in range(100000)),
+    #                                     columns=("author_uid", "title", "content"),
+    #                                     on_duplicate_key_replace=INSERT.DUPLICATE_KEY_IGNORE)
+
     # delete query
     affected_row3 = (BlogRating
                      .delete_query()
@@ -145,6 +178,12 @@ if __name__ == '__main__':
     # on duplicate key update
     user_pk_conflict.insert(on_duplicate_key_replace=INSERT.DUPLICATE_KEY_UPDATE, age=user_pk_conflict["age"] + 1)
 
+    # batched update of a list of objects, in a few statements on one transaction
+    articles2update = BlogArticle.get(author_uid=12)
+    for article in articles2update:
+        article.content += " (batch updated)"
+    batch_updated = BlogArticle.update_many(articles2update, columns=("content",), chunk_size=500)
+
     # count with condition
     article_number1 = BlogArticle.count(aid=3)
     article_number2 = BlogArticle.count(_where_raw=("aid <= 3",))
@@ -163,3 +202,102 @@ if __name__ == '__main__':
         # t = 1 / 0  # uncomment this to raise exception, and transaction will rollback
         article_tx.content = "Aha, a transaction. (content updated)"
         article_tx.save(t=_t)
+
+    # identity map, a row is loaded as one object in a session
+    session = BlogArticle.create().dbi
+    session.use_identity_map()
+    article_im1 = BlogArticle.get_one(t=session, aid=3)
+    article_im2 = BlogArticle.get_one(t=session, aid=3)  # no query, same object as `article_im1`
+    articles_im = BlogArticle.get(t=session, author_uid=12)  # rows merged into loaded objects
+    session.close()
+
+    # reuse a persistent connection of each thread for sessions of `short_connection=True`
+    Riko.set_connection_mode(CONNECTION.THREAD_LOCAL)
+    reused1 = BlogUser.get_one(uid=1)
+    reused2 = BlogUser.get_one(uid=2)  # no new connection
+    Riko.set_connection_mode(CONNECTION.SHORT)
+    Riko.shaded_pool.close_thread_connections()
+
+    # pooled connections, with pool settings, warm-up and statistics
+    Riko.shaded_pool.configure(Riko.db_config, min_idle=4, max_size=32, max_lifetime=3600, idle_timeout=600,
+                               checkout_timeout=5)
+    Riko.shaded_pool.warm_up()
+    pooled_user = BlogUser.get_one(short_connection=False, uid=1)
+    pool_stats = Riko.shaded_pool.stats()
+
+    # rendered sql cache, shared by queries with the same shape
+    sql_cache_stats = Riko.sql_cache.stats()
+    # Riko.sql_cache.enable(False)  # uncomment this to render every query from scratch
+
+    # query result cache, dropped when a write through Riko touches the table
+    cached_users = BlogUser.get(_cached=True, _cache_ttl=30, age=17)
+    cached_articles = BlogArticle.select().where(author_uid=12).cached(ttl=30).get()
+    result_cache_stats = Riko.result_cache.stats()
+
+    # primary key lookups through a row cache in shared memory, shared by all worker processes on the host
+    # from src.riko import SharedEntityCache
+    # BlogUser.entity_cache = SharedEntityCache("/dev/shm/riko-blog-user", buckets=16384, ways=4, ttl=300)
+    # shared_user = BlogUser.get_one(uid=1)
+
+    # read from replicas, writes and transactions stay on primary
+    # from src.riko import Topology
+    # replica_configs = [(dict(Riko.db_config, host="replica1"), 2), dict(Riko.db_config, host="replica2")]
+    # Riko.set_topology(Topology(Riko.db_config, replica_configs, max_lag=5, read_your_writes=1, hedge_after=0.05))
+    # replica_users = BlogUser.get(age=17)  # performed on a replica
+    # primary_user = BlogUser.select().where(uid=1).for_update().get()  # performed on primary
+
+    # rows of a model spread on databases by shard key
+    # from src.riko import ShardMap, SHARD
+    # class BlogEvent(DictModel):
+    #     pk = ["eid"]
+    #     fields = ["uid", "kind", "created_at"]
+    #     shard_map = ShardMap("uid", [dict(Riko.db_config, host="shard0"), dict(Riko.db_config, host="shard1")],
+    #                          strategy=SHARD.HASH)
+    # BlogEvent.create(eid=1, uid=12, kind="login").insert()  # written to the shard of uid 12
+    # user_events = BlogEvent.get(uid=12)  # performed on the shard of uid 12 only
+    # recent_events = BlogEvent.get(_order="created_at DESC", _limit=20)  # all shards, merged in order
+    # event_count = BlogEvent.count(kind="login")  # counts of all shards added
+
+    # statements sent in one multi-statement packet, needs `client_flag=CLIENT.MULTI_STATEMENTS` in db config
+    # from src.riko import DBI
+    # pipe_session = DBI.get_connection(short_connection=False)
+    # with pipe_session.pipeline():
+    #     pipe_article = BlogArticle.create(title="Pipelined article", author_uid=12)
+    #     inserted_handle = pipe_article.insert(t=pipe_session)  # `aid` is set when the pipeline is flushed
+    #     updated_handle = BlogUser.update_query(t=pipe_session).set(age=18).where(uid=12).go()
+    # pipelined_aid, pipelined_updated = inserted_handle.value, updated_handle.value
+
+    # unit of work, changes written at commit in one transaction by a handful of batched statements
+    with Session() as uow:
+        uow_users = BlogUser.get(t=uow.dbi, age=17)  # loaded objects are tracked
+        for uow_user in uow_users:
+            uow_user["age"] = 18
+        uow.add(BlogArticle.create(title="UoW article 1", author_uid=12),
+                BlogArticle.create(title="UoW article 2", author_uid=12))
+        uow.delete(*BlogArticle.get(author_uid=13))
+
+    # IN lists are bound as arguments, a list above `in_table_threshold` is loaded into a temporary table
+    listed_query = BlogArticle.select().where_in("aid", list(range(1, 10001))).where_not_in("author_uid", [12])
+    listed_articles = listed_query.get()
+    listed_articles_again = listed_query.get()  # executed again with the same SQL
+
+    # independent queries performed concurrently on pooled connections, results in order
+    dashboard_users, dashboard_articles, dashboard_count = Riko.gather(
+        BlogUser.select().where(age=17),
+        BlogArticle.select().where(author_uid=12).order_by("aid").limit(10),
+        lambda: BlogArticle.count(author_uid=12),
+        max_workers=8)
+
+    # asyncio, with an aiomysql connection pool (aiomysql is required)
+    async def async_demo():
+        adbi = AsyncDBI()
+        async_users = await BlogUser.select(t=adbi).where(age=17).get(parse_model=True)
+        async_article = BlogArticle.create(title="Async article", author_uid=12)
+        await async_article.insert(t=adbi)
+        async with adbi.transaction() as atx:
+            async_article.content = "Written in an async transaction."
+            await async_article.save(t=atx)
+        async for row in BlogArticle.select(t=adbi).where(author_uid=12).stream(batch_size=100):
+            print(row)
+        await AsyncDBI.close_pools()
+    # asyncio.run(async_demo())
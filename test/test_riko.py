@@ -0,0 +1,1108 @@
+"""
+Unit tests of riko on a fake pymysql driver, no MySQL server is needed.
+Run by `python -m pytest test` from the repository root.
+"""
+import asyncio
+import base64
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+import pymysql
+import pytest
+from pymysql.constants import CLIENT, FIELD_TYPE
+from pymysql.converters import escape_item
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.riko import (Riko, DictModel, ObjectModel, DBI, AsyncDBI, ShadedDBPool, ShardMap, SHARD,  # noqa: E402
+                      CONNECTION, INSERT, SelectQuery, QueryBatch, IdentityMap, SharedEntityCache, ResultCache,
+                      Session, ColumnarResult, TemporalDumper, Topology, ConditionQuery, SqlQuery, SqlRender,
+                      ModelMaterializer)
+
+
+class FakeCursor:
+    def __init__(self, conn, cursor_class=None):
+        self.conn = conn
+        self.cursor_class = cursor_class
+        self.rows = list()
+        self.description = None
+        self.lastrowid = None
+        self.rowcount = 0
+
+    def mogrify(self, sql, args=None):
+        if args is None:
+            return sql
+        if isinstance(args, dict):
+            return sql % {k: escape_item(v, "utf8") for (k, v) in args.items()}
+        return sql % tuple(escape_item(v, "utf8") for v in args)
+
+    def execute(self, sql, args=None):
+        if sql.startswith("LOAD DATA"):
+            with open(args[0], "rb") as data:
+                self.conn.loaded.append(data.read())
+            args = ("'data'",)
+        self.conn.executed.append(self.mogrify(sql, args))
+        failure = self.conn.driver.failure_of(sql)
+        if failure is not None:
+            raise failure
+        delay = self.conn.driver.delays.get(self.conn.config.get("host"))
+        if delay:
+            time.sleep(delay)
+        if sql == "SELECT @@max_allowed_packet":
+            self.rows = [{"@@max_allowed_packet": 1 << 20}]
+        elif sql.startswith("SHOW REPLICA STATUS"):
+            self.rows = list(self.conn.driver.replica_status.get(self.conn.config.get("host"), ()))
+            self.description = None
+        elif sql.lstrip().upper().startswith("SELECT"):
+            self.rows = [dict(row) for row in self.conn.driver.tables.get(self.conn.config.get("host"), ())]
+            self.description = tuple((name, 3, None, None, None, None, True) for name in
+                                     (self.rows[0] if self.rows else ()))
+            if self.cursor_class is not None and not issubclass(self.cursor_class, pymysql.cursors.DictCursorMixin):
+                self.rows = [tuple(row.values()) for row in self.rows]
+            self.rowcount = len(self.rows)
+            self.conn._result = self
+        else:
+            self.rows = list()
+            self.rowcount = 1
+        self.conn.driver.last_id += 1
+        self.lastrowid = self.conn.driver.last_id
+        return self.rowcount
+
+    @property
+    def unbuffered_active(self):
+        return bool(self.rows)
+
+    def executemany(self, sql, args):
+        for row in args:
+            self.execute(sql, row)
+        return len(args)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, list()
+        return rows
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        if self.rows:
+            self.conn.drained = True
+        self.rows = list()
+
+
+class FakeConnection:
+    def __init__(self, driver, config):
+        self.driver = driver
+        self.config = config
+        self.executed = list()
+        self.loaded = list()
+        self.drained = False
+        self._result = None
+        self.open = True
+        self.server_status = 0
+        self.client_flag = config.get("client_flag", 0)
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self, cursor_class)
+
+    def ping(self, reconnect=True):
+        pass
+
+    def begin(self):
+        self.executed.append("BEGIN")
+
+    def commit(self):
+        self.executed.append("COMMIT")
+
+    def rollback(self):
+        self.executed.append("ROLLBACK")
+
+    def autocommit(self, value):
+        pass
+
+    def get_autocommit(self):
+        return False
+
+    def close(self):
+        self.open = False
+
+
+class FakeDriver:
+    """
+    A pymysql stand-in. SELECT returns the rows of `tables` for the `host` of the connection config.
+    """
+
+    def __init__(self):
+        self.tables = dict()
+        self.failures = list()
+        self.connections = list()
+        self.last_id = 0
+        self.down = set()
+        self.delays = dict()
+        self.replica_status = dict()
+
+    def connect(self, **config):
+        if config.get("host") in self.down:
+            raise pymysql.err.OperationalError(2003, "Can't connect to MySQL server")
+        conn = FakeConnection(self, config)
+        self.connections.append(conn)
+        return conn
+
+    def failure_of(self, sql):
+        for (fragment, error) in self.failures:
+            if fragment in sql:
+                return error
+        return None
+
+    def executed(self):
+        return [sql for conn in self.connections for sql in conn.executed]
+
+
+@pytest.fixture
+def driver():
+    fake = FakeDriver()
+    shaded_pool, db_config = Riko.shaded_pool, Riko.db_config
+    Riko.shaded_pool = ShadedDBPool(driver=fake)
+    Riko.db_config = {"host": "default"}
+    try:
+        yield fake
+    finally:
+        Riko.shaded_pool, Riko.db_config = shaded_pool, db_config
+
+
+SHARDS = [{"host": "shard0"}, {"host": "shard1"}]
+
+
+class ShardedUser(DictModel):
+    pk = ["uid"]
+    fields = ["uid", "name"]
+    shard_map = ShardMap("uid", SHARDS)
+
+
+def test_shard_of_key_does_not_depend_on_its_python_type():
+    shard_map = ShardMap("uid", SHARDS)
+    assert shard_map.index_of(3) == shard_map.index_of("3") == shard_map.index_of(3.0) == shard_map.index_of(b"3")
+    range_map = ShardMap("uid", SHARDS, strategy=SHARD.RANGE, bounds=[10])
+    assert range_map.index_of("12") == range_map.index_of(12) == 1
+
+
+def test_query_with_string_shard_key_finds_row_of_integer_key(driver):
+    driver.tables["shard1"] = [{"uid": 3, "name": "three"}]
+    assert ShardedUser.get_one(uid="3")["name"] == "three"
+    assert ShardedUser.select().where(uid="3").get() == [{"uid": 3, "name": "three"}]
+
+
+def test_scatter_queries_in_gather_do_not_wait_forever(driver):
+    driver.tables["shard0"] = [{"uid": 2, "name": "two"}]
+    driver.tables["shard1"] = [{"uid": 3, "name": "three"}]
+    max_threads, executor = QueryBatch.max_threads, QueryBatch._executor
+    QueryBatch.max_threads, QueryBatch._executor = 2, None
+    results = list()
+    try:
+        gathering = threading.Thread(target=lambda: results.append(Riko.gather(
+            *[SelectQuery(ShardedUser).set_session(None, None) for _ in range(4)])), daemon=True)
+        gathering.start()
+        gathering.join(timeout=10)
+        assert not gathering.is_alive()
+    finally:
+        QueryBatch._executor.shutdown(wait=False)
+        QueryBatch.max_threads, QueryBatch._executor = max_threads, executor
+    assert all(sorted(row["uid"] for row in rows) == [2, 3] for rows in results[0])
+
+
+def test_distinct_query_across_shards_drops_repeated_rows(driver):
+    driver.tables["shard0"] = [{"uid": 1}, {"uid": 2}]
+    driver.tables["shard1"] = [{"uid": 1}]
+    query = ShardedUser.select(return_columns=("uid",)).distinct()
+    assert query.get(parse_model=False) == [{"uid": 1}, {"uid": 2}]
+    stream = ShardedUser.select(return_columns=("uid",)).distinct().order_by("uid").stream(parse_model=False)
+    assert list(stream) == [{"uid": 1}, {"uid": 2}]
+
+
+def test_group_by_query_across_shards_drops_repeated_groups(driver):
+    driver.tables["shard0"] = [{"name": "a"}, {"name": "b"}]
+    driver.tables["shard1"] = [{"name": "b"}]
+    query = ShardedUser.select(return_columns=("name",)).group_by("name").order_by("name")
+    assert query.get(parse_model=False) == [{"name": "a"}, {"name": "b"}]
+
+
+class User(DictModel):
+    ak = "uid"
+    pk = ["uid"]
+    fields = ["uid", "name"]
+
+
+@pytest.fixture
+def thread_local_mode():
+    mode = Riko.connection_mode
+    Riko.set_connection_mode(CONNECTION.THREAD_LOCAL)
+    try:
+        yield
+    finally:
+        Riko.shaded_pool.close_thread_connections()
+        Riko.set_connection_mode(mode)
+
+
+def test_config_key_follows_config_changed_in_place():
+    pool = ShadedDBPool()
+    db_config = {"host": "a"}
+    assert pool.config_key(db_config) == (("host", "a"),)
+    db_config["host"] = "b"
+    assert pool.config_key(db_config) == (("host", "b"),)
+    for db_config in [{"host": str(i)} for i in range(ShadedDBPool._CONFIG_KEY_CAPACITY * 2)]:
+        pool.config_key(db_config)
+    assert len(pool._config_keys) <= ShadedDBPool._CONFIG_KEY_CAPACITY
+
+
+TEMPLATES = [
+    (SqlQuery._Insert_Template, {SqlQuery._KW_INSERT_REPLACE: "INSERT", SqlQuery._KW_TABLE: "User",
+                                 SqlQuery._KW_FIELDS: "uid", SqlQuery._KW_VALUES: "%(uid)s"}),
+    (SqlQuery._Delete_Template, {SqlQuery._KW_TABLE: "User"}),
+    (SqlQuery._Update_Template, {SqlQuery._KW_TABLE: "User", SqlQuery._KW_FIELDS: "name = %(name)s"}),
+    (SqlQuery._Select_Template, {SqlQuery._KW_TABLE: "User", SqlQuery._KW_FIELDS: "*"}),
+]
+
+
+def clauses_of(template, required):
+    optional = [key for key in SqlRender._PLACEHOLDER.findall(template) if key[1] not in required]
+    yield dict(required)
+    for (_, key) in optional:
+        yield dict(required, **{key: key.strip("{}_")})
+    yield dict(required, **{key: key.strip("{}_") for (_, key) in optional})
+
+
+@pytest.mark.parametrize("template, required", TEMPLATES, ids=["insert", "delete", "update", "select"])
+def test_rendered_template_has_no_blank_lines_or_stray_spaces(template, required):
+    segments = SqlRender.compile(template)
+    for clauses in clauses_of(template, required):
+        sql = SqlRender.render_compiled(segments, clauses)
+        assert sql == sql.strip()
+        assert "\n\n" not in sql and "  " not in sql
+        assert all(line == line.strip() for line in sql.split("\n"))
+        assert SqlRender.render(template, clauses) == sql
+
+
+def test_rendered_template_keeps_clauses_in_order():
+    sql = SqlRender.render(SqlQuery._Select_Template, {
+        SqlQuery._KW_TABLE: "User", SqlQuery._KW_FIELDS: "*", SqlQuery._KW_WHERE: "WHERE uid = 1",
+        SqlQuery._KW_LIMIT: "LIMIT 1"})
+    assert sql == "SELECT *\nFROM User\nWHERE uid = 1\nLIMIT 1"
+    sql = SqlRender.render(SqlQuery._Select_Template, {
+        SqlQuery._KW_TABLE: "User", SqlQuery._KW_FIELDS: "uid", SqlQuery._KW_DISTINCT: "DISTINCT"})
+    assert sql == "SELECT DISTINCT uid\nFROM User"
+
+
+@pytest.fixture
+def sql_cache():
+    Riko.sql_cache.clear()
+    try:
+        yield Riko.sql_cache
+    finally:
+        Riko.sql_cache.enable(True)
+
+
+def test_queries_differing_in_args_share_rendered_sql(driver, sql_cache):
+    User.select().where(uid=1).get()
+    User.select().where(uid=2).get()
+    assert sql_cache.stats()["misses"] == 1 and sql_cache.stats()["hits"] == 1
+    assert selects_of(driver)[1] == selects_of(driver)[0].replace("1", "2")
+
+
+def test_pages_of_query_share_rendered_sql(driver, sql_cache):
+    for page in range(3):
+        User.select().order_by("uid").pagination(page, 10).get()
+    User.select().order_by("uid").pagination(0, 20).get()
+    assert sql_cache.stats()["size"] == 1 and sql_cache.stats()["hits"] == 3
+    assert selects_of(driver)[2].endswith("LIMIT 10\nOFFSET 20")
+    assert selects_of(driver)[3].endswith("LIMIT 20\nOFFSET 0")
+
+
+def test_queries_of_different_shapes_do_not_share_rendered_sql(driver, sql_cache):
+    queries = [User.select().where(uid=1), User.select().where(name=1), User.select().where(uid=1, name=1),
+               User.select().where(uid=1).order_by("uid"), User.select().where(uid=1).order_by("name"),
+               User.select().where(uid=1).limit(1),
+               User.select().where(uid=1).inner_join(Article, alias="a", on=("uid",)),
+               User.select().where(uid=1).left_join(Article, alias="a", on=("uid",))]
+    for query in queries:
+        query.get(parse_model=False)
+    assert sql_cache.stats()["misses"] == len(queries) and sql_cache.stats()["hits"] == 0
+    assert len(set(selects_of(driver))) == len(queries)
+
+
+def test_disabled_sql_cache_renders_every_query(driver, sql_cache):
+    User.select().where(uid=1).get()
+    sql_cache.enable(False)
+    assert sql_cache.stats()["size"] == 0
+    User.select().where(uid=1).get()
+    User.select().where(uid=1).get()
+    assert sql_cache.stats() == {"hits": 0, "misses": 0, "size": 0, "capacity": 1024, "enabled": False}
+    assert selects_of(driver)[1] == selects_of(driver)[2] == selects_of(driver)[0]
+
+
+@pytest.fixture
+def topology(driver):
+    created = list()
+
+    def use(replicas=1, **settings):
+        topology = Topology(Riko.db_config, [{"host": "replica" + str(i)} for i in range(replicas)], **settings)
+        Riko.set_topology(topology)
+        created.append(topology)
+        return topology
+
+    try:
+        yield use
+    finally:
+        for topology in created:
+            Riko.remove_topology(topology.primary)
+
+
+def hosts_of(driver, statement):
+    return [conn.config.get("host") for conn in driver.connections for sql in conn.executed
+            if sql.startswith(statement)]
+
+
+def with_replica_tables(driver, replicas=1):
+    driver.tables["default"] = [{"uid": 1, "name": "primary"}]
+    for i in range(replicas):
+        driver.tables["replica" + str(i)] = [{"uid": 1, "name": "replica" + str(i)}]
+
+
+def test_topology_reads_from_replica_and_writes_to_primary(driver, topology):
+    with_replica_tables(driver)
+    topology(read_your_writes=0)
+    assert User.select().get()[0]["name"] == "replica0"
+    User.create(name="new").insert()
+    assert hosts_of(driver, "INSERT") == ["default"]
+
+
+def test_topology_reads_for_update_from_primary(driver, topology):
+    with_replica_tables(driver)
+    topology()
+    assert User.select().where(uid=1).for_update().get()[0]["name"] == "primary"
+    assert hosts_of(driver, "SELECT") == ["default"]
+
+
+def test_topology_reads_from_primary_after_write_of_thread(driver, topology):
+    with_replica_tables(driver)
+    topology(read_your_writes=60)
+    User.create(name="new").insert()
+    assert User.select().get()[0]["name"] == "primary"
+
+
+def test_topology_ejects_down_replica_and_reads_from_primary(driver, topology):
+    with_replica_tables(driver)
+    driver.down.add("replica0")
+    replicated = topology()
+    assert User.select().get()[0]["name"] == "primary"
+    assert replicated.stats()["replicas"][0]["ejected"]
+    User.select().get()
+    assert hosts_of(driver, "SELECT") == ["default", "default"]
+
+
+def test_topology_skips_replica_lagging_over_max_lag(driver, topology):
+    with_replica_tables(driver)
+    replicated = topology(max_lag=5)
+    driver.replica_status["replica0"] = [{"Seconds_Behind_Source": 10}]
+    replicated.check_lag()
+    assert User.select().get()[0]["name"] == "primary"
+    driver.replica_status["replica0"] = [{"Seconds_Behind_Source": 1}]
+    replicated.check_lag()
+    assert User.select().get()[0]["name"] == "replica0"
+
+
+def test_hedged_read_tries_another_replica_when_first_fails(driver, topology):
+    with_replica_tables(driver, replicas=2)
+    driver.down.add("replica0")
+    topology(replicas=2, hedge_after=30)
+    begin = time.monotonic()
+    assert User.select().get()[0]["name"] == "replica1"
+    assert time.monotonic() - begin < 30 and "default" not in hosts_of(driver, "SELECT")
+
+
+def test_hedged_read_takes_faster_replica(driver, topology):
+    with_replica_tables(driver, replicas=2)
+    driver.delays["replica0"] = 1
+    topology(replicas=2, hedge_after=0.05)
+    begin = time.monotonic()
+    assert User.select().get()[0]["name"] == "replica1"
+    assert time.monotonic() - begin < 1
+
+
+def test_hedged_read_falls_back_to_primary_when_replicas_are_down(driver, topology):
+    with_replica_tables(driver, replicas=2)
+    driver.down.update(("replica0", "replica1"))
+    replicated = topology(replicas=2, hedge_after=30)
+    assert User.select().get()[0]["name"] == "primary"
+    assert all(replica["ejected"] for replica in replicated.stats()["replicas"])
+
+
+def test_thread_connection_is_not_shared_by_sessions_in_use(driver, thread_local_mode):
+    dbi = DBI(Riko.db_config)
+    with dbi.start_transaction():
+        user_conn = dbi._conn
+        User.create(name="inner").insert()
+        inner_conn, = [conn for conn in driver.connections if conn is not user_conn._raw_conn]
+        assert "COMMIT" in inner_conn.executed and "COMMIT" not in user_conn.executed
+    dbi.close()
+    User.get()
+    assert len(driver.connections) == 2
+
+
+def test_released_thread_connection_rolls_back_open_transaction(driver, thread_local_mode):
+    dbi = DBI(Riko.db_config)
+    dbi.query("UPDATE User SET name = 'x'", None, transactional=False, return_pattern=DBI.RETURN_AFFECTED_ROW)
+    raw_conn = dbi._conn._raw_conn
+    raw_conn.server_status = pymysql.constants.SERVER_STATUS.SERVER_STATUS_IN_TRANS
+    dbi.close()
+    assert raw_conn.executed[-1] == "ROLLBACK"
+
+
+class FakeAsyncDBI(AsyncDBI):
+    """
+    An `AsyncDBI` recording statements instead of performing them on aiomysql.
+    """
+
+    def __init__(self):
+        super().__init__({"host": "async"})
+        self.executed = list()
+
+    async def query(self, sql, args, return_pattern=DBI.RETURN_RESULT, cursor_class=None):
+        await asyncio.sleep(0)
+        self.executed.append(sql)
+        if return_pattern == DBI.RETURN_DESCRIBED_RESULT:
+            return [{"uid": 1, "name": "one"}], (("uid", 3), ("name", 253))
+        return 1
+
+
+def test_update_many_on_async_session_awaits_each_chunk():
+    dbi = FakeAsyncDBI()
+    users = [User.create(uid=i, name="u" + str(i)) for i in range(3)]
+    pending = User.update_many(users, t=dbi, chunk_size=2)
+    assert len(dbi.executed) == 0
+    assert asyncio.run(pending) == 2
+    assert len(dbi.executed) == 2 and not any("name" in user.dirty_fields() for user in users)
+
+
+def test_delete_many_on_async_session_clears_identity_map_after_delete():
+    dbi = FakeAsyncDBI()
+    identity_map = dbi.identity_map = IdentityMap()
+    identity_map.add(User.create(uid=1, name="one"))
+    pending = User.delete_many(t=dbi, uid=1)
+    assert len(identity_map.objects()) == 1
+    assert asyncio.run(pending) == 1
+    assert len(identity_map.objects()) == 0
+
+
+def test_identity_map_keeps_only_objects_with_all_columns(driver):
+    driver.tables["default"] = [{"uid": 3}]
+    dbi = DBI(Riko.db_config, short_connection=False)
+    dbi.use_identity_map()
+    partial = User.get_one(t=dbi, return_columns=("uid",), uid=3)
+    assert partial is not None and len(dbi.identity_map) == 0
+    driver.tables["default"] = [{"uid": 3, "name": "three"}]
+    loaded = User.get_one(t=dbi, uid=3)
+    assert loaded["name"] == "three"
+    assert User.get_one(t=dbi, uid="3") is loaded
+    dbi.close()
+
+
+def test_abandoned_stream_closes_session_connection_instead_of_draining(driver):
+    driver.tables["default"] = [{"uid": uid, "name": str(uid)} for uid in range(5)]
+    dbi = DBI(Riko.db_config, short_connection=False)
+    rows = User.select(t=dbi).stream(batch_size=1)
+    assert next(rows)["uid"] == 0
+    rows.close()
+    first, = driver.connections
+    assert not first.open and not first.drained
+    assert len(User.get(t=dbi)) == 5 and len(driver.connections) == 2
+    dbi.close()
+
+
+def test_abandoned_stream_in_transaction_keeps_connection(driver):
+    driver.tables["default"] = [{"uid": uid, "name": str(uid)} for uid in range(5)]
+    dbi = DBI(Riko.db_config, short_connection=False)
+    with dbi.start_transaction():
+        rows = User.select(t=dbi).stream(batch_size=1)
+        next(rows)
+        rows.close()
+    dbi.close()
+    conn, = driver.connections
+    assert conn.drained and conn.executed[-1] == "COMMIT"
+
+
+def test_failed_pipeline_packet_fails_every_handle_in_it(driver):
+    db_config = {"host": "pipeline", "client_flag": CLIENT.MULTI_STATEMENTS}
+    DBI._max_allowed_packet[("pipeline", None, None)] = 1 << 20
+    driver.failures.append(("INSERT INTO User", pymysql.err.IntegrityError(1062, "Duplicate entry")))
+    dbi = DBI(db_config, short_connection=False)
+    with pytest.raises(pymysql.err.IntegrityError):
+        with dbi.pipeline():
+            first = User.create(name="first").insert(t=dbi)
+            second = User.create(name="second").insert(t=dbi)
+    dbi.close()
+    for handle in (first, second):
+        assert handle.done and isinstance(handle.error, pymysql.err.IntegrityError)
+        with pytest.raises(pymysql.err.IntegrityError):
+            handle.value
+
+
+@pytest.fixture
+def cached_user(tmp_path):
+    User.entity_cache = SharedEntityCache(str(tmp_path / "entities"), buckets=64, ways=2, slot_size=256)
+    try:
+        yield User
+    finally:
+        User.entity_cache.close()
+        User.entity_cache = None
+
+
+def selects_of(driver):
+    return [sql for sql in driver.executed() if sql.startswith("SELECT") and "FROM User" in sql]
+
+
+def test_entity_of_string_key_is_invalidated_by_save_of_integer_key(driver, cached_user):
+    driver.tables["default"] = [{"uid": 3, "name": "three"}]
+    user = User.get_one(uid="3")
+    User.get_one(uid="3")
+    assert len(selects_of(driver)) == 1
+    user["name"] = "changed"
+    user.save()
+    User.get_one(uid="3")
+    assert len(selects_of(driver)) == 2
+
+
+def test_entities_are_dropped_by_writes_of_unknown_rows(driver, cached_user):
+    driver.tables["default"] = [{"uid": 3, "name": "three"}]
+    User.get_one(uid=3)
+    User.update_query().set(name="all").where_raw("name IS NOT NULL").go()
+    User.get_one(uid=3)
+    User.insert_many().values(["uid", "name"], [(3, "replaced")]).replace().go()
+    User.get_one(uid=3)
+    User.insert_many().values(["uid", "name"], [(4, "new")]).go()
+    User.get_one(uid=3)
+    assert len(selects_of(driver)) == 3
+
+
+def test_entity_cache_file_writable_by_others_is_rejected(tmp_path):
+    path = tmp_path / "shared"
+    path.touch()
+    path.chmod(0o666)
+    with pytest.raises(Exception, match="not writable by others"):
+        SharedEntityCache(str(path))
+
+
+def test_entity_cache_invalidation_waits_for_put_in_another_thread(tmp_path):
+    cache = SharedEntityCache(str(tmp_path / "entities"), buckets=4, ways=2, slot_size=256)
+    key = cache.make_key(Riko.db_config, "User", (1,))
+    stamp = cache.stamp(key)
+    invalidation = threading.Thread(target=cache.invalidate, args=(key,))
+    with cache._bucket_lock(cache._locate(key)[1]):
+        invalidation.start()
+        invalidation.join(0.2)
+        assert invalidation.is_alive() and cache.stamp(key) == stamp
+    invalidation.join()
+    assert cache.stamp(key) != stamp
+    assert not cache.put(key, ("uid",), (1,), stamp)
+    cache.close()
+
+
+def test_entity_cache_rows_put_by_threads_are_never_torn(tmp_path):
+    cache = SharedEntityCache(str(tmp_path / "entities"), buckets=1, ways=1, slot_size=256)
+    key = cache.make_key(Riko.db_config, "User", (1,))
+    rows = [(("name",), (str(n) * 100,)) for n in range(4)]
+    errors = list()
+
+    def write(row):
+        for _ in range(200):
+            cache.put(key, row[0], row[1], cache.stamp(key))
+            cache.invalidate(key)
+
+    def read():
+        for _ in range(2000):
+            try:
+                cached = cache.get(key)
+            except Exception as ex:
+                errors.append(ex)
+                return
+            if cached is not None and cached not in rows:
+                errors.append(cached)
+
+    threads = [threading.Thread(target=write, args=(row,)) for row in rows] + [threading.Thread(target=read)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and cache.get(key) is None
+    cache.close()
+
+
+def test_result_read_before_invalidation_is_not_stored():
+    cache = ResultCache()
+    stamp = cache.stamp(["User"])
+    cache.invalidate("User")
+    assert not cache.store(("key",), ["User"], [{"uid": 1}], None, stamp=stamp)
+    assert cache.lookup(("key",)) is None
+
+
+def test_result_cache_is_invalidated_again_at_commit(driver):
+    dbi = DBI(Riko.db_config, short_connection=False)
+    with dbi.start_transaction():
+        User.update_query(t=dbi).set(name="x").where_raw("name IS NULL").go()
+        stamp = Riko.result_cache.stamp(["User"])
+    assert Riko.result_cache.stamp(["User"]) != stamp
+    dbi.close()
+
+
+def test_cached_query_on_async_session_reads_through_cache():
+    dbi = FakeAsyncDBI()
+    Riko.result_cache.clear()
+    for _ in range(2):
+        assert asyncio.run(User.select(t=dbi).where(uid=1).cached().get()) == [{"uid": 1, "name": "one"}]
+    assert len(dbi.executed) == 1
+
+
+def test_dict_methods_mark_model_dirty():
+    user = User.create(uid=1, name="one")
+    user.mark_clean()
+    user.update(name="two")
+    assert user.dirty_fields() == {"name"}
+    user.mark_clean()
+    user.pop("name")
+    user.setdefault("uid", 2)
+    assert user.dirty_fields() == {"name"} and user["uid"] == 1
+    user.mark_clean()
+    user |= {"name": "three"}
+    del user["uid"]
+    assert user.dirty_fields() == {"name", "uid"}
+
+
+class Note(ObjectModel):
+    ak = "nid"
+    pk = ["nid"]
+
+    def __init__(self, _db_config=None, title=None):
+        super().__init__(_db_config)
+        self.nid = None
+        self.title = title
+
+
+def test_helper_attribute_of_first_object_is_not_a_column(driver):
+    note = Note(title="a")
+    note.cached_html = "<p>"
+    note.insert()
+    Note.insert_many().from_objects([Note(title="z")]).go()
+    inserts = [sql for sql in driver.executed() if sql.startswith("INSERT")]
+    assert inserts[-1] == "INSERT INTO Note(title) VALUES ('z')"
+    assert "cached_html" not in inserts[0]
+
+
+class Article(ObjectModel):
+    ak = "aid"
+    pk = ["aid"]
+    fields = ["title"]
+
+    def __init__(self, _db_config=None):
+        super().__init__(_db_config)
+        self.tags = []
+
+
+class CompactArticle(ObjectModel):
+    ak = "aid"
+    pk = ["aid"]
+    fields = ["title"]
+    slots = True
+
+
+def test_object_model_declaring_fields_keeps_other_attributes(driver):
+    driver.tables["default"] = [{"aid": 1, "title": "one"}]
+    article, = Article.get()
+    article.tags.append("news")
+    assert article.title == "one" and article.tags == ["news"]
+    assert Article().title is None
+
+
+def test_objects_built_from_rows_run_their_own_init(driver):
+    class NumberedArticle(ObjectModel):
+        ak = "aid"
+        pk = ["aid"]
+        fields = ["title"]
+        numbered = 0
+
+        def __init__(self, _db_config=None):
+            super().__init__(_db_config)
+            NumberedArticle.numbered += 1
+            self.number = NumberedArticle.numbered
+
+    driver.tables["default"] = [{"aid": 1, "title": "one"}, {"aid": 2, "title": "two"}]
+    first, second = NumberedArticle.get()
+    assert first.number != second.number and not first.is_dirty()
+
+
+def test_object_model_opting_in_slots_has_no_dict(driver):
+    driver.tables["default"] = [{"aid": 1, "title": "one"}]
+    article, = CompactArticle.get()
+    assert article.title == "one" and not hasattr(article, "__dict__")
+    with pytest.raises(AttributeError):
+        article.tags = []
+
+
+def test_keyset_seek_term_is_combined_with_raw_or_terms_and_qualified_keys(driver):
+    query = User.select().alias("u").where_raw("name = 'a' OR name = 'b'").order_by("u.name").seek(name="a", uid=1)
+    query.get()
+    sql, = [sql for sql in driver.executed() if sql.startswith("SELECT")]
+    assert "WHERE (name = 'a' OR name = 'b') AND (u.name, u.uid) > ('a', 1)" in sql
+    assert "ORDER BY u.name, u.uid" in sql
+
+
+def test_keyset_seek_after_null_value_is_rejected(driver):
+    with pytest.raises(Exception, match="NULL"):
+        User.select().order_by("name").after({"uid": 1, "name": None}).get()
+
+
+def test_batch_insert_renders_duplicate_key_update_after_go(driver):
+    query = User.insert_many(on_duplicate_key_replace=INSERT.DUPLICATE_KEY_UPDATE, name="dup")
+    query.values(("uid", "name"), [(1, "one"), (2, "two")])
+    assert query.go() == 1
+    assert query.go_chunked() == [1]
+    inserts = [sql for sql in driver.executed() if sql.startswith("INSERT")]
+    assert inserts == ["INSERT INTO User(uid, name) VALUES (1, 'one'),(2, 'two') "
+                       "ON DUPLICATE KEY UPDATE name = 'dup'"] * 2
+
+
+def test_columnar_result_rejects_duplicated_column_names():
+    description = (("uid", 3), ("name", 253), ("uid", 3))
+    with pytest.raises(Exception, match="uid"):
+        ColumnarResult(description, [(1, "one", 2)])
+
+
+def test_lazy_temporal_row_converts_values_when_copied():
+    row, = TemporalDumper.lazy([{"uid": 1, "ts": datetime.datetime(2020, 1, 2, 3, 4, 5)}], ("ts",))
+    expected = {"uid": 1, "ts": "2020-01-02 03:04:05"}
+    assert dict(row) == expected and {**row} == expected and row == expected
+    assert json.loads(json.dumps(row.dump())) == expected
+
+
+def test_commit_per_chunk_is_rejected_in_transaction(driver):
+    dbi = DBI(Riko.db_config, short_connection=False)
+    with pytest.raises(Exception, match="in a transaction"):
+        with dbi.start_transaction():
+            User.create(name="first").insert(t=dbi)
+            User.insert_many(t=dbi).values(("uid", "name"), [(2, "two")]).go_chunked(commit_per_chunk=True)
+    dbi.close()
+    conn, = driver.connections
+    assert "COMMIT" not in conn.executed and conn.executed[-1] == "ROLLBACK"
+
+
+def test_chunked_insert_on_session_leaves_transaction_to_caller(driver):
+    dbi = DBI(Riko.db_config, short_connection=False)
+    User.insert_many(t=dbi).values(("uid", "name"), [(1, "one"), (2, "two")]).go_chunked(max_rows=1)
+    dbi.close()
+    conn, = driver.connections
+    assert conn.executed[-1].startswith("INSERT") and "COMMIT" not in conn.executed
+
+
+def test_where_in_values_are_bound_once_per_execution(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    query = User.select(t=DBI(Riko.db_config, short_connection=False)).where_in("uid", [1, 2, 3])
+    query.get()
+    query.get()
+    assert selects_of(driver) == ["SELECT *\nFROM User\nWHERE uid IN (1,2,3)"] * 2
+
+
+@pytest.fixture
+def in_table_threshold():
+    threshold = ConditionQuery.in_table_threshold
+    ConditionQuery.in_table_threshold = 2
+    try:
+        yield
+    finally:
+        ConditionQuery.in_table_threshold = threshold
+
+
+def test_where_in_values_over_threshold_are_loaded_into_temporary_table(driver, in_table_threshold):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    dbi = DBI(Riko.db_config, short_connection=False)
+    query = User.select(t=dbi).where_in("uid", [1, 2, 3])
+    for _ in range(2):
+        assert query.get() == [{"uid": 1, "name": "one"}]
+    dbi.close()
+    assert "__RIKO_IN_uid" not in query._args
+    assert selects_of(driver) == ["SELECT *\nFROM User\nWHERE uid IN (SELECT v FROM __riko_in_0)"] * 2
+    loads = [sql for sql in driver.executed() if sql.startswith("INSERT INTO __riko_in_0")]
+    assert loads == ["INSERT INTO __riko_in_0 VALUES (1),(2),(3)"] * 2
+
+
+def test_cached_query_over_threshold_loads_no_table_on_hit(driver, in_table_threshold):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    Riko.result_cache.clear()
+    for _ in range(2):
+        assert User.select().where_in("uid", [1, 2, 3]).cached().get() == [{"uid": 1, "name": "one"}]
+    executed = len(driver.executed())
+    User.select().where_in("uid", [1, 2, 3]).cached().get()
+    assert len(driver.executed()) == executed
+    User.select().where_in("uid", [1, 2, 4]).cached().get()
+    assert len(selects_of(driver)) == 2
+    Riko.result_cache.clear()
+
+
+def test_keyset_page_token_seeks_after_last_row(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "a"}, {"uid": 2, "name": "b"}]
+    page, token = User.select().order_by("name").keyset_page(per_page=2)
+    assert [row["uid"] for row in page] == [1, 2] and token is not None
+    page, next_token = User.select().order_by("name").keyset_page(per_page=3, token=token)
+    assert next_token is None
+    assert "WHERE (name, User.uid) > ('b', 2)\nORDER BY name, User.uid\nLIMIT 3" in selects_of(driver)[-1]
+    with pytest.raises(Exception, match="Miss match continuation token"):
+        User.select().order_by("uid").continue_from(token)
+
+
+@pytest.mark.parametrize("token", ["x", "!!!", base64.urlsafe_b64encode(b"[]").decode(),
+                                   base64.urlsafe_b64encode(b'{"c": ["name", "uid"]}').decode(), 3])
+def test_malformed_continuation_token_is_rejected(token):
+    with pytest.raises(Exception, match="Miss match continuation token"):
+        User.select().order_by("name").continue_from(token)
+
+
+def test_keyset_ordering_by_expression_is_rejected_before_query(driver):
+    with pytest.raises(Exception, match="must be a column"):
+        User.select().order_by("LOWER(name)").keyset_page(per_page=2)
+    assert driver.executed() == []
+
+
+def lose_connection(driver, fragment):
+    driver.failures.append((fragment, pymysql.err.OperationalError(2013, "Lost connection to MySQL server")))
+    return lambda: [sql for sql in driver.executed() if fragment in sql]
+
+
+def test_read_on_temporary_session_is_retried_after_lost_connection(driver):
+    performed = lose_connection(driver, "FROM User")
+    with pytest.raises(pymysql.err.OperationalError):
+        User.select().where(uid=1).get()
+    assert len(performed()) == 2
+
+
+@pytest.mark.parametrize("perform", [lambda: User.create(name="new").insert(),
+                                     lambda: User.update_query().set(name="x").where(uid=1).go(),
+                                     lambda: User.select().where(uid=1).for_update().get()],
+                         ids=["insert", "update", "for_update"])
+def test_write_or_locking_read_is_not_retried_after_lost_connection(driver, perform):
+    performed = lose_connection(driver, "User")
+    with pytest.raises(pymysql.err.OperationalError):
+        perform()
+    assert len(performed()) == 1
+
+
+def test_read_in_transaction_is_not_retried_after_lost_connection(driver):
+    performed = lose_connection(driver, "FROM User")
+    dbi = DBI(Riko.db_config, short_connection=False)
+    with pytest.raises(pymysql.err.OperationalError):
+        with dbi.start_transaction():
+            User.select(t=dbi).where(uid=1).get()
+    dbi.close()
+    assert len(performed()) == 1
+
+
+def test_read_is_not_retried_after_other_errors(driver):
+    driver.failures.append(("FROM User", pymysql.err.OperationalError(1205, "Lock wait timeout")))
+    with pytest.raises(pymysql.err.OperationalError):
+        User.select().where(uid=1).get()
+    assert len([sql for sql in driver.executed() if "FROM User" in sql]) == 1
+
+
+def test_failed_session_commit_restores_objects(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}, {"uid": 2, "name": "two"}]
+    driver.failures.append(("DELETE FROM User", pymysql.err.OperationalError(1205, "Lock wait timeout")))
+    with Session(short_connection=False) as session:
+        loaded, removed = User.get(t=session.dbi)
+        loaded["name"] = "changed"
+        created = User.create(name="new")
+        session.add(created)
+        session.delete(removed)
+        with pytest.raises(pymysql.err.OperationalError):
+            session.commit()
+        assert loaded.dirty_fields() == {"name"} and created.get_ak() is None
+        assert session.dirty() == [loaded] and removed in session.dbi.identity_map
+        driver.failures.clear()
+        session.commit()
+    updates = [sql for sql in driver.executed() if sql.startswith("UPDATE User")]
+    assert len(updates) == 2 and "changed" in updates[1]
+    assert created.get_ak() is not None and not loaded.is_dirty()
+
+
+def test_bulk_load_sends_bytes_as_they_are(driver):
+    dbi = DBI(Riko.db_config, short_connection=False)
+    User.bulk_load([(1, b"\xff\x00\t"), (2, "\u00e9")], columns=("uid", "name"), t=dbi, charset="binary")
+    dbi.close()
+    conn, = driver.connections
+    assert conn.loaded == [b"1\t\xff\\0\\t\n2\t\xc3\xa9\n"]
+    assert "CHARACTER SET binary" in conn.executed[-2]
+
+
+def test_bulk_load_on_session_rolls_back_to_savepoint_if_rows_raise(driver):
+    def rows():
+        yield 1, "one"
+        raise ValueError("source failed")
+
+    dbi = DBI(Riko.db_config, short_connection=False)
+    with pytest.raises(ValueError):
+        User.bulk_load(rows(), columns=("uid", "name"), t=dbi)
+    dbi.close()
+    assert driver.connections[0].executed[-1] == "ROLLBACK TO SAVEPOINT riko_load"
+
+
+def test_stream_yields_models_in_batches_and_releases_connection(driver):
+    driver.tables["default"] = [{"uid": uid, "name": str(uid)} for uid in range(5)]
+    users = list(User.select().stream(batch_size=2))
+    assert [user["uid"] for user in users] == list(range(5)) and all(isinstance(user, User) for user in users)
+    conn, = driver.connections
+    assert not conn.open and not conn.drained
+
+
+def test_chunked_insert_splits_statements_by_rows_and_bytes(driver):
+    rows = [(i, "x" * 10) for i in range(5)]
+    assert User.insert_many().values(("uid", "name"), rows).go_chunked(max_rows=2) == [1, 1, 1]
+    inserts = [sql for sql in driver.executed() if sql.startswith("INSERT INTO User")]
+    assert [sql.count("(") - 1 for sql in inserts] == [2, 2, 1]
+    assert driver.connections[0].executed[-1] == "COMMIT"
+    limit = len(inserts[0]) - 1
+    assert len(User.insert_many().values(("uid", "name"), rows).go_chunked(max_bytes=limit)) == 5
+
+
+def test_update_many_writes_chunks_in_one_transaction(driver):
+    users = [User.create(uid=i, name="u" + str(i)) for i in range(3)]
+    User.update_many(users, chunk_size=2)
+    executed = driver.connections[0].executed
+    assert executed[0] == "BEGIN" and executed[-1] == "COMMIT" and len(executed) == 4
+    assert "name = CASE uid WHEN 0 THEN 'u0' WHEN 1 THEN 'u1' ELSE name END" in executed[1]
+    assert executed[1].endswith("uid IN (0, 1)")
+    assert not any("name" in user.dirty_fields() for user in users)
+
+
+class Account(DictModel):
+    pk = ["uid"]
+    fields = ["uid", "name", "email", "joined"]
+
+
+def test_save_writes_only_changed_columns(driver):
+    account = Account.create(uid=1, name="one", email="a")
+    account.mark_clean()
+    assert account.save() == 0 and driver.executed() == []
+    account["name"] = "two"
+    account.save()
+    update, = [sql for sql in driver.executed() if sql.startswith("UPDATE")]
+    assert "name = 'two'" in update and "email" not in update
+    assert not account.is_dirty()
+
+
+def test_materializer_builds_models_and_dumps_temporal_columns():
+    moment = datetime.datetime(2024, 1, 2, 3, 4, 5)
+    rows = [{"uid": 1, "name": "one", "joined": moment}, {"uid": 2, "name": "two", "joined": None}]
+    description = (("uid", FIELD_TYPE.LONG), ("name", FIELD_TYPE.VAR_STRING), ("joined", FIELD_TYPE.DATETIME))
+    accounts = ModelMaterializer.materialize(Account, rows, description=description)
+    assert all(isinstance(account, Account) and not account.is_dirty() for account in accounts)
+    assert accounts[0]["joined"] == "2024-01-02 03:04:05" and accounts[1]["joined"] is None
+    assert accounts[1]["name"] == "two"
+
+
+def test_columns_result_keeps_columns_in_order(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}, {"uid": 2, "name": "two"}]
+    result = User.select().columns_result()
+    assert list(result) == ["uid", "name"] and len(result) == 2
+    assert list(result["uid"]) == [1, 2] and list(result["name"]) == ["one", "two"]
+    chunks = list(User.select().columns_stream(chunk_size=1))
+    assert [list(chunk["uid"]) for chunk in chunks] == [[1], [2]]
+
+
+def test_identity_map_returns_loaded_object_without_query(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    dbi = DBI(Riko.db_config, short_connection=False)
+    dbi.use_identity_map()
+    loaded, = User.get(t=dbi)
+    assert User.get_one(t=dbi, uid=1) is loaded and len(selects_of(driver)) == 1
+    loaded["name"] = "changed"
+    assert User.get(t=dbi)[0] is loaded and loaded["name"] == "changed"
+    dbi.close()
+
+
+def test_cached_query_is_read_again_after_write_of_its_table(driver):
+    Riko.result_cache.clear()
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    for _ in range(2):
+        assert User.select().where(uid=1).cached().get() == [{"uid": 1, "name": "one"}]
+    assert len(selects_of(driver)) == 1
+    User.update_query().set(name="two").where(uid=1).go()
+    driver.tables["default"] = [{"uid": 1, "name": "two"}]
+    assert User.select().where(uid=1).cached().get() == [{"uid": 1, "name": "two"}]
+    assert len(selects_of(driver)) == 2
+
+
+@pytest.fixture
+def pooled_mode():
+    mode = Riko.connection_mode
+    Riko.set_connection_mode(CONNECTION.POOLED)
+    try:
+        yield
+    finally:
+        Riko.set_connection_mode(mode)
+
+
+def test_pooled_sessions_reuse_connection(driver, pooled_mode):
+    User.get()
+    User.get()
+    assert len(driver.connections) == 1
+    stats = Riko.shaded_pool.stats()
+    assert stats["checkouts"] == 2 and stats["creations"] == 1 and stats["idle"] == 1
+
+
+def test_pool_warm_up_connects_min_idle_connections(driver):
+    Riko.shaded_pool.configure(Riko.db_config, min_idle=3)
+    Riko.shaded_pool.warm_up()
+    assert len(driver.connections) == 3 and Riko.shaded_pool.stats()["idle"] == 3
+
+
+def test_gathered_results_are_in_order_of_queries(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}]
+    results = Riko.gather(User.select(), lambda: "plain", User.select(return_columns=("uid",)))
+    assert results == [[{"uid": 1, "name": "one"}], "plain", [{"uid": 1, "name": "one"}]]
+
+
+def test_failed_gathered_query_is_returned_in_its_place(driver):
+    driver.failures.append(("FROM User", pymysql.err.OperationalError(1205, "Lock wait timeout")))
+    results = Riko.gather(User.select(), lambda: "plain", return_exceptions=True)
+    assert isinstance(results[0], pymysql.err.OperationalError) and results[1] == "plain"
+
+
+def test_pipeline_sends_statements_in_one_round_trip(driver):
+    db_config = {"host": "pipeline", "client_flag": CLIENT.MULTI_STATEMENTS}
+    DBI._max_allowed_packet[("pipeline", None, None)] = 1 << 20
+    dbi = DBI(db_config, short_connection=False)
+    with dbi.pipeline():
+        first = User.create(name="first").insert(t=dbi)
+        second = User.update_query(t=dbi).set(name="x").where(uid=1).go()
+        assert not first.done and hosts_of(driver, "INSERT") == []
+    dbi.close()
+    packet, = [sql for sql in driver.executed() if sql.startswith("INSERT")]
+    assert packet.startswith("INSERT INTO User") and ";\nUPDATE User" in packet
+    assert first.done and second.value == 1
+
+
+def test_session_commit_writes_inserts_updates_and_deletes_in_order(driver):
+    driver.tables["default"] = [{"uid": 1, "name": "one"}, {"uid": 2, "name": "two"}]
+    with Session(short_connection=False) as session:
+        loaded, removed = User.get(t=session.dbi)
+        loaded["name"] = "changed"
+        session.add(User.create(name="a"), User.create(name="b"))
+        session.delete(removed)
+    writes = [sql.split()[0] for sql in driver.connections[0].executed if not sql.startswith(("SELECT", "SET"))]
+    assert writes == ["BEGIN", "INSERT", "INSERT", "UPDATE", "DELETE", "COMMIT"]